@@ -0,0 +1,567 @@
+#!/usr/bin/env python
+
+#  SG_CACHE module
+
+import cPickle
+import os
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+class LRUCache(object):
+    """
+    Thread-safe least recently used cache with optional expiry.
+
+    Holds at most max_entries values. Values older than ttl seconds are
+    treated as missing (ttl of None keeps them until they are evicted).
+    """
+    def __init__(self, max_entries=1000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._entries = {} # key -> [prev, next, key, value, expires]
+        # sentinel of a circular doubly linked list, most recently used first
+        self._head = [None, None, None, None, None]
+        self._head[0] = self._head[1] = self._head
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _unlink(self, entry):
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
+
+    def _link_first(self, entry):
+        head = self._head
+        entry[0] = head
+        entry[1] = head[1]
+        head[1][0] = entry
+        head[1] = entry
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for key, or default if there is none
+        or it has expired.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[4] is not None and entry[4] < time.time():
+                self._remove(entry)
+                return default
+            self._unlink(entry)
+            self._link_first(entry)
+            return entry[3]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, expires=None):
+        """
+        Caches value for key, evicting the least recently used values if
+        the cache is full. expires is an absolute time, it defaults to ttl
+        seconds from now.
+        """
+        if expires is None and self.ttl is not None:
+            expires = time.time() + self.ttl
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._remove(entry)
+            entry = [None, None, key, value, expires]
+            self._entries[key] = entry
+            self._link_first(entry)
+            while len(self._entries) > self.max_entries:
+                self._remove(self._head[0])
+        finally:
+            self._lock.release()
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self._entries[entry[2]]
+        self.evicted(entry[2], entry[3])
+
+    def evicted(self, key, value):
+        """
+        Called whenever a value leaves the cache. Does nothing by default.
+        """
+        pass
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._remove(entry)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            for key in self._entries.keys():
+                self._remove(self._entries[key])
+        finally:
+            self._lock.release()
+
+    def items(self):
+        """
+        Returns (key, value, expires) for every cached value, most recently
+        used first.
+        """
+        self._lock.acquire()
+        try:
+            items = []
+            entry = self._head[1]
+            while entry is not self._head:
+                items.append((entry[2], entry[3], entry[4]))
+                entry = entry[1]
+            return items
+        finally:
+            self._lock.release()
+
+def cache_file_name(*keys):
+    """
+    Returns a file name that is unique to the given keys (eg. site url and
+    script name), safe to use on any file system.
+    """
+    return md5("\0".join([str(k) for k in keys])).hexdigest()
+
+class SchemaCache(LRUCache):
+    """
+    Cache for the results of the schema_* methods of a single site.
+
+    If cache_dir is given, the cache is also saved to a file in that
+    directory named after the site url, so it survives between processes.
+    Processes sharing the file merge their entries into it.
+    """
+    def __init__(self, site_url, ttl=300, cache_dir=None, max_entries=1000):
+        LRUCache.__init__(self, max_entries, ttl)
+        self.path = None
+        if cache_dir:
+            self.path = os.path.join(cache_dir, "schema_%s.cache" % cache_file_name(site_url))
+            self._load()
+
+    def _load(self):
+        now = time.time()
+        items = self._read()
+        items.reverse()
+        for key, value, expires in items:
+            if expires is None or expires > now:
+                LRUCache.set(self, key, value, expires)
+
+    def _read(self):
+        # the entries saved in the file, most recently used first
+        try:
+            f = open(self.path, "rb")
+            try:
+                items = cPickle.load(f)
+            finally:
+                f.close()
+            return [(key, value, expires) for key, value, expires in items]
+        except Exception:
+            # nothing saved yet, or the file is unusable (eg. corrupt, or
+            # written by another version)
+            return []
+
+    def _save(self, merge=True):
+        if not self.path:
+            return
+        try:
+            cache_dir = os.path.dirname(self.path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            lock = FileLock(self.path + ".lock")
+            lock.acquire()
+            try:
+                items = self.items()
+                if merge:
+                    # keep what other processes have saved since we loaded
+                    now = time.time()
+                    keys = set([key for key, value, expires in items])
+                    for key, value, expires in self._read():
+                        if key not in keys and (expires is None or expires > now):
+                            items.append((key, value, expires))
+                self._write(items)
+            finally:
+                lock.release()
+        except (IOError, OSError):
+            pass # the in-memory cache still works without the file
+
+    def _write(self, items):
+        # write to a temporary file first, so other processes never see
+        # a half written cache
+        cache_dir = os.path.dirname(self.path)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        f = os.fdopen(fd, "wb")
+        try:
+            cPickle.dump(items, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        try:
+            os.rename(tmp_path, self.path)
+        except OSError:
+            # windows can't rename over an existing file
+            os.remove(self.path)
+            os.rename(tmp_path, self.path)
+
+    def set(self, key, value, expires=None):
+        LRUCache.set(self, key, value, expires)
+        self._save()
+
+    def clear(self):
+        LRUCache.clear(self)
+        self._save(merge=False)
+
+def _rough_sizeof(value):
+    # guess of sys.getsizeof() for pythons older than 2.6, from the sizes
+    # of the common types on 64 bit builds
+    if isinstance(value, str):
+        return 40 + len(value)
+    elif isinstance(value, unicode):
+        return 52 + 4 * len(value)
+    elif isinstance(value, dict):
+        return 280 + 96 * len(value)
+    elif isinstance(value, list):
+        return 72 + 8 * len(value)
+    elif isinstance(value, tuple):
+        return 56 + 8 * len(value)
+    return 24
+
+try:
+    _sizeof = sys.getsizeof
+except AttributeError:
+    _sizeof = _rough_sizeof
+
+def estimate_size(value):
+    """
+    Roughly how many bytes value takes in memory, counting what it 
+    holds. Objects shared between several places are counted each time.
+    """
+    size = _sizeof(value)
+    if isinstance(value, dict):
+        for v in value.itervalues():
+            size += estimate_size(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            size += estimate_size(v)
+    elif hasattr(value, "values") and hasattr(value, "__slots__"):
+        # dict-like records keeping their values in slots
+        for v in value.values():
+            size += estimate_size(v)
+    return size
+
+class QueryCache(LRUCache):
+    """
+    Cache for query results, holding roughly max_size bytes of results at
+    most, for ttl seconds each.
+
+    Each result is stored with the entity types it depends on, so a 
+    write to one type only drops the results that could have changed. A
+    result fetched while one of its types was written to is not stored: 
+    take generations() before fetching and pass them to put().
+    """
+    def __init__(self, ttl=60, max_size=64 * 1024 * 1024, max_entries=1000):
+        LRUCache.__init__(self, max_entries, ttl)
+        self.max_size = max_size
+        self.size = 0
+        self._sizes = {}       # key -> estimated size of the result
+        self._types = {}       # key -> entity types of the result
+        self._keys = {}        # entity type -> keys of the results of that type
+        self._generations = {} # entity type -> number of writes to it
+        self._cleared = 0
+
+    def generations(self, types):
+        self._lock.acquire()
+        try:
+            return (self._cleared,) + tuple([self._generations.get(t, 0) for t in types])
+        finally:
+            self._lock.release()
+
+    def put(self, key, value, types, generations):
+        """
+        Caches value for key, unless it is too big or one of types was 
+        written to since generations were taken.
+        """
+        size = estimate_size(value)
+        if size > self.max_size:
+            return
+        self._lock.acquire()
+        try:
+            if self.generations(types) != generations:
+                return
+            LRUCache.set(self, key, value)
+            self._sizes[key] = size
+            self._types[key] = types
+            self.size += size
+            for t in types:
+                self._keys.setdefault(t, set()).add(key)
+            while self.size > self.max_size:
+                self._remove(self._head[0])
+        finally:
+            self._lock.release()
+
+    def evicted(self, key, value):
+        self.size -= self._sizes.pop(key, 0)
+        for t in self._types.pop(key, ()):
+            keys = self._keys.get(t)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys[t]
+
+    def invalidate(self, entity_type):
+        """
+        Drops every result that depends on entity_type.
+        """
+        self._lock.acquire()
+        try:
+            self._generations[entity_type] = self._generations.get(entity_type, 0) + 1
+            for key in list(self._keys.get(entity_type, ())):
+                self.delete(key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._cleared += 1
+            LRUCache.clear(self)
+        finally:
+            self._lock.release()
+
+class AttachmentCache(object):
+    """
+    Cache of downloaded Attachment files of a single site, kept in a
+    directory on local disk.
+
+    Holds at most max_size bytes. When it grows past that, the least
+    recently used files are deleted. Files are only ever moved into place
+    complete, so several processes can share the same directory.
+    """
+    def __init__(self, site_url, cache_dir, max_size=1024 * 1024 * 1024):
+        self.max_size = max_size
+        self.path = os.path.join(cache_dir, "attachments_%s" % cache_file_name(site_url))
+
+    def _file_path(self, entity_id):
+        return os.path.join(self.path, str(int(entity_id)))
+
+    def get(self, entity_id):
+        """
+        Returns the path of the cached file for an Attachment, or None if
+        it isn't cached.
+        """
+        path = self._file_path(entity_id)
+        try:
+            # the modification time records when it was last used
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def add(self, entity_id, download):
+        """
+        Caches an Attachment. download is called with the path of a
+        temporary file to write it to. Returns the path of the cached file.
+        """
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                pass # made by another process in the meantime
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".part")
+        os.close(fd)
+        path = self._file_path(entity_id)
+        try:
+            download(tmp_path)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # windows can't rename over an existing file
+                os.remove(path)
+                os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._evict(path)
+        return path
+
+    def _evict(self, keep):
+        files = []
+        total = 0
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue # removed by another process
+            total += st.st_size
+            if not name.endswith(".part"):
+                files.append((st.st_mtime, st.st_size, path))
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        if os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+class FileLock(object):
+    """
+    Lock shared between processes, held on a file at path. Threads of 
+    one process must not share a FileLock.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        self._file = open(self.path, "a+b")
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        elif msvcrt is not None:
+            self._file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except IOError:
+                    pass # LK_LOCK gives up after 10 seconds, keep waiting
+
+    def release(self):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._file.close()
+            self._file = None
+
+class SessionCache(object):
+    """
+    Session token of a single site and script, kept in a file in cache_dir
+    so other processes can reuse it until it is ttl seconds old.
+
+    The file is locked while a token is read or fetched, so processes 
+    starting at the same time wait for one of them to fetch a token 
+    instead of each fetching their own.
+    """
+    def __init__(self, site_url, script_name, cache_dir, ttl=3600):
+        self.ttl = ttl
+        self.path = os.path.join(cache_dir, "session_%s.cache" % cache_file_name(site_url, script_name))
+        self._lock = threading.Lock()
+
+    def _file_lock(self):
+        cache_dir = os.path.dirname(self.path)
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                pass # made by another process in the meantime
+        return FileLock(self.path + ".lock")
+
+    def _read(self):
+        # the (session_id, created) saved in the file, or None
+        try:
+            f = open(self.path, "rb")
+            try:
+                session_id, created = cPickle.load(f)
+            finally:
+                f.close()
+            return session_id, float(created)
+        except Exception:
+            # nothing saved yet, or the file is unusable (eg. corrupt, or
+            # written by another version)
+            return None
+
+    def _write(self, token):
+        # mkstemp makes a file only the current user can read
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        f = os.fdopen(fd, "wb")
+        try:
+            cPickle.dump(token, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        try:
+            os.rename(tmp_path, self.path)
+        except OSError:
+            # windows can't rename over an existing file
+            os.remove(self.path)
+            os.rename(tmp_path, self.path)
+
+    def get(self, fetch):
+        """
+        Returns (session_id, created) for the cached token, calling fetch()
+        to get a new session id if there is no token or it is too old.
+        """
+        self._lock.acquire()
+        try:
+            lock = self._file_lock()
+            lock.acquire()
+            try:
+                token = self._read()
+                if token is not None and token[1] + self.ttl > time.time():
+                    return token
+                token = (fetch(), time.time())
+                try:
+                    self._write(token)
+                except (IOError, OSError):
+                    pass # the token can still be used by this process
+                return token
+            finally:
+                lock.release()
+        finally:
+            self._lock.release()
+
+    def invalidate(self, session_id):
+        """
+        Forgets session_id after the server rejected it, unless the cache
+        already holds a newer token.
+        """
+        self._lock.acquire()
+        try:
+            lock = self._file_lock()
+            lock.acquire()
+            try:
+                token = self._read()
+                if token is not None and token[0] == session_id:
+                    try:
+                        os.remove(self.path)
+                    except OSError:
+                        pass
+            finally:
+                lock.release()
+        finally:
+            self._lock.release()
@@ -8,6 +8,54 @@ import stat
 import urllib
 import urllib2
 
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+class MultipartStream(object):
+    """
+    File-like multipart body made of strings and (file, size) pairs, which
+    are read in order. Files are read from disk in chunks as the body is
+    sent, so memory use doesn't depend on the size of the files.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, parts):
+        self._parts = parts = [_utf8(part) for part in parts]
+        self._index = 0
+        self._offset = 0
+        self.length = 0
+        for part in parts:
+            if isinstance(part, basestring):
+                self.length += len(part)
+            else:
+                self.length += part[1]
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length
+        chunks = []
+        while size > 0 and self._index < len(self._parts):
+            part = self._parts[self._index]
+            if isinstance(part, basestring):
+                data = part[self._offset:self._offset + size]
+                self._offset += len(data)
+                done = self._offset >= len(part)
+            else:
+                fd, file_size = part
+                if self._offset == 0:
+                    fd.seek(0)
+                data = fd.read(min(size, file_size - self._offset))
+                self._offset += len(data)
+                done = not data or self._offset >= file_size
+            if done:
+                self._index += 1
+                self._offset = 0
+            chunks.append(data)
+            size -= len(data)
+        return "".join(chunks)
+
 # Based on http://code.activestate.com/recipes/146306/
 class FormPostHandler(urllib2.BaseHandler):
     """
@@ -17,7 +65,7 @@ class FormPostHandler(urllib2.BaseHandler):
 
     def http_request(self, request):
         data = request.get_data()
-        if data is not None and not isinstance(data, basestring):
+        if data is not None and not isinstance(data, basestring) and not isinstance(data, MultipartStream):
             files = []
             params = []
             for key, value in data.items():
@@ -28,32 +76,49 @@ class FormPostHandler(urllib2.BaseHandler):
             if not files:
                 data = urllib.urlencode(params, True) # sequencing on
             else:
-                boundary, data = self.encode(params, files)
+                # stream the body, so files are sent straight from disk
+                # instead of being read into memory
+                boundary, data = self.encode_stream(params, files)
                 content_type = 'multipart/form-data; boundary=%s' % boundary
                 request.add_unredirected_header('Content-Type', content_type)
+                request.add_unredirected_header('Content-Length', str(data.length))
             request.add_data(data)
         return request
 
-    def encode(self, params, files, boundary=None, buffer=None):
+    def encode_stream(self, params, files, boundary=None):
+        """
+        Returns the boundary and a MultipartStream for the multipart body
+        of params and files.
+        """
         if boundary is None:
             boundary = mimetools.choose_boundary()
-        if buffer is None:
-            buffer = cStringIO.StringIO()
+        parts = []
         for (key, value) in params:
-            buffer.write('--%s\r\n' % boundary)
-            buffer.write('Content-Disposition: form-data; name="%s"' % key)
-            buffer.write('\r\n\r\n%s\r\n' % value)
+            parts.append('--%s\r\n' % boundary)
+            parts.append('Content-Disposition: form-data; name="%s"' % _utf8(key))
+            parts.append('\r\n\r\n%s\r\n' % _utf8(value))
         for (key, fd) in files:
-            filename = fd.name.split('/')[-1]
+            filename = _utf8(fd.name).split('/')[-1]
             content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
             file_size = os.fstat(fd.fileno())[stat.ST_SIZE]
-            buffer.write('--%s\r\n' % boundary)
-            buffer.write('Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (key, filename))
-            buffer.write('Content-Type: %s\r\n' % content_type)
-            buffer.write('Content-Length: %s\r\n' % file_size)
-            fd.seek(0)
-            buffer.write('\r\n%s\r\n' % fd.read())
-        buffer.write('--%s--\r\n\r\n' % boundary)
+            parts.append('--%s\r\n' % boundary)
+            parts.append('Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (_utf8(key), filename))
+            parts.append('Content-Type: %s\r\n' % content_type)
+            parts.append('Content-Length: %s\r\n' % file_size)
+            parts.append('\r\n')
+            parts.append((fd, file_size))
+            parts.append('\r\n')
+        parts.append('--%s--\r\n\r\n' % boundary)
+        return boundary, MultipartStream(parts)
+
+    def encode(self, params, files, boundary=None, buffer=None):
+        if buffer is None:
+            buffer = cStringIO.StringIO()
+        boundary, stream = self.encode_stream(params, files, boundary)
+        chunk = stream.read(MultipartStream.chunk_size)
+        while chunk:
+            buffer.write(chunk)
+            chunk = stream.read(MultipartStream.chunk_size)
         buffer = buffer.getvalue()
         return boundary, buffer
 
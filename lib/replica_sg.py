@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+
+#  SG_REPLICA module
+
+import calendar
+import cPickle
+import datetime
+import threading
+from cStringIO import StringIO
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from timezone_sg import sg_timezone
+
+class UnsupportedQuery(Exception):
+    """
+    Raised for find() requests a ReplicaStore can't answer locally.
+    """
+    pass
+
+# the shared tzinfo instances of returned datetimes are pickled by name
+_timezones = {"utc": sg_timezone.utc, "local": sg_timezone.local}
+
+def _persistent_id(obj):
+    if obj is sg_timezone.local:
+        return "local"
+    elif obj is sg_timezone.utc:
+        return "utc"
+    return None
+
+def dumps(value):
+    f = StringIO()
+    p = cPickle.Pickler(f, 2)
+    p.persistent_id = _persistent_id
+    p.dump(value)
+    return f.getvalue()
+
+def loads(data):
+    u = cPickle.Unpickler(StringIO(str(data)))
+    u.persistent_load = _timezones.__getitem__
+    return u.load()
+
+def _is_link(value):
+    # entity links are dicts, or Records from find(compact=True)
+    return isinstance(value, dict) or (hasattr(value, "keys") and hasattr(value, "get"))
+
+def column_value(value):
+    """
+    Returns what is kept in the indexed column of a field for a value, or
+    compared with it in a filter: entity links become "Type:id", datetimes
+    unix times (naive ones are local times, like in requests), dates iso
+    strings and bools ints.
+    """
+    if _is_link(value):
+        return "%s:%s" % (value.get("type"), value.get("id"))
+    elif isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=sg_timezone.local)
+        return calendar.timegm(value.utctimetuple())
+    elif isinstance(value, datetime.date):
+        return value.isoformat()
+    elif isinstance(value, bool):
+        return int(value)
+    return value
+
+def _quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+def _like(text):
+    return unicode(text).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+class SyncMarks(dict):
+    """
+    Sync marks of a ReplicaStore, for an IncrementalSync. Setting one,
+    which the sync does after storing each page, commits the page along
+    with its mark, so a refresh holds the database write lock a page at
+    a time and other processes see how far it got.
+    """
+    def __init__(self, store):
+        dict.__init__(self)
+        self._store = store
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._store._save_marks(key[0])
+
+class ReplicaStore(object):
+    """
+    SQLite store for the entities of a ShotgunReplica, in a file or in
+    memory (path ":memory:"). entities maps each entity type kept to the
+    list of its fields kept.
+
+    Each entity type has a table with the pickled entities and an indexed
+    column per field, which find() requests are translated into queries
+    on. Like on the server, text is compared without regard to case and
+    empty fields sort last. Entities are stored with
+    store[(entity_type, id)] = entity and removed with pop(), so the
+    store can be given to an IncrementalSync.
+
+    A file keeps the sync marks and refresh times too, and can be shared
+    by several processes: reload() picks up what the others have done.
+    Tables whose fields have changed are read again from scratch.
+    """
+    def __init__(self, path, entities):
+        if sqlite3 is None:
+            raise ImportError("the sqlite3 module is required for a replica")
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        self._entities = {}
+        for entity_type, fields in entities.items():
+            fields = [f for f in fields if f not in ("id", "type")]
+            if "updated_at" not in fields:
+                fields.append("updated_at")
+            self._entities[entity_type] = fields
+        self._marks = SyncMarks(self)
+        # per entity type: [refreshed_at, fields holding lists, fields 
+        # holding entity links]
+        self._meta = {}
+
+        db = self._db
+        db.execute("CREATE TABLE IF NOT EXISTS _replica (entity_type PRIMARY KEY, fields, marks, refreshed_at, "
+                   "list_fields, link_fields)")
+        for entity_type, fields in self._entities.items():
+            self._meta[entity_type] = [None, set(), set()]
+            row = db.execute("SELECT fields FROM _replica WHERE entity_type = ?", (entity_type,)).fetchone()
+            if row is None or loads(row[0]) != fields:
+                table = _quote(entity_type)
+                db.execute("DROP TABLE IF EXISTS %s" % table)
+                db.execute("CREATE TABLE %s (id INTEGER PRIMARY KEY, _record, %s)" %
+                    (table, ", ".join([_quote(f) + " COLLATE NOCASE" for f in fields])))
+                for f in fields:
+                    db.execute("CREATE INDEX %s ON %s (%s)" % (_quote("%s.%s" % (entity_type, f)), table, _quote(f)))
+                db.execute("INSERT OR REPLACE INTO _replica VALUES (?, ?, ?, NULL, ?, ?)",
+                    (entity_type, buffer(dumps(fields)), buffer(dumps({})), buffer(dumps(set())),
+                     buffer(dumps(set()))))
+        db.commit()
+        for entity_type in self._entities:
+            self.reload(entity_type)
+
+    def entity_types(self):
+        return self._entities.keys()
+
+    def fields(self, entity_type):
+        return list(self._entities[entity_type])
+
+    def marks(self):
+        """
+        Returns the SyncMarks of all the entity types, for an IncrementalSync.
+        """
+        return self._marks
+
+    def reload(self, entity_type):
+        """
+        Reads the sync marks, refresh time and field kinds of entity_type
+        saved by the last sync, which may have been run by another process.
+        """
+        self._lock.acquire()
+        try:
+            row = self._db.execute("SELECT marks, refreshed_at, list_fields, link_fields FROM _replica "
+                                   "WHERE entity_type = ?", (entity_type,)).fetchone()
+            if row is None:
+                return
+            for key in [k for k in self._marks if k[0] == entity_type]:
+                dict.__delitem__(self._marks, key)
+            dict.update(self._marks, loads(row[0]))
+            meta = self._meta[entity_type]
+            meta[0] = row[1]
+            meta[1].update(loads(row[2]))
+            meta[2].update(loads(row[3]))
+        finally:
+            self._lock.release()
+
+    def refreshed_at(self, entity_type):
+        self.reload(entity_type)
+        return self._meta[entity_type][0]
+
+    def __setitem__(self, key, record):
+        entity_type, entity_id = key
+        fields = self._entities[entity_type]
+        values = [entity_id, buffer(dumps(record))]
+        for f in fields:
+            value = record.get(f)
+            if isinstance(value, (list, tuple)):
+                self._meta[entity_type][1].add(f)
+                value = None
+            elif isinstance(value, dict):
+                self._meta[entity_type][2].add(f)
+            values.append(column_value(value))
+        self._lock.acquire()
+        try:
+            self._db.execute("INSERT OR REPLACE INTO %s VALUES (%s)" %
+                (_quote(entity_type), ", ".join(["?"] * len(values))), values)
+        finally:
+            self._lock.release()
+
+    def pop(self, key, default=None):
+        entity_type, entity_id = key
+        self._lock.acquire()
+        try:
+            table = _quote(entity_type)
+            row = self._db.execute("SELECT _record FROM %s WHERE id = ?" % table, (entity_id,)).fetchone()
+            if row is None:
+                return default
+            self._db.execute("DELETE FROM %s WHERE id = ?" % table, (entity_id,))
+            return loads(row[0])
+        finally:
+            self._lock.release()
+
+    def _save_marks(self, entity_type):
+        # commits the entities stored so far with the marks of their type
+        marks = dict([(k, v) for k, v in self._marks.items() if k[0] == entity_type])
+        meta = self._meta[entity_type]
+        self._lock.acquire()
+        try:
+            self._db.execute("UPDATE _replica SET marks = ?, list_fields = ?, link_fields = ? WHERE entity_type = ?",
+                (buffer(dumps(marks)), buffer(dumps(meta[1])), buffer(dumps(meta[2])), entity_type))
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def refreshed(self, entity_type, refreshed_at):
+        """
+        Records that entity_type was brought up to date by a sync started
+        at refreshed_at, unless another process has done so since.
+        """
+        self._lock.acquire()
+        try:
+            self._db.execute("UPDATE _replica SET refreshed_at = MAX(COALESCE(refreshed_at, 0), ?) "
+                             "WHERE entity_type = ?", (refreshed_at, entity_type))
+            self._db.commit()
+        finally:
+            self._lock.release()
+        self.reload(entity_type)
+
+    def rollback(self):
+        self._lock.acquire()
+        try:
+            self._db.rollback()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._db.close()
+
+    def find(self, req, limit=0):
+        """
+        Returns the entities matching a find() request, as the server
+        would. Raises UnsupportedQuery for requests on entity types or
+        fields that aren't kept (or haven't been read yet), for retired
+        entities, dotted paths, filters on fields holding lists, sorts and
+        ordering relations on entity links (the server orders them by 
+        name) and relations it doesn't know.
+        """
+        entity_type = req["type"]
+        if entity_type not in self._entities or \
+                (self._meta[entity_type][0] is None and self.refreshed_at(entity_type) is None):
+            raise UnsupportedQuery("%s is not replicated" % entity_type)
+        if req["return_only"] != "active":
+            raise UnsupportedQuery("retired entities are not replicated")
+        fields = self._entities[entity_type]
+        for f in req["return_fields"]:
+            if f not in fields and f not in ("id", "type"):
+                raise UnsupportedQuery("%s.%s is not replicated" % (entity_type, f))
+
+        columns = set(fields) - self._meta[entity_type][1]
+        columns.add("id")
+        links = self._meta[entity_type][2]
+        params = []
+        where = self._where(req["filters"], columns, links, params)
+        order = []
+        for sort in req.get("sorts", []):
+            field = sort["field_name"]
+            if field not in columns or field in links:
+                raise UnsupportedQuery("can't sort on %s" % field)
+            # empty fields last, then first when sorting down
+            if sort["direction"] == "desc":
+                order.append("%s IS NULL DESC, %s DESC" % (_quote(field), _quote(field)))
+            else:
+                order.append("%s IS NULL, %s" % (_quote(field), _quote(field)))
+        order.append("id")
+        sql = "SELECT _record FROM %s WHERE %s ORDER BY %s" % (_quote(entity_type), where, ", ".join(order))
+        if limit and limit > 0:
+            sql += " LIMIT %d" % limit
+
+        self._lock.acquire()
+        try:
+            rows = self._db.execute(sql, params).fetchall()
+        finally:
+            self._lock.release()
+        return_fields = [f for f in req["return_fields"] if f not in ("id", "type")]
+        records = []
+        for row in rows:
+            entity = loads(row[0])
+            record = {"type": entity_type, "id": entity["id"]}
+            for f in return_fields:
+                record[f] = entity.get(f)
+            records.append(record)
+        return records
+
+    def _where(self, filters, columns, links, params):
+        # SQL condition for a find() filter or group of filters, adding
+        # the values it compares with to params
+        if "conditions" in filters:
+            if filters.get("logical_operator") == "or":
+                op, empty = " OR ", "0"
+            else:
+                op, empty = " AND ", "1"
+            parts = [self._where(f, columns, links, params) for f in filters["conditions"]]
+            if not parts:
+                return empty
+            return "(%s)" % op.join(parts)
+
+        path, relation, values = filters["path"], filters["relation"], list(filters["values"])
+        if path not in columns:
+            raise UnsupportedQuery("can't filter on %s" % path)
+        column = _quote(path)
+        if relation in ("in", "not_in") and len(values) == 1 and isinstance(values[0], (list, tuple)):
+            values = list(values[0])
+        if relation in ("less_than", "greater_than", "between") and \
+                (path in links or [v for v in values if _is_link(v)]):
+            raise UnsupportedQuery("can't order entity links of %s" % path)
+        values = [column_value(v) for v in values]
+        for v in values:
+            if v is not None and not isinstance(v, (int, long, float, basestring)):
+                raise UnsupportedQuery("can't compare %s with %r" % (path, v))
+        value = values and values[0]
+
+        if relation in ("is", "is_not") and value is None:
+            return "%s %s NULL" % (column, relation == "is" and "IS" or "IS NOT")
+        elif relation in ("type_is", "type_is_not"):
+            values = [_like(value) + ":%"]
+            sql = "%s LIKE ? ESCAPE '\\'" % column
+        elif relation in ("contains", "not_contains"):
+            values = ["%" + _like(value) + "%"]
+            sql = "%s LIKE ? ESCAPE '\\'" % column
+        elif relation == "starts_with":
+            values = [_like(value) + "%"]
+            sql = "%s LIKE ? ESCAPE '\\'" % column
+        elif relation == "ends_with":
+            values = ["%" + _like(value)]
+            sql = "%s LIKE ? ESCAPE '\\'" % column
+        elif relation in ("is", "is_not"):
+            values = [value]
+            sql = "%s = ?" % column
+        elif relation == "less_than":
+            values = [value]
+            sql = "%s < ?" % column
+        elif relation == "greater_than":
+            values = [value]
+            sql = "%s > ?" % column
+        elif relation == "between":
+            values = values[:2]
+            sql = "%s BETWEEN ? AND ?" % column
+        elif relation in ("in", "not_in"):
+            # None in the list matches empty fields
+            none = None in values
+            values = [v for v in values if v is not None]
+            sql = "%s IN (%s)" % (column, ", ".join(["?"] * len(values)))
+            if none:
+                params.extend(values)
+                sql = "(%s IS NULL OR %s)" % (column, sql)
+                if relation == "not_in":
+                    return "NOT " + sql
+                return sql
+        else:
+            raise UnsupportedQuery("unknown relation %s" % relation)
+
+        params.extend(values)
+        if relation in ("is_not", "not_contains", "not_in", "type_is_not"):
+            # like on the server, empty fields match the negative relations
+            return "(%s IS NULL OR NOT %s)" % (column, sql)
+        return sql
@@ -2,7 +2,7 @@
 
 #  SG_TIMEZONE module 
 
-from datetime import tzinfo, timedelta
+from datetime import datetime, tzinfo, timedelta
 import time as _time
 
 ZERO = timedelta(0)
@@ -12,6 +12,8 @@ if _time.daylight:
 else:
     DSTOFFSET = STDOFFSET
 DSTDIFF = DSTOFFSET - STDOFFSET
+EPOCH = datetime(1970, 1, 1)
+DAY = 86400
 
 class SgTimezone:
     def __init__(self):
@@ -29,7 +31,64 @@ class SgTimezone:
             return ZERO
 
     class LocalTimezone(tzinfo):
+        # utc offsets by utc day (days since the epoch) and by local day
+        # (date ordinal), None for days with a dst transition. shared by
+        # all instances.
+        _day_offsets = {}
+        _local_day_offsets = {}
+        max_cached_days = 20000
+
+        def fromutc(self, dt):
+            # same as the default tzinfo.fromutc(), which calls _isdst()
+            # twice, but the offset is looked up once per day
+            delta = dt.replace(tzinfo=None) - EPOCH
+            try:
+                offset = self._day_offsets[delta.days]
+            except KeyError:
+                offset = self._day_offset(delta.days)
+            if offset is None:
+                offset = self._stamp_offset(delta.days * DAY + delta.seconds)
+                if offset is None:
+                    return tzinfo.fromutc(self, dt)
+            return dt + offset
+
+        def _day_offset(self, day):
+            start = self._stamp_offset(day * DAY)
+            if start is None or start != self._stamp_offset(day * DAY + DAY - 1):
+                start = None
+            if len(self._day_offsets) >= self.max_cached_days:
+                self._day_offsets.clear()
+            self._day_offsets[day] = start
+            return start
+
+        def _local_day_offset(self, dt):
+            isdst = self._isdst(dt.replace(hour=0, minute=0, second=0))
+            offset = None
+            if isdst == self._isdst(dt.replace(hour=23, minute=59, second=59)):
+                offset = isdst and DSTOFFSET or STDOFFSET
+            if len(self._local_day_offsets) >= self.max_cached_days:
+                self._local_day_offsets.clear()
+            self._local_day_offsets[dt.toordinal()] = offset
+            return offset
+
+        def _stamp_offset(self, stamp):
+            # offset from utc at a unix time, None when the platform can't
+            # tell (eg. times before 1970 on windows)
+            try:
+                if _time.localtime(stamp).tm_isdst > 0:
+                    return DSTOFFSET
+                return STDOFFSET
+            except (ValueError, OverflowError):
+                return None
+
         def utcoffset(self, dt):
+            day = dt.toordinal()
+            try:
+                offset = self._local_day_offsets[day]
+            except KeyError:
+                offset = self._local_day_offset(dt)
+            if offset is not None:
+                return offset
             if self._isdst(dt):
                 return DSTOFFSET
             else:
@@ -127,6 +127,8 @@ Exported classes:
   Unmarshaller   Unmarshal an XML-RPC response from incoming XML event message
   Transport      Handles an HTTP transaction to an XML-RPC server
   SafeTransport  Handles an HTTPS transaction to an XML-RPC server
+  ConnectionPool Thread-safe pool of keep-alive connections used by the
+                 transports
 
 Exported constants:
 
@@ -150,6 +152,10 @@ from types import *
 import socket
 import errno
 import httplib
+import threading
+import inspect
+import gzip
+import zlib
 
 # --------------------------------------------------------------------
 # Internal stuff
@@ -415,6 +421,14 @@ def _datetime(data):
     return value
 
 def _datetime_type(data):
+    try:
+        # the server always sends "YYYYMMDDTHH:MM:SS", slicing it is much
+        # faster than strptime
+        if len(data) == 17 and data[8] == "T":
+            return datetime.datetime(int(data[:4]), int(data[4:6]), int(data[6:8]),
+                int(data[9:11]), int(data[12:14]), int(data[15:17]))
+    except ValueError:
+        pass
     t = time.strptime(data, "%Y%m%dT%H:%M:%S")
     return datetime.datetime(*tuple(t)[:6])
 
@@ -463,6 +477,27 @@ def _binary(data):
     value.decode(data)
     return value
 
+##
+# Wrapper for a parameter that is sent unchanged with many calls, like
+# authentication details.  The value is marshalled once, when the
+# wrapper is made, and the XML is reused by every call it is passed to.
+# Changing the value afterwards has no effect.
+#
+# @param value Any value that can be marshalled.
+
+class Marshalled(object):
+    """Wrapper for a value marshalled in advance."""
+
+    def __init__(self, value, encoding=None, allow_none=1, convert_datetimes_to_utc=1):
+        self.value = value
+        out = []
+        m = BufferedMarshaller(encoding, allow_none, convert_datetimes_to_utc)
+        m._dump(value, out.append)
+        self.xml = "".join(out)
+
+    def __repr__(self):
+        return "<Marshalled %s at %x>" % (repr(self.value), id(self))
+
 WRAPPERS = (DateTime, Binary)
 if not _bool_is_builtin:
     WRAPPERS = WRAPPERS + (Boolean,)
@@ -539,7 +574,7 @@ try:
     if not hasattr(expat, "ParserCreate"):
         raise ImportError
 except ImportError:
-    ExpatParser = None # expat not available
+    ExpatParser = BufferedExpatParser = None # expat not available
 else:
     class ExpatParser:
         # fast expat parser for Python 2.0 and later.  this is about
@@ -562,6 +597,27 @@ else:
             self._parser.Parse("", 1) # end of data
             del self._target, self._parser # get rid of circular references
 
+    class BufferedExpatParser(ExpatParser):
+        # expat parser set up for ExpatUnmarshaller: text is handed over
+        # in one piece instead of a call per line or entity, and as utf-8 
+        # strings, which are only decoded when they aren't plain ascii
+        def __init__(self, target):
+            self._parser = parser = expat.ParserCreate(None, None)
+            self._target = target
+            parser.buffer_text = 1
+            parser.buffer_size = 65536
+            # xml-rpc elements have no attributes, a list of them is 
+            # cheaper to make than a dict
+            parser.ordered_attributes = 1
+            parser.returns_unicode = 0
+            parser.StartElementHandler = target.start
+            parser.EndElementHandler = target.end
+            parser.CharacterDataHandler = target.data
+            target.xml("utf-8", None)
+
+    if not hasattr(expat.ParserCreate(), "buffer_text"):
+        BufferedExpatParser = None # expat before python 2.3
+
 class SlowParser:
     """Default XML parser (based on xmllib.XMLParser)."""
     # this is about 10 times slower than sgmlop, on roundtrip
@@ -643,9 +699,8 @@ class Marshaller:
         try:
             f = self.dispatch[type(value)]
         except KeyError:
-            raise TypeError, "cannot marshal %s objects" % type(value)
-        else:
-            f(self, value, write)
+            f = _subclass_dump(self.dispatch, type(value))
+        f(self, value, write)
 
     def dump_nil (self, value, write):
         if not self.allow_none:
@@ -771,6 +826,161 @@ class Marshaller:
             self.dump_struct(value.__dict__, write)
     dispatch[InstanceType] = dump_instance
 
+    def dump_marshalled(self, value, write):
+        write(value.xml)
+    dispatch[Marshalled] = dump_marshalled
+
+##
+# XML-RPC marshaller for large requests, like big batch() or create()
+# calls.  Common types are written inline instead of through a dispatch
+# per value, strings are only escaped when they contain a special
+# character, and struct member names are escaped and wrapped once per
+# marshaller.  Everything goes into a single list joined at the end.
+#
+# Recursive structures are only reported as such if check_recursion is 
+# set, otherwise they run into python's recursion limit.  Checking costs
+# a dict update per array and struct.
+
+class BufferedMarshaller(Marshaller):
+
+    dispatch = Marshaller.dispatch.copy()
+
+    def __init__(self, encoding=None, allow_none=1, convert_datetimes_to_utc=1, check_recursion=0):
+        Marshaller.__init__(self, encoding, allow_none, convert_datetimes_to_utc)
+        self.check_recursion = check_recursion
+        self._names = {}
+        if encoding is None:
+            self.encoding = "utf-8"
+
+    def dumps(self, values):
+        out = []
+        write = out.append
+        if isinstance(values, Fault):
+            write("<fault>\n")
+            self._dump({'faultCode': values.faultCode,
+                        'faultString': values.faultString},
+                       write)
+            write("</fault>\n")
+        else:
+            write("<params>\n")
+            for v in values:
+                write("<param>\n")
+                self._dump(v, write)
+                write("</param>\n")
+            write("</params>\n")
+        return "".join(out)
+
+    def _dump(self, value, write, special=re.compile("[&<>]").search):
+        t = type(value)
+        if t is StringType:
+            if special(value):
+                value = escape(value)
+            write("<value><string>")
+            write(value)
+            write("</string></value>\n")
+        elif t is IntType:
+            if value > MAXINT or value < MININT:
+                raise OverflowError, "int exceeds XML-RPC limits"
+            write("<value><int>%d</int></value>\n" % value)
+        elif t is DictType:
+            self._dump_struct(value, write)
+        elif t is ListType or t is TupleType:
+            self._dump_array(value, write)
+        elif value is None:
+            self.dump_nil(value, write)
+        elif value is True:
+            write("<value><boolean>1</boolean></value>\n")
+        elif value is False:
+            write("<value><boolean>0</boolean></value>\n")
+        else:
+            try:
+                f = self.dispatch[t]
+            except KeyError:
+                f = _subclass_dump(self.dispatch, t)
+            f(self, value, write)
+
+    def _name(self, key):
+        # "<member><name>" element for a struct key
+        k = key
+        if type(k) is not StringType:
+            if unicode and type(k) is UnicodeType:
+                k = k.encode(self.encoding)
+            else:
+                raise TypeError, "dictionary key must be string"
+        name = "<member>\n<name>%s</name>\n" % escape(k)
+        self._names[key] = name
+        return name
+
+    def _dump_array(self, value, write):
+        if self.check_recursion:
+            i = id(value)
+            if i in self.memo:
+                raise TypeError, "cannot marshal recursive sequences"
+            self.memo[i] = None
+        dump = self._dump
+        write("<value><array><data>\n")
+        for v in value:
+            dump(v, write)
+        write("</data></array></value>\n")
+        if self.check_recursion:
+            del self.memo[i]
+
+    def _dump_struct(self, value, write, special=re.compile("[&<>]").search):
+        if self.check_recursion:
+            i = id(value)
+            if i in self.memo:
+                raise TypeError, "cannot marshal recursive dictionaries"
+            self.memo[i] = None
+        names = self._names
+        dump = self._dump
+        write("<value><struct>\n")
+        for k, v in value.iteritems():
+            name = names.get(k)
+            if name is None:
+                name = self._name(k)
+            write(name)
+            # plain strings and ints, the most common field values, are 
+            # written here rather than through another call
+            t = type(v)
+            if t is StringType:
+                if special(v):
+                    v = escape(v)
+                write("<value><string>")
+                write(v)
+                write("</string></value>\n</member>\n")
+            elif t is IntType and MININT <= v <= MAXINT:
+                write("<value><int>%d</int></value>\n</member>\n" % v)
+            else:
+                dump(v, write)
+                write("</member>\n")
+        write("</struct></value>\n")
+        if self.check_recursion:
+            del self.memo[i]
+
+    # nested values of types handled by Marshaller (eg. DateTime wrappers
+    # and instances) come back through here
+    _Marshaller__dump = _dump
+
+def _subclass_dump(dispatch, t):
+    # dump function for a subclass of a registered type, remembered for
+    # the next values of the same type
+    for base in getattr(t, "__mro__", ())[1:]:
+        f = dispatch.get(base)
+        if f is not None:
+            dispatch[t] = f
+            return f
+    raise TypeError, "cannot marshal %s objects" % t
+
+##
+# Registers a mapping class, whose instances (and those of its 
+# subclasses) are then marshalled as structs made from their items().
+#
+# @param cls A class with items() and iteritems() methods.
+
+def register_struct_type(cls):
+    Marshaller.dispatch[cls] = Marshaller.__dict__["dump_struct"]
+    BufferedMarshaller.dispatch[cls] = BufferedMarshaller.__dict__["_dump_struct"]
+
 ##
 # XML-RPC unmarshaller.
 #
@@ -798,6 +1008,9 @@ class Unmarshaller:
         self.append = self._stack.append
         self._use_datetime = use_datetime
         self._convert_datetimes_to_utc = convert_datetimes_to_utc
+        # dateTime values already decoded, the same ones (eg. created_at of
+        # records made together) often come up many times in a response
+        self._datetimes = {}
         if use_datetime and not datetime:
             raise ValueError, "the datetime module is not available"
 
@@ -916,9 +1129,13 @@ class Unmarshaller:
 
     def end_dateTime(self, data):
         if self._use_datetime:
-            value = _datetime_type(data)
-            if self._convert_datetimes_to_utc:
-                value = value.replace(tzinfo = sg_timezone.utc).astimezone(sg_timezone.local)
+            value = self._datetimes.get(data)
+            if value is None:
+                value = _datetime_type(data)
+                if self._convert_datetimes_to_utc:
+                    local = sg_timezone.local
+                    value = local.fromutc(value.replace(tzinfo = local))
+                self._datetimes[data] = value
         else:
             value = DateTime()
             value.decode(data)
@@ -947,6 +1164,121 @@ class Unmarshaller:
         self._type = "methodName" # no params
     dispatch["methodName"] = end_methodName
 
+##
+# Unmarshaller specialised for large responses, like find() pages of
+# thousands of records, parsed by BufferedExpatParser.  End tags are 
+# dispatched to bound methods, text is rarely joined, and struct keys 
+# (eg. "type", "id" and field names) are decoded and interned once per
+# response instead of once per record, so records share the key strings.
+
+class ExpatUnmarshaller(Unmarshaller):
+
+    dispatch = Unmarshaller.dispatch.copy()
+
+    def __init__(self, use_datetime=1, convert_datetimes_to_utc=1):
+        Unmarshaller.__init__(self, use_datetime, convert_datetimes_to_utc)
+        self._value = 0
+        self._names = {}
+        # text goes straight into a list that is emptied at each start 
+        # tag, without a python call per piece of text
+        self._data = []
+        self.data = self._data.append
+        self._end = end = {}
+        for tag, f in self.dispatch.items():
+            end[tag] = f.__get__(self)
+
+    def start(self, tag, attrs):
+        if tag == "array" or tag == "struct":
+            self._marks.append(len(self._stack))
+        del self._data[:]
+        self._value = (tag == "value")
+
+    def end(self, tag):
+        f = self._end.get(tag)
+        if f is not None:
+            data = self._data
+            if len(data) == 1:
+                f(data[0])
+            else:
+                f("".join(data))
+
+    def end_string(self, data, is8bit=re.compile("[\x80-\xff]").search):
+        if self._encoding:
+            if is8bit(data):
+                data = unicode(data, self._encoding)
+        else:
+            data = _stringify(data)
+        self.append(data)
+        self._value = 0
+    dispatch["string"] = end_string
+
+    def end_name(self, data):
+        name = self._names.get(data)
+        if name is None:
+            if self._encoding:
+                name = _stringify(_decode(data, self._encoding))
+            else:
+                name = _stringify(data)
+            if type(name) is str:
+                name = intern(name)
+            self._names[data] = name
+        self.append(name)
+        self._value = 0
+    dispatch["name"] = end_name
+
+    def end_struct(self, data):
+        mark = self._marks.pop()
+        items = self._stack[mark:]
+        self._stack[mark:] = [dict(zip(items[::2], items[1::2]))]
+        self._value = 0
+    dispatch["struct"] = end_struct
+
+    def end_value(self, data):
+        if self._value:
+            self.end_string(data)
+    dispatch["value"] = end_value
+
+##
+# Unmarshaller that hands each struct found row_depth containers deep
+# to add_row(keys, values) as soon as it is decoded, instead of building
+# a dict for it.  For find() pages, {"results": {"entities": [...]}}, the
+# entities are 3 deep and the entities list is left empty.
+#
+# @param add_row Called with the lists of keys and values of each row.
+# @param row_depth Number of arrays and structs around each row.
+
+class RowUnmarshaller(ExpatUnmarshaller):
+
+    dispatch = ExpatUnmarshaller.dispatch.copy()
+
+    def __init__(self, add_row, row_depth=3, use_datetime=1, convert_datetimes_to_utc=1):
+        ExpatUnmarshaller.__init__(self, use_datetime, convert_datetimes_to_utc)
+        self._add_row = add_row
+        self._row_depth = row_depth
+
+    def end_struct(self, data):
+        if len(self._marks) != self._row_depth + 1:
+            return ExpatUnmarshaller.end_struct(self, data)
+        mark = self._marks.pop()
+        items = self._stack[mark:]
+        del self._stack[mark:]
+        self._add_row(items[::2], items[1::2])
+        self._value = 0
+    dispatch["struct"] = end_struct
+
+##
+# Returns a parser for an unmarshaller made by the caller.
+#
+# @param target The unmarshaller.
+# @return The fastest available parser feeding target.
+
+def parser_for(target):
+    if BufferedExpatParser and isinstance(target, ExpatUnmarshaller):
+        return BufferedExpatParser(target)
+    elif ExpatParser:
+        return ExpatParser(target)
+    return SlowParser(target)
+
 ## Multicall support
 #
 
@@ -1044,6 +1376,9 @@ def getparser(use_datetime=1, convert_datetimes_to_utc=1):
             parser = FastParser(target)
         elif SgmlopParser:
             parser = SgmlopParser(target)
+        elif BufferedExpatParser:
+            target = ExpatUnmarshaller(use_datetime=use_datetime, convert_datetimes_to_utc=convert_datetimes_to_utc)
+            parser = BufferedExpatParser(target)
         elif ExpatParser:
             parser = ExpatParser(target)
         else:
@@ -1063,6 +1398,8 @@ def getparser(use_datetime=1, convert_datetimes_to_utc=1):
 # @keyparam encoding The packet encoding.
 # @return A string containing marshalled data.
 
+_method_call_heads = {}
+
 def dumps(params, methodname=None, methodresponse=None, encoding=None,
           allow_none=1, convert_datetimes_to_utc=1):
     """data [,options] -> marshalled data
@@ -1097,10 +1434,11 @@ def dumps(params, methodname=None, methodresponse=None, encoding=None,
     if not encoding:
         encoding = "utf-8"
 
-    if FastMarshaller:
+    if FastMarshaller and not (isinstance(params, TupleType) and
+                               [p for p in params if isinstance(p, Marshalled)]):
         m = FastMarshaller(encoding)
     else:
-        m = Marshaller(encoding, allow_none, convert_datetimes_to_utc)
+        m = BufferedMarshaller(encoding, allow_none, convert_datetimes_to_utc)
 
     data = m.dumps(params)
 
@@ -1111,13 +1449,18 @@ def dumps(params, methodname=None, methodresponse=None, encoding=None,
 
     # standard XML-RPC wrappings
     if methodname:
-        # a method call
-        if not isinstance(methodname, StringType):
-            methodname = methodname.encode(encoding)
+        # a method call. the start of it only depends on the method name
+        # and the encoding, so it is only put together once
+        try:
+            head = _method_call_heads[methodname, encoding]
+        except KeyError:
+            name = methodname
+            if not isinstance(name, StringType):
+                name = name.encode(encoding)
+            head = xmlheader + "<methodCall>\n<methodName>" + name + "</methodName>\n"
+            _method_call_heads[methodname, encoding] = head
         data = (
-            xmlheader,
-            "<methodCall>\n"
-            "<methodName>", methodname, "</methodName>\n",
+            head,
             data,
             "</methodCall>\n"
             )
@@ -1171,6 +1514,215 @@ class _Method:
     def __call__(self, *args):
         return self.__send(self.__name, args)
 
+##
+# Encode a request body with gzip.
+#
+# @param data An 8-bit string.
+# @return The gzip compressed string.
+
+def gzip_encode(data):
+    f = StringIO.StringIO()
+    gzf = gzip.GzipFile(mode="wb", fileobj=f, compresslevel=1)
+    gzf.write(data)
+    gzf.close()
+    return f.getvalue()
+
+##
+# Decompresses a "deflate" encoded response.  The body should be zlib
+# wrapped, but some servers send a raw deflate stream instead, so that
+# is what we fall back to if the first bytes aren't a zlib header.
+
+class DeflateDecoder:
+
+    def __init__(self):
+        self._decompressor = None
+
+    def decompress(self, data):
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj()
+            try:
+                return self._decompressor.decompress(data)
+            except zlib.error:
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        if self._decompressor is None:
+            return ""
+        return self._decompressor.flush()
+
+##
+# Get a decompressor for a Content-Encoding.
+#
+# @param encoding Value of the Content-Encoding header, or None.
+# @return An object with decompress(data) and flush() methods, or
+#    None if the response is not compressed.
+
+def get_decoder(encoding):
+    encoding = string.lower(string.strip(encoding or ""))
+    if encoding in ("", "identity"):
+        return None
+    if encoding in ("gzip", "x-gzip"):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return DeflateDecoder()
+    raise ResponseError("unsupported content encoding %r" % encoding)
+
+##
+# HTTP connection classes used by the transports.  These disable Nagle's
+# algorithm on the socket once connected, so small requests on a keep-alive
+# connection are not held back waiting for the server to acknowledge the
+# previous packet.
+
+def _set_nodelay(sock):
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (AttributeError, socket.error):
+        pass # not a TCP socket, or not supported on this platform
+
+# python 2.7 and later can send the request body along with the headers
+_endheaders_sends_body = len(inspect.getargspec(httplib.HTTPConnection.endheaders)[0]) > 1
+
+class HTTPConnection(httplib.HTTPConnection):
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        _set_nodelay(self.sock)
+
+if hasattr(httplib, "HTTPSConnection"):
+    class HTTPSConnection(httplib.HTTPSConnection):
+        def connect(self):
+            httplib.HTTPSConnection.connect(self)
+            _set_nodelay(self.sock)
+else:
+    HTTPSConnection = None
+
+##
+# Thread-safe pool of keep-alive HTTP connections, kept per host.
+# <p>
+# Connections are checked out for the duration of a single request and
+# checked back in once the response has been read, so a single transport
+# can be shared by many threads.  At most max_connections connections
+# are open per host; further checkouts wait until one is returned.
+#
+# @param max_connections Maximum number of connections per host.
+# @param idle_timeout Close connections that have been idle for longer
+#    than this many seconds (None to keep them forever).
+# @param max_lifetime Close connections that were opened more than this
+#    many seconds ago, instead of reusing them (None to disable).
+
+class ConnectionPool:
+    """Thread-safe pool of keep-alive connections."""
+
+    def __init__(self, max_connections=4, idle_timeout=60, max_lifetime=600):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self._lock = threading.Condition()
+        self._idle = {} # host -> list of (connection, last used)
+        self._open = {} # host -> number of connections, idle or not
+        self._generation = 0
+
+    def _expired(self, connection, last_used, now):
+        if self.idle_timeout is not None and now - last_used > self.idle_timeout:
+            return 1
+        if self.max_lifetime is not None and now - connection._pool_created > self.max_lifetime:
+            return 1
+        return connection._pool_generation != self._generation
+
+    ##
+    # Check out a connection to host.
+    #
+    # @param host Host descriptor.
+    # @param factory Called with the host descriptor to create a new
+    #    connection when no idle one is available.
+    # @return A connection handle.
+
+    def checkout(self, host, factory):
+        self._lock.acquire()
+        try:
+            while 1:
+                now = time.time()
+                idle = self._idle.get(host, [])
+                # drop everything that has been idle too long
+                for connection, last_used in idle[:]:
+                    if self._expired(connection, last_used, now):
+                        idle.remove((connection, last_used))
+                        self._open[host] -= 1
+                        connection.close()
+                if idle:
+                    # most recently used first, it is the least likely to
+                    # have been dropped by the server
+                    return idle.pop()[0]
+                if self._open.get(host, 0) < self.max_connections:
+                    self._open[host] = self._open.get(host, 0) + 1
+                    generation = self._generation
+                    break
+                self._lock.wait()
+        finally:
+            self._lock.release()
+
+        try:
+            connection = factory(host)
+        except:
+            self.discard(host, None)
+            raise
+        connection._pool_created = time.time()
+        connection._pool_generation = generation
+        return connection
+
+    ##
+    # Return a connection to the pool, so it can be reused.
+    #
+    # @param host Host descriptor the connection was checked out for.
+    # @param connection Connection handle.
+
+    def checkin(self, host, connection):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            if self._expired(connection, now, now):
+                self._open[host] -= 1
+                connection.close()
+            else:
+                self._idle.setdefault(host, []).append((connection, now))
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+    ##
+    # Close a connection that is in an unknown state instead of
+    # returning it to the pool.
+    #
+    # @param host Host descriptor the connection was checked out for.
+    # @param connection Connection handle.
+
+    def discard(self, host, connection):
+        if connection is not None:
+            connection.close()
+        self._lock.acquire()
+        try:
+            self._open[host] -= 1
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+    ##
+    # Close all idle connections.  Connections that are checked out are
+    # closed when they are returned.
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            for host, idle in self._idle.items():
+                for connection, last_used in idle:
+                    self._open[host] -= 1
+                    connection.close()
+            self._idle = {}
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
+
 ##
 # Standard transport class for XML-RPC over HTTP.
 # <p>
@@ -1183,9 +1735,26 @@ class Transport:
     # client identifier (may be overridden)
     user_agent = "xmlrpclib.py/%s (by www.pythonware.com)" % __version__
 
-    def __init__(self, use_datetime=1, convert_datetimes_to_utc=1):
+    # responses are read in chunks of min_read_size bytes at first,
+    # doubling up to max_read_size for large responses
+    min_read_size = 16 * 1024
+    max_read_size = 1024 * 1024
+
+    # if true, responses with a known length are read straight from
+    # the socket into one buffer and handed to the parser in one go
+    zero_copy = 0
+
+    # ask the server to gzip/deflate responses
+    accept_gzip_encoding = 1
+
+    # gzip request bodies larger than this many bytes (None to never
+    # compress requests; the server has to support gzipped requests)
+    encode_threshold = None
+
+    def __init__(self, use_datetime=1, convert_datetimes_to_utc=1,
+                 max_connections=4, idle_timeout=60, max_lifetime=600):
         self._use_datetime = use_datetime
-        self._connection = (None, None)
+        self._pool = ConnectionPool(max_connections, idle_timeout, max_lifetime)
         self._extra_headers = []
         self._convert_datetimes_to_utc = convert_datetimes_to_utc
 
@@ -1197,13 +1766,17 @@ class Transport:
     # @param handler Target PRC handler.
     # @param request_body XML-RPC request body.
     # @param verbose Debugging flag.
+    # @param new_target Function returning an Unmarshaller for the
+    #     response, if it shouldn't be the one getparser() makes.  It is
+    #     called again for each retry.
     # @return Parsed response.
     
-    def request(self, host, handler, request_body, verbose=0):
+    def request(self, host, handler, request_body, verbose=0, new_target=None):
         #retry request once if cached connection has gone cold
         for i in range(10):
             try:
-                return self.single_request(host, handler, request_body, verbose)
+                target = new_target and new_target()
+                return self.single_request(host, handler, request_body, verbose, target)
             except socket.error, (err_num, msg):
                 if i >= 10 or err_num not in (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE):
                     raise
@@ -1218,9 +1791,11 @@ class Transport:
     # @param handler Target PRC handler.
     # @param request_body XML-RPC request body.
     # @param verbose Debugging flag.
+    # @param target Unmarshaller for the response, if it shouldn't be the
+    #     one getparser() makes.
     # @return Parsed response.
 
-    def single_request(self, host, handler, request_body, verbose=0):
+    def single_request(self, host, handler, request_body, verbose=0, target=None):
         # issue XML-RPC request
 
         h = self.make_connection(host)
@@ -1228,39 +1803,53 @@ class Transport:
             h.set_debuglevel(1)
 
         try:
-            self.send_request(h, handler, request_body)
-            self.send_host(h, host)
-            self.send_user_agent(h)
-            self.send_content(h, request_body)
-
-            response = h.getresponse()
-            if response.status == 200:
-                self.verbose = verbose
-                return self.parse_response(response)
-        except Fault:
-            raise
-        except Exception:
-            # All unexpected errors leave connection in
-            # a strange state, so we clear it.
-            self.close()
-            raise
-
-        #discard any response data and raise exception
-        if (response.getheader("content-length", 0)):
+            try:
+                self.send_request(h, handler, request_body)
+                self.send_host(h, host)
+                self.send_user_agent(h)
+                self.send_content(h, request_body)
+
+                response = h.getresponse()
+                if response.status == 200:
+                    self.verbose = verbose
+                    if self.zero_copy and response.length is not None and not response.chunked \
+                       and not response.getheader("content-encoding"):
+                        # body can be read straight off the socket
+                        return self._parse_response(response, h.sock, target)
+                    if target is not None:
+                        return self._parse_response(response, None, target)
+                    return self.parse_response(response)
+            except Fault:
+                raise
+            except Exception:
+                # All unexpected errors leave connection in
+                # a strange state, so we discard it.
+                self._pool.discard(host, h)
+                h = None
+                raise
+
+            #discard any response data and raise exception
             response.read()
-        raise ProtocolError(
-            host + handler,
-            response.status, response.reason,
-            response.msg,
-            )
+            raise ProtocolError(
+                host + handler,
+                response.status, response.reason,
+                response.msg,
+                )
+        finally:
+            # the response has been read completely, so the
+            # connection can be reused by the next request
+            if h is not None:
+                self._pool.checkin(host, h)
 
     ##
     # Create parser.
     #
     # @return A 2-tuple containing a parser and a unmarshaller.
 
-    def getparser(self):
+    def getparser(self, target=None):
         # get parser and unmarshaller
+        if target is not None:
+            return parser_for(target), target
         return getparser(use_datetime=self._use_datetime, convert_datetimes_to_utc=self._convert_datetimes_to_utc)
 
     ##
@@ -1298,27 +1887,31 @@ class Transport:
     # Connect to server.
     #
     # @param host Target host.
-    # @return A connection handle.
+    # @return A connection handle, checked out of the connection pool.
 
     def make_connection(self, host):
-        #return an existing connection if possible.  This allows
+        #return an idle pooled connection if possible.  This allows
         #HTTP/1.1 keep-alive.
-        if self._connection and host == self._connection[0]:
-            return self._connection[1]
+        return self._pool.checkout(host, self.new_connection)
+
+    ##
+    # Create a new connection object.  Called by the connection pool
+    # when there are no idle connections to reuse.
+    #
+    # @param host Target host.
+    # @return A connection handle.
+
+    def new_connection(self, host):
         # create a HTTP connection object from a host descriptor
         chost, self._extra_headers, x509 = self.get_host_info(host)
-        #store the host argument along with the connection object
-        self._connection = host, httplib.HTTPConnection(chost)
-        return self._connection[1]
+        return HTTPConnection(chost)
 
     ##
-    # Clear any cached connection object.
+    # Close all pooled connection objects.
     # Used in the event of socket errors.
     #
     def close(self):
-        if self._connection[1]:
-            self._connection[1].close()
-            self._connection = (None, None)
+        self._pool.close()
 
     ##
     # Send request header.
@@ -1363,11 +1956,22 @@ class Transport:
     # @param request_body XML-RPC request body.
 
     def send_content(self, connection, request_body):
+        if self.accept_gzip_encoding:
+            connection.putheader("Accept-Encoding", "gzip, deflate")
+        if self.encode_threshold is not None and self.encode_threshold < len(request_body):
+            request_body = gzip_encode(request_body)
+            connection.putheader("Content-Encoding", "gzip")
         connection.putheader("Content-Type", "text/xml")
         connection.putheader("Content-Length", str(len(request_body)))
-        connection.endheaders()
-        if request_body:
-            connection.send(request_body)
+        if _endheaders_sends_body:
+            # headers and body go out in a single write.  writing them
+            # separately and then waiting for the response stalls on the
+            # interaction between Nagle's algorithm and delayed acks.
+            connection.endheaders(request_body)
+        else:
+            connection.endheaders()
+            if request_body:
+                connection.send(request_body)
 
     ##
     # Parse response.
@@ -1389,22 +1993,71 @@ class Transport:
     #    could not be accessed).
     # @return Response tuple and target method.
 
-    def _parse_response(self, file, sock):
+    def _parse_response(self, file, sock, target=None):
         # read response from input file/socket, and parse it
 
-        p, u = self.getparser()
+        if target is not None:
+            p, u = self.getparser(target)
+        else:
+            p, u = self.getparser()
 
-        while 1:
-            if sock:
-                response = sock.recv(1024)
-            else:
-                response = file.read(1024)
-            if not response:
-                break
+        length = None
+        decoder = None
+        if hasattr(file, "getheader"):
+            try:
+                length = int(file.getheader("content-length"))
+            except (TypeError, ValueError):
+                pass
+            decoder = get_decoder(file.getheader("content-encoding"))
+        if decoder:
+            # decompress the response as it is read, straight into the parser
+            def feed(data, feed=p.feed, decompress=decoder.decompress):
+                feed(decompress(data))
+        else:
+            feed = p.feed
+
+        if sock and length is not None:
+            # read the whole body into a single preallocated buffer and
+            # parse it in one go, without copying it into strings first
+            data = bytearray(length)
+            view = memoryview(data)
+            received = 0
+            while received < length:
+                n = sock.recv_into(view[received:], length - received)
+                if not n:
+                    # the connection was closed part way through the body
+                    raise httplib.IncompleteRead(str(data[:received]), length - received)
+                received += n
             if self.verbose:
-                print "body:", repr(response)
-            p.feed(response)
-
+                print "body:", repr(str(data[:received]))
+            if decoder or (ExpatParser and isinstance(p, ExpatParser)):
+                feed(buffer(data, 0, received))
+            else:
+                feed(str(data[:received]))
+        else:
+            # read in chunks that grow as the response turns out to be
+            # large, never asking for more than the announced length
+            read_size = self.min_read_size
+            while 1:
+                if length is not None:
+                    read_size = min(read_size, length)
+                    if not read_size:
+                        break
+                if sock:
+                    response = sock.recv(read_size)
+                else:
+                    response = file.read(read_size)
+                if not response:
+                    break
+                if self.verbose:
+                    print "body:", repr(response)
+                feed(response)
+                if length is not None:
+                    length -= len(response)
+                read_size = min(read_size * 2, self.max_read_size)
+
+        if decoder:
+            p.feed(decoder.flush())
         file.close()
         p.close()
 
@@ -1418,23 +2071,16 @@ class SafeTransport(Transport):
 
     # FIXME: mostly untested
 
-    def make_connection(self, host):
-        #return an existing connection if possible.  This allows
-        #HTTP/1.1 keep-alive.
-        if self._connection and host == self._connection[0]:
-            return self._connection[1]
+    def new_connection(self, host):
         # create a HTTPS connection object from a host descriptor
         # host may be a string, or a (host, x509-dict) tuple
-        try:
-            HTTPS = httplib.HTTPSConnection
-        except AttributeError:
+        if HTTPSConnection is None:
             raise NotImplementedError(
                 "your version of httplib doesn't support HTTPS"
                 )
         else:
             chost, self._extra_headers, x509 = self.get_host_info(host)
-            self._connection = host, HTTPS(chost, None, **(x509 or {}))
-            return self._connection[1]
+            return HTTPSConnection(chost, None, **(x509 or {}))
 
 # From example here, modified for keepalive changes:  http://docs.python.org/library/xmlrpclib.html
 class ProxiedTransport(Transport):
@@ -1442,21 +2088,15 @@ class ProxiedTransport(Transport):
     def set_proxy(self, proxy):
         self.proxy = proxy
         
-    def make_connection(self, host):
-        self.realhost = host
-        host = self.proxy
-        #return an existing connection if possible.  This allows
-        #HTTP/1.1 keep-alive.
-        if self._connection and host == self._connection[0]:
-            return self._connection[1]
-        # create a HTTP connection object from a host descriptor
-        chost, self._extra_headers, x509 = self.get_host_info(host)
-        #store the host argument along with the connection object
-        self._connection = host, httplib.HTTPConnection(chost)
-        return self._connection[1]
+    def new_connection(self, host):
+        # connections are pooled by the real host, but talk to the proxy
+        chost, self._extra_headers, x509 = self.get_host_info(self.proxy)
+        connection = HTTPConnection(chost)
+        connection.realhost = host
+        return connection
         
     def send_request(self, connection, handler, request_body):
-        connection.putrequest("POST", 'http://%s%s' % (self.realhost, handler))
+        connection.putrequest("POST", 'http://%s%s' % (connection.realhost, handler))
 
 
 ##
@@ -1474,6 +2114,8 @@ class ProxiedTransport(Transport):
 #    (default is UTF-8).
 # @keyparam verbose Use a true value to enable debugging output.
 #    (printed to standard output).
+# @keyparam max_connections Maximum number of keep-alive connections
+#    the default transport keeps open to the server.
 # @see Transport
 
 class ServerProxy:
@@ -1493,13 +2135,16 @@ class ServerProxy:
 
         transport: a transport factory
         encoding: the request encoding (default is UTF-8)
+        max_connections: connections the default transport may keep
+        open to the server (default is 4)
 
     All 8-bit strings passed to the server proxy are assumed to use
     the given encoding.
     """
 
     def __init__(self, uri, transport=None, encoding=None, verbose=0,
-                 allow_none=1, use_datetime=1, convert_datetimes_to_utc=1):
+                 allow_none=1, use_datetime=1, convert_datetimes_to_utc=1,
+                 max_connections=4):
         # establish a "logical" server connection
 
         # get the url
@@ -1513,9 +2158,11 @@ class ServerProxy:
 
         if transport is None:
             if type == "https":
-                transport = SafeTransport(use_datetime=use_datetime, convert_datetimes_to_utc=convert_datetimes_to_utc)
+                transport = SafeTransport(use_datetime=use_datetime, convert_datetimes_to_utc=convert_datetimes_to_utc,
+                                          max_connections=max_connections)
             else:
-                transport = Transport(use_datetime=use_datetime, convert_datetimes_to_utc=convert_datetimes_to_utc)
+                transport = Transport(use_datetime=use_datetime, convert_datetimes_to_utc=convert_datetimes_to_utc,
+                                      max_connections=max_connections)
         self.__transport = transport
 
         self.__encoding = encoding
@@ -1526,18 +2173,28 @@ class ServerProxy:
     def __close(self):
         self.__transport.close()
 
-    def __request(self, methodname, params):
+    def __request(self, methodname, params, new_target=None):
         # call a method on the remote server
 
         request = dumps(params, methodname, encoding=self.__encoding,
                         allow_none=self.__allow_none, convert_datetimes_to_utc=self.__convert_datetimes_to_utc)
 
-        response = self.__transport.request(
-            self.__host,
-            self.__handler,
-            request,
-            verbose=self.__verbose
-            )
+        if new_target is None:
+            response = self.__transport.request(
+                self.__host,
+                self.__handler,
+                request,
+                verbose=self.__verbose
+                )
+        else:
+            # the response is decoded by the caller's unmarshaller
+            response = self.__transport.request(
+                self.__host,
+                self.__handler,
+                request,
+                verbose=self.__verbose,
+                new_target=new_target
+                )
 
         if len(response) == 1:
             response = response[0]
@@ -1567,6 +2224,9 @@ class ServerProxy:
             return self.__close
         elif attr == "transport":
             return self.__transport
+        elif attr == "request":
+            # request(methodname, params, new_target=None)
+            return self.__request
         raise AttributeError("Attribute %r not found" % (attr,))
 
 # compatibility
@@ -9,17 +9,456 @@ docs and latest version available for download at
 
 __version__ = "3.0.1"
 
+import array
 import cookielib
+import copy
+import datetime
+import httplib
+import mmap
 import os
+import shutil
+import Queue
+import socket
+import threading
+import time
 import urllib2
 import sys
 from urlparse import urlparse
 
+from lib.cache_sg import SchemaCache, AttachmentCache, SessionCache, QueryCache
 from lib.form_post_handler import FormPostHandler
-from lib.xmlrpc_sg import ServerProxy, ProxiedTransport, Fault
+from lib.replica_sg import ReplicaStore, UnsupportedQuery
+from lib.xmlrpc_sg import ServerProxy, ProxiedTransport, ConnectionPool, HTTPConnection, HTTPSConnection, Fault, Marshalled, \
+    RowUnmarshaller, register_struct_type
 
 class ShotgunError(Exception): pass
 
+class _DownloadRefused(ShotgunError):
+    """
+    The server refused to serve a download because it didn't accept the
+    session token.
+    """
+    pass
+
+class BatchError(ShotgunError):
+    """
+    Raised by batch() when chunks of a chunked batch fail.
+    
+    failed_chunks is a list of (chunk index, index of the chunk's first 
+    request, exception) for every chunk that failed. results holds the 
+    results of the chunks that succeeded, in request order, with None for
+    each request of a chunk that failed or was never sent.
+    """
+    def __init__(self, failed_chunks, results, chunk_size):
+        self.failed_chunks = failed_chunks
+        self.results = results
+        messages = []
+        for index, start, error in failed_chunks:
+            messages.append("chunk %d (requests %d-%d): %s" % (index, start, 
+                min(start + chunk_size, len(results)) - 1, error))
+        ShotgunError.__init__(self, "batch() failed for %s" % "; ".join(messages))
+
+def _parallel_map(func, items, max_workers):
+    """
+    Calls func on every item using at most max_workers threads and returns
+    the results in the same order as items. The first exception raised by 
+    a worker is re-raised in the calling thread once all workers have stopped.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    queue = Queue.Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+    
+    def worker():
+        while not errors:
+            try:
+                i, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+    
+    threads = []
+    for n in range(max(1, min(max_workers, len(items)))):
+        t = threading.Thread(target=worker)
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+class _AsyncCall(object):
+    """
+    Runs func(*args) on a background thread. result() waits for the call to 
+    finish and returns its value, or re-raises its exception.
+    """
+    def __init__(self, func, *args):
+        self._func = func
+        self._args = args
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+    
+    def _run(self):
+        try:
+            self._result = self._func(*self._args)
+        except Exception:
+            self._error = sys.exc_info()
+    
+    def result(self):
+        self._thread.join()
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+class LazyThumbnailUrl(object):
+    """
+    Stands in for the thumbnail url of an entity and asks the server for 
+    the actual url the first time it is used as a string.
+    """
+    def __init__(self, sg, entity_type, entity_id):
+        self._sg = sg
+        self.entity_type = entity_type
+        self.entity_id = entity_id
+        self._url = None
+    
+    def _get_url(self):
+        if self._url is None:
+            self._url = self._sg._get_thumb_url(self.entity_type, self.entity_id)
+        return self._url
+    url = property(_get_url)
+    
+    def __str__(self):
+        return self.url
+    
+    def __repr__(self):
+        return "<LazyThumbnailUrl for %s:%s>" % (self.entity_type, self.entity_id)
+    
+    def __eq__(self, other):
+        if isinstance(other, LazyThumbnailUrl):
+            other = other.url
+        return self.url == other
+    
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    
+    def __hash__(self):
+        # equal to the url string, so it has to hash like it too
+        return hash(self.url)
+    
+    def __getattr__(self, attr):
+        # behave like the url string for everything else (startswith, etc.)
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        return getattr(self.url, attr)
+
+class Record(object):
+    """
+    Compact stand-in for an entity dict, returned by find() with 
+    compact=True. Reads like a dict (r["code"], get(), keys(), items(), 
+    "code" in r, ...) and the values of its fields can be changed, but no
+    fields can be added. Records of the same set of fields share a 
+    subclass holding the values in __slots__ and the field names.
+    """
+    __slots__ = ()
+    _fields = ()
+    _slot_list = ()
+    _slots = {}
+    
+    def __init__(self, values):
+        for slot, value in zip(self._slot_list, values):
+            slot.__set__(self, value)
+    
+    def __getitem__(self, key):
+        return self._slots[key].__get__(self)
+    
+    def __setitem__(self, key, value):
+        try:
+            slot = self._slots[key]
+        except KeyError:
+            raise KeyError("can't add field %s to a compact record" % key)
+        slot.__set__(self, value)
+    
+    def get(self, key, default=None):
+        slot = self._slots.get(key)
+        if slot is None:
+            return default
+        return slot.__get__(self)
+    
+    def __contains__(self, key):
+        return key in self._slots
+    has_key = __contains__
+    
+    def __len__(self):
+        return len(self._fields)
+    
+    def __iter__(self):
+        return iter(self._fields)
+    iterkeys = __iter__
+    
+    def keys(self):
+        return list(self._fields)
+    
+    def values(self):
+        return [slot.__get__(self) for slot in self._slot_list]
+    
+    def items(self):
+        return zip(self._fields, self.values())
+    
+    def itervalues(self):
+        return iter(self.values())
+    
+    def iteritems(self):
+        return iter(self.items())
+    
+    def to_dict(self):
+        """
+        Returns the record as a plain dict, with linked entities as dicts 
+        too.
+        """
+        return _plain(self)
+    
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+    
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+    
+    __hash__ = None
+    
+    def __repr__(self):
+        return repr(dict(self.items()))
+    
+    def __reduce__(self):
+        return (_make_record, (self._fields, tuple(self.values())))
+
+# records can be sent back to the server, eg. as links in filters or data
+register_struct_type(Record)
+
+_record_classes = {}
+
+def record_class(fields):
+    """
+    Returns the Record subclass for a tuple of field names, the same one 
+    for the same fields in the same order.
+    """
+    try:
+        return _record_classes[fields]
+    except KeyError:
+        pass
+    slot_names = tuple(["_%d" % i for i in range(len(fields))])
+    cls = type("Record", (Record,), {"__slots__": slot_names})
+    cls._fields = tuple([type(f) is str and intern(f) or f for f in fields])
+    cls._slot_list = tuple([getattr(cls, name) for name in slot_names])
+    cls._slots = dict(zip(cls._fields, cls._slot_list))
+    _record_classes[fields] = cls
+    return cls
+
+def _make_record(fields, values):
+    return record_class(fields)(values)
+
+def _plain(value):
+    # value with Records turned back into dicts
+    if isinstance(value, Record):
+        return dict([(k, _plain(v)) for k, v in value.items()])
+    elif type(value) is list:
+        return [_plain(v) for v in value]
+    return value
+
+class _RecordBuilder(object):
+    """
+    Turns the dicts of find() results into Records. Equal linked entities
+    (and other nested dicts) found by the same builder become a single 
+    shared Record, so don't change them in place.
+    """
+    def __init__(self):
+        self._shared = {}
+    
+    def records(self, dicts):
+        return [self._record(d) for d in dicts]
+    
+    def _record(self, d):
+        items = d.items()
+        fields = tuple([k for k, v in items])
+        return record_class(fields)([self._value(v) for k, v in items])
+    
+    def _value(self, value):
+        t = type(value)
+        if t is dict:
+            try:
+                key = tuple(value.items())
+                record = self._shared.get(key)
+            except TypeError:
+                return self._record(value) # unhashable values, can't be shared
+            if record is None:
+                record = self._shared[key] = self._record(value)
+            return record
+        elif t is list:
+            return [self._value(v) for v in value]
+        return value
+
+def _freeze(value):
+    # hashable copy of a find() request, the same for equal requests
+    if isinstance(value, (dict, Record)):
+        return tuple(sorted([(k, _freeze(v)) for k, v in value.items()]))
+    elif isinstance(value, (list, tuple)):
+        return tuple([_freeze(v) for v in value])
+    return value
+
+def _query_types(req):
+    """
+    Returns the entity types the results of a find() request depend on:
+    its own type and the types linked to by dotted paths (eg. Shot for
+    "entity.Shot.code") in its fields, filters and sorts.
+    """
+    paths = list(req["return_fields"])
+    paths.extend([s["field_name"] for s in req.get("sorts", [])])
+    filters = [req["filters"]]
+    while filters:
+        f = filters.pop()
+        if isinstance(f, dict):
+            filters.extend(f.get("conditions", []))
+            if "path" in f:
+                paths.append(f["path"])
+    types = [req["type"]]
+    for path in paths:
+        for t in path.split(".")[1::2]:
+            if t not in types:
+                types.append(t)
+    return tuple(types)
+
+def _copy_records(value, memo=None):
+    # copy of find() results, so cached ones can't be changed by callers.
+    # Records shared between results stay shared in the copy
+    if memo is None:
+        memo = {}
+    if type(value) is dict:
+        return dict([(k, _copy_records(v, memo)) for k, v in value.iteritems()])
+    elif type(value) is list:
+        return [_copy_records(v, memo) for v in value]
+    elif isinstance(value, Record):
+        record = memo.get(id(value))
+        if record is None:
+            record = memo[id(value)] = type(value)([_copy_records(v, memo) for v in value.values()])
+        return record
+    return value
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+class _Columns(object):
+    """
+    Collects the rows of find_columns() results field by field, then turns
+    each field into the most compact column its values allow.
+    """
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.count = 0
+        self._values = {}
+        self._keys = None
+        self._page = (0, ())
+    
+    def start_page(self):
+        self._page = (self.count, tuple(self._values))
+    
+    def restart_page(self):
+        # drops the rows added since start_page(), for a retried request
+        count, fields = self._page
+        for field in self._values.keys():
+            if field in fields:
+                del self._values[field][count:]
+            else:
+                del self._values[field]
+        self.count = count
+        self._keys = None
+    
+    def add_row(self, keys, values):
+        if self.limit and self.count >= self.limit:
+            return
+        columns = self._values
+        if keys == self._keys:
+            for k, v in zip(keys, values):
+                columns[k].append(v)
+        else:
+            self._add_odd_row(keys, values)
+        self.count += 1
+    
+    def _add_odd_row(self, keys, values):
+        # first row, or a row with other fields than the one before
+        columns = self._values
+        for k, v in zip(keys, values):
+            if k not in columns:
+                columns[k] = [None] * self.count
+            columns[k].append(v)
+        for column in columns.itervalues():
+            if len(column) == self.count:
+                column.append(None)
+        if len(keys) == len(columns):
+            self._keys = keys
+        else:
+            self._keys = None
+    
+    def columns(self):
+        result = {}
+        for field, values in self._values.items():
+            del self._values[field] # let the values go as soon as possible
+            result.update(_column(field, values))
+        return result
+
+def _column(field, values):
+    """
+    Returns {field: column} for a list of values. Ints go into an 
+    array("l") and other numbers and datetimes (as unix times) into an 
+    array("d"), with NaN for None. Entity links become two columns, 
+    "<field>.type" (a list) and "<field>.id" (an array("l"), 0 for None).
+    Anything else stays a list.
+    """
+    kinds = set(map(type, values))
+    has_none = type(None) in kinds
+    kinds.discard(type(None))
+    nan = float("nan")
+    try:
+        if not kinds:
+            pass
+        elif kinds <= set([int, long]) and not has_none:
+            return {field: array.array("l", values)}
+        elif kinds <= set([int, long, float]):
+            return {field: array.array("d", [v is None and nan or v for v in values])}
+        elif kinds == set([bool]) and not has_none:
+            return {field: array.array("b", values)}
+        elif kinds == set([datetime.datetime]):
+            return {field: array.array("d", [v is None and nan or _timestamp(v) for v in values])}
+        elif kinds == set([dict]):
+            links = [v for v in values if v is not None]
+            if not [v for v in links if "type" not in v or "id" not in v]:
+                return {field + ".type": [v and v["type"] for v in values],
+                        field + ".id": array.array("l", [v and v["id"] or 0 for v in values])}
+    except OverflowError:
+        pass # ints too big for an array("l")
+    return {field: values}
+
+def _timestamp(value):
+    # unix time of a datetime, naive ones are taken to be utc
+    offset = value.utcoffset()
+    if offset is not None:
+        value = value.replace(tzinfo=None) - offset
+    delta = value - _EPOCH
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+
 class Shotgun(object):
     # Used to split up requests into batches of records_per_page when doing 
     # requests.  this helps speed tremendously when getting lots of results
@@ -27,10 +466,59 @@ class Shotgun(object):
     # full set of results back as one array) but just how the client class 
     # communicates with the server.
     records_per_page = 500
+    
+    # Maximum number of requests a single Shotgun instance will have in flight
+    # at once when running in parallel mode (eg. find(..., parallel=True)). 
+    # each concurrent request uses its own keep-alive connection to the server.
+    # the connection pools are sized from it when the instance is created, 
+    # so set it for an instance with the max_parallel_requests argument.
+    max_parallel_requests = 4
+    
+    # When set, find() returns the 'image' field as a LazyThumbnailUrl which 
+    # only asks the server for the thumbnail url the first time it is read.
+    lazy_thumbnail_urls = False
+    
+    # Number of bytes download_attachment() reads and writes at a time when
+    # saving to a file.
+    download_chunk_size = 1024 * 1024
+    
+    # Session tokens younger than this many seconds are trusted: when a 
+    # download is refused with a younger token, the file is the problem, 
+    # so no new token is fetched.
+    session_token_min_age = 60
 
-    def __init__(self, base_url, script_name, api_key, convert_datetimes_to_utc=True, http_proxy=None):
+    def __init__(self, base_url, script_name, api_key, convert_datetimes_to_utc=True, http_proxy=None,
+                 compress_request_threshold=None, schema_cache_ttl=None, schema_cache_dir=None,
+                 attachment_cache_dir=None, attachment_cache_size=1024*1024*1024,
+                 session_cache_dir=None, session_token_ttl=3600,
+                 query_cache_ttl=None, query_cache_size=64*1024*1024, max_parallel_requests=None):
         """
         Initialize Shotgun.
+        
+        Responses are always requested gzip compressed. If 
+        compress_request_threshold is set, request bodies larger than that
+        many bytes (eg. big batch() calls) are gzipped too, which requires
+        a server that accepts compressed requests.
+        
+        If schema_cache_ttl is set, the results of the schema_*_read() 
+        methods are cached for that many seconds. Give schema_cache_dir to
+        also keep the cache on disk, shared between processes.
+        
+        If attachment_cache_dir is set, downloaded Attachments are kept in
+        that directory, up to attachment_cache_size bytes, and reused instead
+        of being downloaded again.
+        
+        If session_cache_dir is set, the session token used for downloads 
+        is saved there and reused by every process using the same site and 
+        script for session_token_ttl seconds.
+        
+        If query_cache_ttl is set, find() results are cached for that many
+        seconds, keeping up to about query_cache_size bytes of them. Writes
+        made through this instance drop the cached results of the entity 
+        types they change.
+        
+        max_parallel_requests overrides the class default number of 
+        requests this instance runs at once, and of connections it keeps.
         """
         self.server = None
         if base_url.split("/")[0] not in ("http:","https:"):
@@ -48,43 +536,122 @@ class Shotgun(object):
         self.api_url = "%s/%s/" % (self.base_url, self.api_ver)
         self.convert_datetimes_to_utc = convert_datetimes_to_utc
         self.sid = None # only load this if needed
+        self._sid_created = None
         self.http_proxy = http_proxy
+        if max_parallel_requests is not None:
+            self.max_parallel_requests = max_parallel_requests
         
-        server_options = {
+        self._server_options = {
             'server_url': self.api_url,
             'script_name': self.script_name,
             'script_key': self.api_key,
             'http_proxy' : self.http_proxy,
-            'convert_datetimes_to_utc': self.convert_datetimes_to_utc
+            'convert_datetimes_to_utc': self.convert_datetimes_to_utc,
+            'max_connections': self.max_parallel_requests,
+            'compress_request_threshold': compress_request_threshold
         }
         
-        self._api3 = ShotgunCRUD(server_options)
+        self._api3 = ShotgunCRUD(self._server_options)
+        
+        # openers for file transfers. the download one needs a session token,
+        # so it is only created when first used
+        self._upload_opener = urllib2.build_opener(FormPostHandler)
+        self._download_opener = None
+        self._opener_lock = threading.Lock()
         
+        self.schema_cache = None
+        if schema_cache_ttl:
+            self.schema_cache = SchemaCache(self.base_url, schema_cache_ttl, schema_cache_dir)
+        
+        self.attachment_cache = None
+        if attachment_cache_dir:
+            self.attachment_cache = AttachmentCache(self.base_url, attachment_cache_dir, attachment_cache_size)
+        
+        self.query_cache = None
+        if query_cache_ttl:
+            self.query_cache = QueryCache(query_cache_ttl, query_cache_size)
+        
+        self.session_cache = None
+        if session_cache_dir:
+            self.session_cache = SessionCache(self.base_url, self.script_name, session_cache_dir, session_token_ttl)
+        
+        # keep-alive connections for thumbnail url lookups
+        self._thumb_pool = ConnectionPool(self.max_parallel_requests)
+        
+    def _new_thumb_connection(self, host):
+        if self.http_proxy:
+            return HTTPConnection(self.http_proxy)
+        elif urlparse(self.base_url)[0] == "https":
+            return HTTPSConnection(host)
+        return HTTPConnection(host)
+    
     def _get_thumb_url(self, entity_type, entity_id):
         """
         Returns the URL for the thumbnail of an entity given the 
         entity type and the entity id 
         """
         url = self.base_url + "/upload/get_thumbnail_url?entity_type=%s&entity_id=%d"%(entity_type,entity_id)
+        if self.http_proxy:
+            selector = url
+        else:
+            selector = url[len(self.base_url):]
+        host = urlparse(self.base_url)[1]
         for i in range(3):
-            f = urllib2.urlopen(url)
-            response_code = f.readline().strip()
+            connection = self._thumb_pool.checkout(host, self._new_thumb_connection)
+            try:
+                connection.request("GET", selector)
+                body = connection.getresponse().read()
+            except (socket.error, httplib.HTTPException):
+                # cached connection has gone cold. drop it and reconnect
+                self._thumb_pool.discard(host, connection)
+                if i == 2:
+                    raise
+                continue
+            self._thumb_pool.checkin(host, connection)
+            response_code, f = (body.split("\n", 1) + [""])[:2]
+            response_code = response_code.strip()
             # something else happened. try again. found occasional connection errors still spit out html but not
             # the correct response codes. usually trying again will right the ship. if not, we catch for it later.
             if response_code not in ('0','1'): 
                 continue    
             elif response_code == '1': 
-                path = f.readline().strip()
+                path = f.split("\n", 1)[0].strip()
                 if path:
                     return self.base_url + path
             elif response_code == '0':
                 break                        
         # if it's an error, message is printed on second line
-        raise ValueError("%s:%s " % (entity_type,entity_id)+f.read().strip())
+        raise ValueError("%s:%s " % (entity_type,entity_id)+f.strip())
+    
+    def _schema_call(self, key, method, *args):
+        """
+        Makes a schema read call, going through the schema cache if enabled
+        """
+        if self.schema_cache is None:
+            return method(*args)["results"]
+        results = self.schema_cache.get(key)
+        if results is None:
+            results = method(*args)["results"]
+            self.schema_cache.set(key, results)
+        # callers are free to modify what they get back
+        return copy.deepcopy(results)
+    
+    def _schema_changed(self):
+        if self.schema_cache is not None:
+            self.schema_cache.clear()
+        if self.query_cache is not None:
+            self.query_cache.clear()
+    
+    def _data_changed(self, entity_types):
+        """
+        Drops the cached find() results that depend on entity_types.
+        """
+        if self.query_cache is not None:
+            for entity_type in set(entity_types):
+                self.query_cache.invalidate(entity_type)
     
     def schema_read(self):
-        resp = self._api3.schema_read()
-        return resp["results"]
+        return self._schema_call(("schema_read",), self._api3.schema_read)
     
     def schema_field_read(self, entity_type, field_name=None):
         args = {
@@ -92,8 +659,7 @@ class Shotgun(object):
         }
         if field_name:
             args["field_name"] = field_name
-        resp = self._api3.schema_field_read(args)
-        return resp["results"]
+        return self._schema_call(("schema_field_read", entity_type, field_name), self._api3.schema_field_read, args)
     
     def schema_field_create(self, entity_type, data_type, display_name, properties=None):
         if properties == None: 
@@ -107,6 +673,7 @@ class Shotgun(object):
         for f,v in properties.items():
             args["properties"].append( {"property_name":f,"value":v} )
         resp = self._api3.schema_field_create(args)
+        self._schema_changed()
         return resp["results"]
     
     def schema_field_update(self, entity_type, field_name, properties):
@@ -118,6 +685,7 @@ class Shotgun(object):
         for f,v in properties.items():
             args["properties"].append( {"property_name":f,"value":v} )
         resp = self._api3.schema_field_update(args)
+        self._schema_changed()
         return resp["results"]
     
     def schema_field_delete(self, entity_type, field_name):
@@ -126,29 +694,16 @@ class Shotgun(object):
             "field_name":field_name
         }
         resp = self._api3.schema_field_delete(args)
+        self._schema_changed()
         return resp["results"]
     
     def schema_entity_read(self):
-        resp = self._api3.schema_entity_read()
-        return resp["results"]
+        return self._schema_call(("schema_entity_read",), self._api3.schema_entity_read)
 
-    def find(self, entity_type, filters, fields=None, order=None, filter_operator=None, limit=0, retired_only=False):
+    def _translate_find_request(self, entity_type, filters, fields, order, filter_operator, limit, retired_only):
         """
-        Find entities of entity_type matching the given filters.
-        
-        The columns returned for each entity match the 'fields' 
-        parameter provided, or just the id if nothing is specified.
-        
-        Limit constrains the total results to its value.
-        
-        Returns an array of dict entities sorted by the optional
-        'order' parameter. 
+        Builds the read request sent to the server for find() and find_iter()
         """
-        if fields == None: 
-            fields = ['id']
-        if order == None: 
-            order = []
-        
         # we want to check if filters is iterable, not only if it's a list.
         if hasattr(filters, '__iter__'):
             new_filters = {}
@@ -192,29 +747,242 @@ class Shotgun(object):
         if (limit and limit > 0 and limit < self.records_per_page):
             req["paging"]["entities_per_page"] = limit
         
-        records = []
-        done = False
-        while not done:
-            resp = self._api3.read(req)
-            results = resp["results"]["entities"]
-            if results:
-                records.extend(results)
-                if ( len(records) >= limit and limit > 0 ):
-                    records = records[:limit]
-                    done = True
-                elif len(records) == resp["results"]["paging_info"]["entity_count"]:
-                    done = True
+        return req
+    
+    def _add_thumb_urls(self, entity_type, records):
+        """
+        'image' only returns id by default. add links to the thumbnail images.
+        
+        The urls for a whole page of records are looked up concurrently over
+        max_parallel_requests keep-alive connections, or left as 
+        LazyThumbnailUrl values if lazy_thumbnail_urls is set.
+        """
+        records = [r for r in records if r['image']]
+        if self.lazy_thumbnail_urls:
+            for r in records:
+                r['image'] = LazyThumbnailUrl(self, entity_type, r['id'])
+        elif records:
+            urls = _parallel_map(lambda r: self._get_thumb_url(entity_type, r['id']), 
+                records, self.max_parallel_requests)
+            for r, url in zip(records, urls):
+                r['image'] = url
+    
+    def find(self, entity_type, filters, fields=None, order=None, filter_operator=None, limit=0, retired_only=False, parallel=False,
+             compact=False):
+        """
+        Find entities of entity_type matching the given filters.
+        
+        The columns returned for each entity match the 'fields' 
+        parameter provided, or just the id if nothing is specified.
+        
+        Limit constrains the total results to its value.
+        
+        If parallel is True, the first page is used to work out how many 
+        pages there are and the remaining pages are requested concurrently, 
+        using at most max_parallel_requests connections.
+        
+        If compact is True, the entities are returned as Records instead
+        of dicts. They read like dicts but take several times less memory, 
+        and every link to the same entity is the same shared Record.
+        
+        Returns an array of dict entities sorted by the optional
+        'order' parameter. 
+        """
+        if fields == None: 
+            fields = ['id']
+        if order == None: 
+            order = []
+        
+        req = self._translate_find_request(entity_type, filters, fields, order, filter_operator, limit, retired_only)
+        
+        cache = self.query_cache
+        if cache is not None:
+            key = (_freeze(req), limit, compact)
+            records = cache.get(key)
+            if records is not None:
+                return _copy_records(records)
+            types = _query_types(req)
+            generations = cache.generations(types)
+        
+        # pages are compacted as they arrive, so only one page of dicts
+        # is in memory at a time
+        convert = None
+        if compact:
+            convert = _RecordBuilder().records
+        
+        if parallel:
+            records = self._find_parallel(req, limit, convert)
+        else:
+            records = []
+            done = False
+            while not done:
+                resp = self._api3.read(req)
+                results = resp["results"]["entities"]
+                if results:
+                    if convert:
+                        results = convert(results)
+                    records.extend(results)
+                    if ( len(records) >= limit and limit > 0 ):
+                        records = records[:limit]
+                        done = True
+                    elif len(records) == resp["results"]["paging_info"]["entity_count"]:
+                        done = True
+                    else:
+                        req['paging']['current_page'] += 1
                 else:
-                    req['paging']['current_page'] += 1
-            else:
-                done = True
+                    done = True
         
-        # 'image' only returns id by default. add links to the thumbnail images
         if 'image' in set(fields):
-            for i,v in enumerate(records):
-                if records[i]['image']:
-                    records[i]['image'] = self._get_thumb_url(entity_type,records[i]['id'])
+            self._add_thumb_urls(entity_type, records)
         
+        if cache is not None:
+            cache.put(key, _copy_records(records), types, generations)
+        return records
+    
+    def find_iter(self, entity_type, filters, fields=None, order=None, filter_operator=None, limit=0, retired_only=False,
+                  compact=False):
+        """
+        Same as find, but returns a generator that yields the dict entities 
+        (or Records, with compact=True) one at a time as the pages arrive 
+        from the server, instead of building the full list in memory.
+        
+        While the entities of one page are being consumed, the next page 
+        is already being read on a separate connection.
+        """
+        if fields == None: 
+            fields = ['id']
+        if order == None: 
+            order = []
+        
+        req = self._translate_find_request(entity_type, filters, fields, order, filter_operator, limit, retired_only)
+        
+        builder = compact and _RecordBuilder()
+        for records in self._iter_pages(req, limit):
+            if builder:
+                records = builder.records(records)
+            if 'image' in set(fields):
+                self._add_thumb_urls(entity_type, records)
+            for record in records:
+                yield record
+    
+    def find_columns(self, entity_type, filters, fields=None, order=None, filter_operator=None, limit=0, retired_only=False,
+                     numpy=False):
+        """
+        Same as find, but returns the entities as columns: a dict of field
+        name to the values of that field for every entity, in order. The 
+        'image' column holds thumbnail urls, as with find().
+        
+        The columns are filled while the response is decoded, without a 
+        dict per entity. Number fields become array("l") (ints) or 
+        array("d") (other numbers, NaN for None) columns, datetime fields
+        array("d") columns of unix times. An entity link field "entity" 
+        becomes two columns: "entity.type", a list, and "entity.id", an 
+        array("l") with 0 for no entity. Other fields are lists.
+        
+        With numpy=True, the arrays are returned as numpy arrays sharing 
+        their memory.
+        """
+        if fields == None: 
+            fields = ['id']
+        if order == None: 
+            order = []
+        
+        req = self._translate_find_request(entity_type, filters, fields, order, filter_operator, limit, retired_only)
+        
+        columns = _Columns(limit)
+        def new_target():
+            # a retried request starts the page over
+            columns.restart_page()
+            return RowUnmarshaller(columns.add_row, 3, convert_datetimes_to_utc=self.convert_datetimes_to_utc)
+        while True:
+            count = columns.count
+            columns.start_page()
+            resp = self._api3.call_into(new_target, "read", req)
+            total = resp["results"]["paging_info"]["entity_count"]
+            if limit and limit > 0:
+                total = min(total, limit)
+            if columns.count == count or columns.count >= total:
+                break
+            req['paging']['current_page'] += 1
+        
+        result = columns.columns()
+        if 'image' in set(fields) and 'image' in result:
+            records = [{'id': i, 'image': image} for i, image in zip(result['id'], result['image'])]
+            self._add_thumb_urls(entity_type, records)
+            result['image'] = [r['image'] for r in records]
+        if numpy:
+            import numpy as np
+            for field, column in result.items():
+                if isinstance(column, array.array):
+                    result[field] = np.frombuffer(column, dtype=column.typecode)
+        return result
+    
+    def _read_page(self, req, page):
+        """
+        Reads a single page of a find() request. Safe to call from several
+        threads at once, each call uses its own pooled connection.
+        """
+        page_req = dict(req)
+        page_req["paging"] = dict(req["paging"])
+        page_req["paging"]["current_page"] = page
+        resp = self._api3.read(page_req)
+        return resp["results"]
+    
+    def _iter_pages(self, req, limit):
+        """
+        Yields the pages of a find() request in order, reading each page 
+        ahead while the caller works on the previous one.
+        """
+        count = 0
+        page = 1
+        pending = _AsyncCall(self._read_page, req, page)
+        while pending:
+            results = pending.result()
+            records = results["entities"]
+            if not records:
+                break
+            
+            total = results["paging_info"]["entity_count"]
+            if limit and limit > 0:
+                total = min(total, limit)
+            count += len(records)
+            if count < total:
+                page += 1
+                pending = _AsyncCall(self._read_page, req, page)
+            else:
+                pending = None
+                if count > total:
+                    records = records[:len(records) - (count - total)]
+            yield records
+    
+    def _find_parallel(self, req, limit, convert=None):
+        """
+        Reads the first page of a find() request, then fans the remaining 
+        pages out over max_parallel_requests connections and reassembles 
+        them in order. If given, convert is called on each page.
+        """
+        if convert is None:
+            convert = lambda records: records
+        resp = self._api3.read(req)
+        records = resp["results"]["entities"]
+        if not records:
+            return records
+        records = convert(records)
+        
+        total = resp["results"]["paging_info"]["entity_count"]
+        if limit and limit > 0:
+            total = min(total, limit)
+        per_page = req["paging"]["entities_per_page"]
+        page_count = (total + per_page - 1) // per_page
+        
+        if page_count > 1:
+            pages = _parallel_map(lambda page: convert(self._read_page(req, page)["entities"]), 
+                range(2, page_count + 1), self.max_parallel_requests)
+            for results in pages:
+                records.extend(results)
+        
+        if limit and limit > 0:
+            records = records[:limit]
         return records
     
     def find_one(self, entity_type, filters, fields=None, order=None, filter_operator=None, retired_only=False):
@@ -227,66 +995,158 @@ class Shotgun(object):
         else:
             return None
     
+    def incremental_sync(self, store=None, marks=None):
+        """
+        Returns an IncrementalSync, which keeps the entities matching 
+        find() queries merged into store (a dict by default), reading only 
+        the entities updated or retired since the last sync of each query:
+        
+            syncer = sg.incremental_sync(store)
+            syncer.sync("Shot", [["project", "is", project]], ["code", "sg_status_list"])
+            ...
+            updated, retired = syncer.sync("Shot", [["project", "is", project]], ["code", "sg_status_list"])
+        
+        Pass in the marks of a previous IncrementalSync (eg. pickled 
+        along with the store) to carry on from where it stopped.
+        """
+        return IncrementalSync(self, store, marks)
+    
     def _required_keys(self, message, required_keys, data):
         missing = set(required_keys) - set(data.keys())
         if missing:
             raise ShotgunError("%s missing required key: %s. Value was: %s." % (message, ", ".join(missing), data))
     
-    def batch(self, requests):
+    def _translate_batch_request(self, r):
+        """
+        Translates a single batch() request into the form the server expects
+        """
+        self._required_keys("Batched request",['request_type','entity_type'],r)
+        
+        if r["request_type"] == "create":
+            self._required_keys("Batched create request",['data'],r)
+                
+            nr = {
+                "request_type": "create",
+                "type": r["entity_type"],
+                "fields": []
+            }
+            
+            if "return_fields" in r:
+                nr["return_fields"] = r["return_fields"]
+            
+            for f,v in r["data"].items():
+                nr["fields"].append( { "field_name": f, "value": v } )
+            
+            return nr
+        elif r["request_type"] == "update":
+            self._required_keys("Batched create request",['entity_id','data'],r)
+                
+            nr = {
+                "request_type": "update",
+                "type": r["entity_type"],
+                "id": r["entity_id"],
+                "fields": []
+            }
+            
+            for f,v in r["data"].items():
+                nr["fields"].append( { "field_name": f, "value": v } )
+            
+            return nr
+        elif r["request_type"] == "delete":
+            self._required_keys("Batched delete request",['entity_id'],r)
+                
+            nr = {
+                "request_type": "delete",
+                "type": r["entity_type"],
+                "id": r["entity_id"]
+            }
+            
+            return nr
+        else:
+            raise ShotgunError("Invalid request_type for batch")
+    
+    def _send_batch(self, reqs):
+        """
+        Sends already translated batch requests in a single call
+        """
+        try:
+            resp = self._api3.batch(reqs)
+        finally:
+            self._data_changed([r["type"] for r in reqs])
+        return resp["results"]
+    
+    def _batch_chunk(self, reqs):
+        """
+        Sends one chunk of a chunked batch() and returns (results, None), or
+        (None, exc_info) if it failed.
+        """
+        try:
+            return self._send_batch(reqs), None
+        except Exception:
+            return None, sys.exc_info()
+    
+    def batch(self, requests, chunk_size=None, parallel=False):
+        """
+        Make several create, update and delete requests in a single call.
+        
+        If chunk_size is given, the requests are sent chunk_size at a time,
+        one call per chunk. Each chunk succeeds or fails as a whole on the
+        server. With parallel set, the chunks are sent concurrently over at
+        most max_parallel_requests connections, so only use it for chunks
+        that don't depend on each other.
+        
+        Returns the results in the same order as the requests. If any chunk
+        fails a BatchError is raised which says which chunks failed and 
+        holds the results of the chunks that did not.
+        """
         if type(requests) != type([]):
             raise ShotgunError("batch() expects a list.  Instead was sent a %s"%type(requests))
         
         reqs = []
         
         for r in requests:
-            self._required_keys("Batched request",['request_type','entity_type'],r)
-            
-            if r["request_type"] == "create":
-                self._required_keys("Batched create request",['data'],r)
-                    
-                nr = {
-                    "request_type": "create",
-                    "type": r["entity_type"],
-                    "fields": []
-                }
-                
-                if "return_fields" in r:
-                    nr["return_fields"] = r
-                
-                for f,v in r["data"].items():
-                    nr["fields"].append( { "field_name": f, "value": v } )
-                
-                reqs.append(nr)
-            elif r["request_type"] == "update":
-                self._required_keys("Batched create request",['entity_id','data'],r)
-                    
-                nr = {
-                    "request_type": "update",
-                    "type": r["entity_type"],
-                    "id": r["entity_id"],
-                    "fields": []
-                }
-                
-                for f,v in r["data"].items():
-                    nr["fields"].append( { "field_name": f, "value": v } )
-                
-                reqs.append(nr)
-            elif r["request_type"] == "delete":
-                self._required_keys("Batched delete request",['entity_id'],r)
-                    
-                nr = {
-                    "request_type": "delete",
-                    "type": r["entity_type"],
-                    "id": r["entity_id"]
-                }
-                
-                reqs.append(nr)
-            else:
-                raise ShotgunError("Invalid request_type for batch")
+            reqs.append(self._translate_batch_request(r))
         
-        resp = self._api3.batch(reqs)
-        return resp["results"]
+        if not chunk_size or len(reqs) <= chunk_size:
+            return self._send_batch(reqs)
+        
+        chunks = [reqs[i:i + chunk_size] for i in range(0, len(reqs), chunk_size)]
+        if parallel:
+            responses = _parallel_map(self._batch_chunk, chunks, self.max_parallel_requests)
+        else:
+            # later chunks may depend on earlier ones, stop at the first failure
+            responses = []
+            for chunk in chunks:
+                responses.append(self._batch_chunk(chunk))
+                if responses[-1][1]:
+                    break
+            responses.extend([(None, None)] * (len(chunks) - len(responses)))
+        
+        results = []
+        failed_chunks = []
+        for i, (chunk_results, error) in enumerate(responses):
+            if chunk_results is None:
+                chunk_results = [None] * len(chunks[i])
+                if error:
+                    failed_chunks.append((i, i * chunk_size, error[1]))
+            results.extend(chunk_results)
+        if failed_chunks:
+            raise BatchError(failed_chunks, results, chunk_size)
+        return results
+        
+    def buffered_writes(self, max_ops=500, max_delay=0.5):
+        """
+        Returns a BufferedWriter, which collects create, update and delete 
+        calls and sends them with batch() max_ops at a time, or max_delay 
+        seconds after the first one was buffered. Use it as a context 
+        manager so anything still buffered is sent at the end:
         
+            with sg.buffered_writes() as w:
+                for i in range(1000):
+                    w.create("Asset", {"code": "Asset %d" % i})
+        """
+        return BufferedWriter(self, max_ops, max_delay)
+    
     def create(self, entity_type, data, return_fields=None):
         """
         Create a new entity of entity_type type.
@@ -305,7 +1165,10 @@ class Shotgun(object):
         for f,v in data.items():
             args["fields"].append( {"field_name":f,"value":v} )
         
-        resp = self._api3.create(args)
+        try:
+            resp = self._api3.create(args)
+        finally:
+            self._data_changed([entity_type])
         return resp["results"]
         
     def update(self, entity_type, entity_id, data):
@@ -319,14 +1182,20 @@ class Shotgun(object):
         for f,v in data.items():
             args["fields"].append( {"field_name":f,"value":v} )
             
-        resp = self._api3.update(args)
+        try:
+            resp = self._api3.update(args)
+        finally:
+            self._data_changed([entity_type])
         return resp["results"]
 
     def delete(self, entity_type, entity_id):
         """
         Retire an entity given the entity_type, and entity_id
         """
-        resp = self._api3.delete( {"type":entity_type, "id":entity_id} )
+        try:
+            resp = self._api3.delete( {"type":entity_type, "id":entity_id} )
+        finally:
+            self._data_changed([entity_type])
         return resp["results"]
 
     def upload(self, entity_type, entity_id, path, field_name=None, display_name=None, tag_list=None):
@@ -368,12 +1237,12 @@ class Shotgun(object):
             params["tag_list"] = tag_list
             params["file"] = open(path, "rb")
 
-        # Create opener with extended form post support
-        opener = urllib2.build_opener(FormPostHandler)
-        
-        # Perform the request
+        # Perform the request, using the opener with extended form post support
         try:
-            result = opener.open(url, params).read()
+            try:
+                result = self._upload_opener.open(url, params).read()
+            finally:
+                self._data_changed([entity_type, "Attachment"])
         except urllib2.HTTPError, e:
             if e.code == 500:
                 raise ShotgunError("Server encountered an internal error. \n%s\n(%s)\n%s\n\n" % (url, params, e))
@@ -398,50 +1267,276 @@ class Shotgun(object):
         result = self.upload(entity_type, entity_id, path, field_name="thumb_image", **kwargs)
         return result
         
-    def download_attachment(self, entity_id):
+    def _get_download_opener(self):
         """
-        Gets session authentication and returns binary content of Attachment data
+        Returns the opener used for all downloads, which sends the session
+        cookie. It is shared by every download, including concurrent ones.
+        """
+        self._opener_lock.acquire()
+        try:
+            if self._download_opener is None:
+                sid = self._get_session_token()
+                domain = urlparse(self.base_url)[1].split(':',1)[0]
+                cj = cookielib.LWPCookieJar()
+                c = cookielib.Cookie('0', '_session_id', sid, None, False, domain, False, False, "/", True, False, None, True, None, None, {})
+                cj.set_cookie(c)
+                cookie_handler = urllib2.HTTPCookieProcessor(cj)
+                self._download_opener = urllib2.build_opener(cookie_handler)
+            return self._download_opener
+        finally:
+            self._opener_lock.release()
+    
+    def _open_attachment(self, entity_id, offset=0):
+        """
+        Opens the download of an Attachment, starting offset bytes in.
+        Returns the url and the response.
         """
-        sid = self._get_session_token()
-        domain = urlparse(self.base_url)[1].split(':',1)[0]
-        cj = cookielib.LWPCookieJar()
-        c = cookielib.Cookie('0', '_session_id', sid, None, False, domain, False, False, "/", True, False, None, True, None, None, {})
-        cj.set_cookie(c)
-        cookie_handler = urllib2.HTTPCookieProcessor(cj)
-        urllib2.install_opener(urllib2.build_opener(cookie_handler))
+        opener = self._get_download_opener()
         url = '%s/file_serve/attachment/%s' % (self.base_url, entity_id)
 
+        request = urllib2.Request(url)
+        request.add_header('User-agent','Mozilla/5.0 (Macintosh; U; Intel Mac OS X 10.5; en-US; rv:1.9.0.7) Gecko/2009021906 Firefox/3.0.7')
+        if offset:
+            request.add_header('Range', 'bytes=%d-' % offset)
         try:
-            request = urllib2.Request(url)
-            request.add_header('User-agent','Mozilla/5.0 (Macintosh; U; Intel Mac OS X 10.5; en-US; rv:1.9.0.7) Gecko/2009021906 Firefox/3.0.7')
-            attachment = urllib2.urlopen(request).read() 
-
+            return url, opener.open(request)
         except IOError, e:
+            if offset and getattr(e, 'code', None) == 416:
+                # nothing left to download if the partial file is as big as 
+                # the remote one, otherwise it isn't a part of it
+                size = e.info().getheader('Content-Range', '').split('/')[-1]
+                if size == str(offset):
+                    return url, None
+                return self._open_attachment(entity_id)
             err = "Failed to open %s" % url
             if hasattr(e, 'code'):
                 err += "\nWe failed with error code - %s." % e.code
+                if e.code in (401, 403):
+                    raise _DownloadRefused(err)
             elif hasattr(e, 'reason'):
-                err += "\nThe error object has the following 'reason' attribute :", e.reason
+                err += "\nThe error object has the following 'reason' attribute : %s" % (e.reason,)
                 err += "\nThis usually means the server doesn't exist, is down, or we don't have an internet connection."
             raise ShotgunError(err)
-        else:
-            if attachment.lstrip().startswith('<!DOCTYPE '):
-                error_string = "\n%s\nThe server generated an error trying to download the Attachment. \nURL: %s\n" \
-                    "Either the file doesn't exist, or it is a local file which isn't downloadable.\n%s\n" % ("="*30, url, "="*30)
-                raise ShotgunError(error_string)
+    
+    def _check_attachment(self, url, response, data):
+        """
+        The server answers with an html error page instead of the file when 
+        it can't serve it. Only the start of the download is needed to tell.
+        
+        The login page, which it is redirected to when the session token 
+        is rejected, is told apart from other error pages: only then is a 
+        new token worth getting.
+        """
+        if data.lstrip().startswith('<!DOCTYPE '):
+            if '/login' in urlparse(response.geturl())[2] or 'type="password"' in data.lower():
+                raise _DownloadRefused("Failed to download %s\nThe server didn't accept the session token." % url)
+            error_string = "\n%s\nThe server generated an error trying to download the Attachment. \nURL: %s\n" \
+                "Either the file doesn't exist, or it is a local file which isn't downloadable.\n%s\n" % ("="*30, url, "="*30)
+            raise ShotgunError(error_string)
+    
+    def _with_session(self, func, *args):
+        """
+        Calls func, which downloads with the session token. If the server 
+        refuses the download and the token may have expired, gets a new 
+        token and calls func again.
+        """
+        self._opener_lock.acquire()
+        try:
+            sid, created = self._get_session_token(), self._sid_created
+        finally:
+            self._opener_lock.release()
+        try:
+            return func(*args)
+        except _DownloadRefused:
+            if time.time() - created < self.session_token_min_age:
+                raise
+            self._session_rejected(sid)
+            return func(*args)
+    
+    def download_attachment(self, entity_id, file_path=None, resume=False):
+        """
+        Gets session authentication and returns binary content of Attachment data
+        
+        If file_path is given, the Attachment is instead written to it 
+        download_chunk_size bytes at a time, and file_path is returned. 
+        file_path can be a path or an open file object. With resume set and 
+        a path to a partly downloaded file, only the rest of the file is 
+        requested from the server.
+        """
+        if self.attachment_cache is not None:
+            path = self.attachment_path(entity_id)
+            if file_path is None:
+                f = open(path, "rb")
+                try:
+                    return f.read()
+                finally:
+                    f.close()
+            elif isinstance(file_path, basestring):
+                shutil.copyfile(path, file_path)
+            else:
+                f = open(path, "rb")
+                try:
+                    shutil.copyfileobj(f, file_path, self.download_chunk_size)
+                finally:
+                    f.close()
+            return file_path
+        
+        if file_path is not None:
+            return self._with_session(self._download_attachment_to, entity_id, file_path, resume)
+        return self._with_session(self._read_attachment, entity_id)
+    
+    def _read_attachment(self, entity_id):
+        url, response = self._open_attachment(entity_id)
+        attachment = response.read()
+        self._check_attachment(url, response, attachment)
         return attachment
     
+    def attachment_path(self, entity_id):
+        """
+        Returns the path of an Attachment in the attachment cache, 
+        downloading it into the cache first if needed. The file belongs to 
+        the cache: don't modify it, and copy it if you need to keep it.
+        """
+        if self.attachment_cache is None:
+            raise ShotgunError("attachment_path() needs the attachment cache. Set attachment_cache_dir.")
+        path = self.attachment_cache.get(entity_id)
+        if path is None:
+            path = self.attachment_cache.add(entity_id, 
+                lambda tmp_path: self._with_session(self._download_attachment_to, entity_id, tmp_path, False))
+        return path
+    
+    def open_attachment(self, entity_id):
+        """
+        Returns a read-only memory map of an Attachment in the attachment 
+        cache, downloading it into the cache first if needed. Nothing is 
+        copied into memory until it is read.
+        """
+        f = open(self.attachment_path(entity_id), "rb")
+        try:
+            if not os.fstat(f.fileno()).st_size:
+                return ""   # empty files can't be mapped
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+    
+    def _download_attachment_to(self, entity_id, file_path, resume):
+        offset = 0
+        is_path = isinstance(file_path, basestring)
+        if is_path and resume and os.path.isfile(file_path):
+            offset = os.path.getsize(file_path)
+        url, response = self._open_attachment(entity_id, offset)
+        if response is None:
+            return file_path
+        if offset and response.code != 206:
+            # the server sent the whole file, start over
+            offset = 0
+        
+        try:
+            expected = response.info().getheader("Content-Length")
+            data = response.read(self.download_chunk_size)
+            if not offset:
+                self._check_attachment(url, response, data)
+            if not is_path:
+                f = file_path
+            elif offset:
+                f = open(file_path, "ab")
+            else:
+                f = open(file_path, "wb")
+            try:
+                written = 0
+                while data:
+                    f.write(data)
+                    written += len(data)
+                    data = response.read(self.download_chunk_size)
+            finally:
+                if is_path:
+                    f.close()
+        finally:
+            response.close()
+        
+        if expected is not None and int(expected) != written:
+            raise ShotgunError("Download of %s was incomplete: got %d of %s bytes." % (url, written, expected))
+        return file_path
+    
+    def _transfer_many(self, func, items, max_workers):
+        """
+        Calls func(**item) for every item over max_workers threads and 
+        returns a result dict per item, in order.
+        """
+        def transfer(item):
+            try:
+                return {"item": item, "result": func(**item), "error": None}
+            except Exception, e:
+                return {"item": item, "result": None, "error": e}
+        if max_workers is None:
+            max_workers = self.max_parallel_requests
+        return _parallel_map(transfer, items, max_workers)
+    
+    def upload_many(self, items, max_workers=None):
+        """
+        Uploads several files at once. 
+        
+        @param items: list of dicts of arguments for upload(), eg. 
+            {"entity_type": "Version", "entity_id": 1, "path": "/path/to/file.mov",
+             "field_name": "sg_uploaded_movie"}. Use "field_name": "thumb_image" 
+            for thumbnails.
+        @param max_workers: number of uploads to run at the same time, 
+            defaults to max_parallel_requests
+        
+        Returns a list with a dict per item, in order, with keys "item", 
+        "result" (what upload() returned) and "error" (the exception raised 
+        by upload(), or None). A failed upload doesn't stop the others.
+        """
+        return self._transfer_many(self.upload, items, max_workers)
+    
+    def download_many(self, items, max_workers=None):
+        """
+        Downloads several Attachments at once.
+        
+        @param items: list of dicts of arguments for download_attachment(), 
+            eg. {"entity_id": 1, "file_path": "/path/to/file.mov"}
+        @param max_workers: number of downloads to run at the same time, 
+            defaults to max_parallel_requests
+        
+        Returns a list with a dict per item, in order, with keys "item", 
+        "result" (what download_attachment() returned) and "error" (the 
+        exception raised by download_attachment(), or None). A failed 
+        download doesn't stop the others.
+        """
+        return self._transfer_many(self.download_attachment, items, max_workers)
+    
     def _get_session_token(self):
         """
         Hack to authenticate in order to download protected content
         like Attachments
         """
         if self.sid == None:
-            # HACK: use API2 to get token for now until we better resolve how we manage Attachments in general
-            api2_url = "%s/%s/" % (self.base_url, 'api2')
-            conn = ServerProxy(api2_url)
-            self.sid = conn.getSessionToken([self.script_name, self.api_key])['session_id']
+            if self.session_cache is not None:
+                self.sid, self._sid_created = self.session_cache.get(self._fetch_session_token)
+            else:
+                self.sid, self._sid_created = self._fetch_session_token(), time.time()
         return self.sid
+    
+    def _fetch_session_token(self):
+        # HACK: use API2 to get token for now until we better resolve how we manage Attachments in general
+        api2_url = "%s/%s/" % (self.base_url, 'api2')
+        conn = ServerProxy(api2_url)
+        return conn.getSessionToken([self.script_name, self.api_key])['session_id']
+    
+    def _session_rejected(self, sid):
+        """
+        Drops a session token the server rejected, so the next download 
+        gets a new one.
+        """
+        self._opener_lock.acquire()
+        try:
+            if self.sid == sid:
+                if self.session_cache is not None:
+                    self.session_cache.invalidate(sid)
+                self.sid = None
+                self._download_opener = None
+        finally:
+            self._opener_lock.release()
 
     # Deprecated methods from old wrapper
     def schema(self, entity_type):
@@ -450,10 +1545,349 @@ class Shotgun(object):
     def entity_types(self):
         raise ShotgunError("Deprecated: use schema_entity_read() instead")
 
+class PendingResult(object):
+    """
+    Result of a write buffered by a BufferedWriter. result() returns what 
+    the equivalent create(), update() or delete() call would have, sending
+    the buffered writes first if they haven't been sent yet.
+    """
+    def __init__(self, writer):
+        self._writer = writer
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+    
+    def done(self):
+        return self._done.isSet()
+    
+    def _set(self, result, error=None):
+        self._result = result
+        self._error = error
+        self._done.set()
+    
+    def result(self):
+        if not self._done.isSet():
+            self._writer._send()
+        self._done.wait()
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+class BufferedWriter(object):
+    """
+    Collects create, update and delete calls and sends them through batch().
+    Each call returns a PendingResult. See Shotgun.buffered_writes()
+    """
+    def __init__(self, sg, max_ops=500, max_delay=0.5):
+        self._sg = sg
+        self.max_ops = max_ops
+        self.max_delay = max_delay
+        self._lock = threading.RLock()
+        self._pending = []
+        self._timer = None
+        # error of a flush made by the timer, raised by the next flush()
+        self._error = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            try:
+                self.flush()
+            except Exception:
+                pass # don't hide the error already being raised
+    
+    def create(self, entity_type, data, return_fields=None):
+        r = {"request_type": "create", "entity_type": entity_type, "data": data}
+        if return_fields is not None:
+            r["return_fields"] = return_fields
+        return self._add(r)
+    
+    def update(self, entity_type, entity_id, data):
+        return self._add({"request_type": "update", "entity_type": entity_type,
+                          "entity_id": entity_id, "data": data})
+    
+    def delete(self, entity_type, entity_id):
+        return self._add({"request_type": "delete", "entity_type": entity_type,
+                          "entity_id": entity_id})
+    
+    def _add(self, request):
+        # translate right away, so bad requests fail where they are made
+        nr = self._sg._translate_batch_request(request)
+        result = PendingResult(self)
+        self._lock.acquire()
+        try:
+            self._pending.append((nr, result))
+            if len(self._pending) >= self.max_ops:
+                self._send()
+            elif self._timer is None and self.max_delay is not None:
+                self._timer = threading.Timer(self.max_delay, self._flush_in_background)
+                self._timer.setDaemon(True)
+                self._timer.start()
+        finally:
+            self._lock.release()
+        return result
+    
+    def _flush_in_background(self):
+        try:
+            self._send()
+        except Exception:
+            # passed on to the PendingResults, and raised by the next flush
+            self._error = sys.exc_info()
+    
+    def flush(self):
+        """
+        Sends everything buffered so far in a single batch() call. Raises
+        the error of a send made in the background since the last flush,
+        if there was one.
+        """
+        self._send()
+        error, self._error = self._error, None
+        if error:
+            raise error[0], error[1], error[2]
+    
+    def _send(self):
+        self._lock.acquire()
+        try:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending, self._pending = self._pending, []
+            if not pending:
+                return
+            try:
+                results = self._sg._send_batch([nr for nr, result in pending])
+            except Exception:
+                error = sys.exc_info()
+                for nr, result in pending:
+                    result._set(None, error)
+                raise
+            for (nr, result), value in zip(pending, results):
+                result._set(value)
+        finally:
+            self._lock.release()
+    
+    close = flush
+
+class IncrementalSync(object):
+    """
+    Merges the entities matching find() queries into a store, reading 
+    only what changed since the previous sync. See Shotgun.incremental_sync()
+    
+    For each entity type and filter set it keeps, in marks, the updated_at
+    of the last entity read and the ids of the entities read with that
+    updated_at. The next sync asks for the entities updated in that same 
+    second that weren't read yet, then for the ones updated after it, in
+    (updated_at, id) order. updated_at only has one second resolution, so
+    this catches entities updated later in the same second than the last
+    sync, whatever their id, and a sync that stops part way through (eg.
+    on an error) carries on without missing or repeating any entity.
+    
+    The store can be any object with __setitem__ and pop(key, default), 
+    eg. a dict or a shelve, and gets entities keyed by (entity_type, id).
+    Entities changed so they no longer match the filters stay in the store.
+    """
+    _order = ({'field_name': 'updated_at', 'direction': 'asc'},
+              {'field_name': 'id', 'direction': 'asc'})
+    
+    def __init__(self, sg, store=None, marks=None):
+        if store is None:
+            store = {}
+        if marks is None:
+            marks = {}
+        self._sg = sg
+        self.store = store
+        self.marks = marks
+    
+    def sync(self, entity_type, filters, fields=None):
+        """
+        Stores the entities of entity_type matching filters that were 
+        updated since the last sync of the same query, then removes the 
+        ones retired since. The first sync of a query reads all of them.
+        
+        Returns a list of the ids stored and a list of the ids removed.
+        """
+        if fields == None:
+            fields = ['id']
+        fields = list(fields)
+        if 'updated_at' not in fields:
+            fields.append('updated_at')
+        key = (entity_type, _freeze(filters))
+        retired_key = key + ('retired',)
+        
+        if retired_key not in self.marks:
+            # nothing retired before the first sync is in the store
+            newest = self._read(entity_type, filters, ['updated_at'], 
+                [{'field_name': 'updated_at', 'direction': 'desc'}, 
+                 {'field_name': 'id', 'direction': 'desc'}], 1, True)
+            self.marks[retired_key] = newest and (newest[0]['updated_at'], (newest[0]['id'],)) or None
+        
+        updated = []
+        for record in self._read_since(entity_type, filters, fields, key, False):
+            self.store[(entity_type, record['id'])] = record
+            updated.append(record['id'])
+        retired = []
+        for record in self._read_since(entity_type, filters, ['updated_at'], retired_key, True):
+            self.store.pop((entity_type, record['id']), None)
+            retired.append(record['id'])
+        return updated, retired
+    
+    def _read_since(self, entity_type, filters, fields, key, retired_only):
+        # yields the entities past the mark a page at a time, moving the 
+        # mark on after each page
+        per_page = self._sg.records_per_page
+        while True:
+            mark = self.marks.get(key)
+            if mark is None:
+                records = self._read(entity_type, filters, fields, self._order, per_page, retired_only)
+            else:
+                updated_at, seen = mark
+                # the entities updated in the same second as the mark that
+                # haven't been read yet come first
+                records = self._read(entity_type, 
+                    list(filters) + [['updated_at', 'is', updated_at], ['id', 'not_in', list(seen)]], 
+                    fields, self._order, per_page, retired_only)
+                if len(records) < per_page:
+                    records.extend(self._read(entity_type, 
+                        list(filters) + [['updated_at', 'greater_than', updated_at]], 
+                        fields, self._order, per_page - len(records), retired_only))
+            if records and 'image' in fields:
+                self._sg._add_thumb_urls(entity_type, records)
+            for record in records:
+                yield record
+            if records:
+                updated_at = records[-1]['updated_at']
+                seen = [r['id'] for r in records if r['updated_at'] == updated_at]
+                if mark is not None and mark[0] == updated_at:
+                    seen = list(mark[1]) + seen
+                self.marks[key] = (updated_at, tuple(seen))
+            if len(records) < per_page:
+                break
+    
+    def _read(self, entity_type, filters, fields, order, limit, retired_only):
+        # a single page read, bypassing the query cache
+        req = self._sg._translate_find_request(entity_type, filters, fields, 
+            [dict(sort) for sort in order], None, limit, retired_only)
+        req['paging']['entities_per_page'] = limit
+        return self._sg._api3.read(req)["results"]["entities"][:limit]
+
+class ShotgunReplica(object):
+    """
+    Local copy of some entity types, kept in SQLite, which answers find()
+    and find_one() without asking the server. entities maps each entity 
+    type to copy to the list of its fields to keep:
+    
+        replica = ShotgunReplica(sg, {"Shot": ["code", "sg_status_list", "project"]}, "/tmp/shots.db")
+        replica.refresh()
+        shots = replica.find("Shot", [["sg_status_list", "is", "ip"], ["code", "starts_with", "sh1"]], ["code"])
+    
+    The filters of a find() are translated into queries on indexed 
+    columns, so reads take well under a millisecond and work offline. 
+    Requests the copy can't answer (other entity types or fields, dotted 
+    paths, retired entities, multi entity fields) are sent to the server.
+    
+    The copy is only as recent as the last refresh(), which reads just the
+    entities updated or retired since the one before (see 
+    Shotgun.incremental_sync). staleness() tells how old it is. With a 
+    path instead of the default ":memory:", the copy and its sync marks 
+    are kept on disk and shared by the processes opening the same file:
+    a refresh carries on from the last one made by any of them, and 
+    commits a page at a time so the others can keep using the file.
+    """
+    def __init__(self, sg, entities, path=":memory:"):
+        self._sg = sg
+        self._store = ReplicaStore(path, entities)
+        self._syncer = IncrementalSync(sg, self._store, self._store.marks())
+        self._refresh_lock = threading.Lock()
+    
+    def refresh(self, entity_types=None):
+        """
+        Brings the local copy of entity_types (all of them by default) up
+        to date. Returns the number of entities updated or removed.
+        """
+        if entity_types is None:
+            entity_types = self._store.entity_types()
+        count = 0
+        self._refresh_lock.acquire()
+        try:
+            for entity_type in entity_types:
+                started = time.time()
+                # carry on from where other processes sharing the file got to
+                self._store.reload(entity_type)
+                try:
+                    updated, retired = self._syncer.sync(entity_type, [], self._store.fields(entity_type))
+                except:
+                    # drop the page being stored, the ones before are kept
+                    self._store.rollback()
+                    self._store.reload(entity_type)
+                    raise
+                self._store.refreshed(entity_type, started)
+                count += len(updated) + len(retired)
+        finally:
+            self._refresh_lock.release()
+        return count
+    
+    def staleness(self, entity_type):
+        """
+        Returns how many seconds old the local copy of entity_type is
+        (since the start of its last refresh), or None if it was never
+        read.
+        """
+        refreshed_at = self._store.refreshed_at(entity_type)
+        if refreshed_at is None:
+            return None
+        return max(time.time() - refreshed_at, 0)
+    
+    def find(self, entity_type, filters, fields=None, order=None, filter_operator=None, limit=0, retired_only=False):
+        """
+        Same as Shotgun.find, answered from the local copy when possible.
+        """
+        if fields == None: 
+            fields = ['id']
+        if order == None: 
+            order = []
+        
+        req = self._sg._translate_find_request(entity_type, filters, fields, order, filter_operator, limit, retired_only)
+        try:
+            return self._store.find(req, limit)
+        except UnsupportedQuery:
+            return self._sg.find(entity_type, filters, fields, order, filter_operator, limit, retired_only)
+    
+    def find_one(self, entity_type, filters, fields=None, order=None, filter_operator=None, retired_only=False):
+        """
+        Same as find, but only returns 1 result as a dict 
+        """
+        result = self.find(entity_type, filters, fields, order, filter_operator, 1, retired_only)
+        if len(result) > 0:
+            return result[0]
+        else:
+            return None
+    
+    def close(self):
+        self._store.close()
+
+class _Flight(object):
+    """
+    A call in progress that other threads making the same call wait for.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
 class ShotgunCRUD(object):
+    # Read only methods. Identical calls to them made from several threads
+    # at once are sent only once, and every thread gets the result.
+    coalesced_methods = ("read", "schema_read", "schema_field_read", "schema_entity_read")
+    
     def __init__(self, options):
         self.__sg_url = options['server_url']
-        self.__auth_args = {'script_name': options['script_name'], 'script_key': options['script_key']}
+        # sent with every call, so only marshalled once
+        self.__auth_args = Marshalled({'script_name': options['script_name'], 'script_key': options['script_key']})
         if 'convert_datetimes_to_utc' in options:
             convert_datetimes_to_utc = options['convert_datetimes_to_utc']
         else:
@@ -462,33 +1896,114 @@ class ShotgunCRUD(object):
             self.__err_stream = options['error_stream']
         else:
             self.__err_stream = sys.stderr
+        # number of pooled keep-alive connections, which is also the number
+        # of threads that can use this object at the same time
+        if 'max_connections' in options:
+            max_connections = options['max_connections']
+        else:
+            max_connections = 4
         if 'http_proxy' in options and options['http_proxy']:
-            p = ProxiedTransport()
+            p = ProxiedTransport(convert_datetimes_to_utc = convert_datetimes_to_utc, max_connections = max_connections)
             p.set_proxy( options['http_proxy'] )
             self.__sg = ServerProxy(self.__sg_url, convert_datetimes_to_utc = convert_datetimes_to_utc, transport=p)
         else:
-            self.__sg = ServerProxy(self.__sg_url, convert_datetimes_to_utc = convert_datetimes_to_utc)
+            self.__sg = ServerProxy(self.__sg_url, convert_datetimes_to_utc = convert_datetimes_to_utc, max_connections = max_connections)
+        if 'compress_request_threshold' in options:
+            self.__sg("transport").encode_threshold = options['compress_request_threshold']
+        self.__flights = {}
+        self.__flights_lock = threading.Lock()
     
     def __getattr__(self, attr):
         def callable(*args, **kwargs):
             return self.meta_caller(attr, *args, **kwargs)
         return callable
     
+    def call_into(self, new_target, attr, *args):
+        """
+        Calls attr like meta_caller does, but has the response decoded by 
+        the Unmarshaller new_target() returns. new_target is called again
+        each time the request is retried.
+        """
+        try:
+            return self.__sg("request")(attr, (self.__auth_args,) + args, new_target)
+        except Fault, e:
+            self.__report_fault(e)
+            raise e
+    
+    def __report_fault(self, e):
+        if self.__err_stream:
+            self.__err_stream.write("\\n" + "-"*80 + "\\n")
+            self.__err_stream.write("XMLRPC Fault %s: \\n" % e.faultCode)
+            self.__err_stream.write(e.faultString)
+            self.__err_stream.write("\\n" + "-"*80 + "\\n")
+    
     def meta_caller(self, attr, *args, **kwargs):
+        if attr in self.coalesced_methods and not kwargs:
+            key = (attr, _freeze(args))
+            try:
+                hash(key)
+            except TypeError:
+                pass # unhashable arguments, can't tell identical calls apart
+            else:
+                return self.__coalesced_call(key, attr, args)
+        return self.__call(attr, *args, **kwargs)
+    
+    def __coalesced_call(self, key, attr, args):
+        """
+        Makes the call, unless an identical one is already in progress in 
+        another thread, in which case it waits for that one's result.
+        """
+        self.__flights_lock.acquire()
+        try:
+            flight = self.__flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.__flights[key] = _Flight()
+            else:
+                flight.waiters += 1
+        finally:
+            self.__flights_lock.release()
+        
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error[0], flight.error[1], flight.error[2]
+            # flight.result is a copy nobody changes, each thread gets its own
+            return copy.deepcopy(flight.result)
+        
+        result = None
+        try:
+            try:
+                result = self.__call(attr, *args)
+            except:
+                flight.error = sys.exc_info()
+                raise
+            return result
+        finally:
+            self.__flights_lock.acquire()
+            try:
+                del self.__flights[key]
+            finally:
+                self.__flights_lock.release()
+            # no more threads can join the flight now. The leader's result 
+            # is copied before it returns, as it may change it right away
+            if flight.waiters and not flight.error:
+                flight.result = copy.deepcopy(result)
+            flight.done.set()
+    
+    def __call(self, attr, *args, **kwargs):
         try:
 
             # attempt to get the remote call from the Proxy Server
             rpc_func = getattr(self.__sg, attr, None)
-            if rpc_func:
+            # compare against None: a truth test on the method proxy would
+            # itself be sent to the server as an "<attr>.__nonzero__" call
+            if rpc_func is not None:
                 return rpc_func(self.__auth_args, *args, **kwargs)
             else:
                 raise ShotgunError('No attribute %s on rpc server' % attr)
         except Fault, e:
-            if self.__err_stream:
-                self.__err_stream.write("\\n" + "-"*80 + "\\n")
-                self.__err_stream.write("XMLRPC Fault %s: \\n" % e.faultCode)
-                self.__err_stream.write(e.faultString)
-                self.__err_stream.write("\\n" + "-"*80 + "\\n")
+            self.__report_fault(e)
             raise e
 
 if __name__ == "__main__":
@@ -0,0 +1,201 @@
+"""
+Benchmarks for the client against a local stand-in server.
+
+Run with:  python test/bench_shotgun.py
+"""
+import datetime
+import time
+import xmlrpclib
+
+from test_shotgun import StandInServer, xmlrpc_echo, make_find_response, FilteringCRUD
+import shotgun_api3
+from lib import xmlrpc_sg
+
+def timeit(func, number):
+    start = time.time()
+    for i in xrange(number):
+        func()
+    return (time.time() - start) / number
+
+def report(name, before, after, unit="ms", scale=1000.0):
+    print "%-40s %10.3f %s %10.3f %s  (x%.1f)" % (name, before * scale, unit, after * scale, unit, before / after)
+
+class TwoWriteTransport(xmlrpc_sg.Transport):
+    """
+    The transport as it was before headers and body were coalesced: 
+    headers and body are separate writes and Nagle's algorithm is on.
+    """
+    def new_connection(self, host):
+        return xmlrpc_sg.httplib.HTTPConnection(host)
+
+    def send_content(self, connection, request_body):
+        connection.putheader("Content-Type", "text/xml")
+        connection.putheader("Content-Length", str(len(request_body)))
+        connection.endheaders()
+        if request_body:
+            connection.send(request_body)
+
+def bench_small_calls(number=200):
+    print "Small calls, per call latency (%d calls)" % number
+    server = StandInServer({"/api3_preview/": xmlrpc_echo})
+    try:
+        url = server.url + "/api3_preview/"
+        auth = {"script_name": "bench", "script_key": "0123456789abcdef"}
+        find_one = {"type": "Shot", "return_fields": ["id", "code"], "return_only": "active",
+                    "filters": {"logical_operator": "and", "conditions": [{"path": "id", "relation": "is", "values": [1]}]},
+                    "paging": {"entities_per_page": 1, "current_page": 1}}
+        update = {"type": "Shot", "id": 1, "fields": [{"field_name": "sg_status_list", "value": "ip"}]}
+        before = xmlrpc_sg.ServerProxy(url, transport=TwoWriteTransport())
+        after = xmlrpc_sg.ServerProxy(url)
+        for name, args in (("find_one", find_one), ("update", update)):
+            report(name, timeit(lambda: getattr(before, name)(auth, args), number),
+                         timeit(lambda: getattr(after, name)(auth, args), number))
+        before("close")()
+        after("close")()
+    finally:
+        server.stop()
+
+class SmallReadTransport(xmlrpc_sg.Transport):
+    """
+    The transport as it was before reads used the Content-Length: fixed
+    1024 byte reads, each fed to the parser.
+    """
+    min_read_size = max_read_size = 1024
+
+def bench_large_response(count=20000, number=3):
+    response = make_find_response(count)
+    print "Large find page, %d entities, %.1f MB (%d runs)" % (count, len(response) / 1048576.0, number)
+    server = StandInServer({"/api3_preview/": lambda handler: (200, {}, response)})
+    try:
+        url = server.url + "/api3_preview/"
+        before = xmlrpc_sg.ServerProxy(url, transport=SmallReadTransport())
+        after = xmlrpc_sg.ServerProxy(url)
+        zero_copy = xmlrpc_sg.ServerProxy(url)
+        zero_copy("transport").zero_copy = 1
+        base = timeit(lambda: before.read({}), number)
+        report("read() adaptive chunks", base, timeit(lambda: after.read({}), number))
+        report("read() zero copy", base, timeit(lambda: zero_copy.read({}), number))
+        for proxy in (before, after, zero_copy):
+            proxy("close")()
+    finally:
+        server.stop()
+
+class OldLocalTimezone(xmlrpc_sg.sg_timezone.LocalTimezone):
+    # the local timezone as it was before utc offsets were cached
+    fromutc = datetime.tzinfo.fromutc
+
+class OldDatetimeUnmarshaller(xmlrpc_sg.Unmarshaller):
+    """
+    The unmarshaller as it was before the datetime fast path: strptime and
+    astimezone() for every value.
+    """
+    dispatch = xmlrpc_sg.Unmarshaller.dispatch.copy()
+    local = OldLocalTimezone()
+
+    def end_dateTime(self, data):
+        t = time.strptime(data, "%Y%m%dT%H:%M:%S")
+        value = datetime.datetime(*tuple(t)[:6])
+        value = value.replace(tzinfo=xmlrpc_sg.sg_timezone.utc).astimezone(self.local)
+        self.append(value)
+    dispatch["dateTime.iso8601"] = end_dateTime
+
+def bench_datetimes(count=20000, number=3):
+    print "Decoding %d records with created_at and updated_at (%d runs)" % (count, number)
+    start = datetime.datetime(2010, 1, 1)
+    records = [{"type": "Version", "id": i, "created_at": start + datetime.timedelta(minutes=i * 7),
+                "updated_at": start + datetime.timedelta(seconds=i * 1000)} for i in range(count)]
+    response = xmlrpclib.dumps(({"entities": records},), methodresponse=1)
+    def loads(unmarshaller):
+        parser = xmlrpc_sg.ExpatParser(unmarshaller)
+        parser.feed(response)
+        parser.close()
+        return unmarshaller.close()
+    report("unmarshal dateTimes", timeit(lambda: loads(OldDatetimeUnmarshaller()), number),
+                                  timeit(lambda: loads(xmlrpc_sg.Unmarshaller()), number))
+
+def bench_unmarshal(count=20000, number=3):
+    response = make_find_response(count)
+    print "Unmarshalling a find page, %d entities, %.1f MB (%d runs)" % (count, len(response) / 1048576.0, number)
+    def loads(parser_class, unmarshaller_class):
+        unmarshaller = unmarshaller_class()
+        parser = parser_class(unmarshaller)
+        parser.feed(response)
+        parser.close()
+        return unmarshaller.close()
+    report("ExpatUnmarshaller", timeit(lambda: loads(xmlrpc_sg.ExpatParser, xmlrpc_sg.Unmarshaller), number),
+                                timeit(lambda: loads(xmlrpc_sg.BufferedExpatParser, xmlrpc_sg.ExpatUnmarshaller), number))
+
+def bench_marshal(count=5000, number=5):
+    print "Marshalling a batch() of %d creates (%d runs)" % (count, number)
+    requests = [{"request_type": "create", "type": "Version",
+                 "fields": [{"field_name": "code", "value": "shot_%04d_comp_v%03d" % (i / 10, i % 10)},
+                            {"field_name": "description", "value": "notes & <comments>"},
+                            {"field_name": "frame_count", "value": 120},
+                            {"field_name": "sg_status_list", "value": "rev"},
+                            {"field_name": "sg_first_frame", "value": 1001},
+                            {"field_name": "entity", "value": {"type": "Shot", "id": i / 10}},
+                            {"field_name": "created_at", "value": datetime.datetime(2010, 5, 1, 12, i % 60)}],
+                 "return_fields": ["id"]} for i in range(count)]
+    auth = {"script_name": "bench", "script_key": "0123456789abcdef"}
+    params = (auth, requests)
+    report("BufferedMarshaller", timeit(lambda: xmlrpc_sg.Marshaller("utf-8").dumps(params), number),
+                                 timeit(lambda: xmlrpc_sg.BufferedMarshaller("utf-8").dumps(params), number))
+
+def bench_small_requests(number=20000):
+    print "Encoding a small read() request (%d runs)" % number
+    auth = {"script_name": "bench", "script_key": "0123456789abcdef"}
+    find_one = {"type": "Shot", "return_fields": ["id", "code"], "return_only": "active",
+                "filters": {"logical_operator": "and", "conditions": [{"path": "id", "relation": "is", "values": [1]}]},
+                "paging": {"entities_per_page": 1, "current_page": 1}}
+    marshalled = xmlrpc_sg.Marshalled(auth)
+    report("dumps() with Marshalled auth", timeit(lambda: xmlrpclib.dumps((auth, find_one), "read"), number),
+                                           timeit(lambda: xmlrpc_sg.dumps((marshalled, find_one), "read"), number),
+                                           "us", 1000000.0)
+
+def bench_find_columns(count=20000, number=3):
+    print "find() and pivot into columns vs find_columns(), %d entities (%d runs)" % (count, number)
+    response = make_find_response(count)
+    server = StandInServer({"/api3_preview/": lambda handler: (200, {}, response)})
+    try:
+        sg = shotgun_api3.Shotgun(server.url, "bench", "0123456789abcdef")
+        sg.records_per_page = count
+        fields = ["code", "sg_status_list", "frame_count", "created_at", "entity", "description"]
+        def pivot():
+            records = sg.find("Version", [], fields)
+            columns = {}
+            for field in ["id", "type"] + fields:
+                columns[field] = [r[field] for r in records]
+            return columns
+        report("find_columns()", timeit(pivot, number),
+                                 timeit(lambda: sg.find_columns("Version", [], fields), number))
+    finally:
+        server.stop()
+
+def bench_replica_find(count=20000, number=200):
+    print "find() of 10 entities from the server vs a ShotgunReplica of %d entities (%d runs)" % (count, number)
+    response = make_find_response(10)
+    server = StandInServer({"/api3_preview/": lambda handler: (200, {}, response)})
+    try:
+        sg = shotgun_api3.Shotgun(server.url, "bench", "0123456789abcdef")
+        fields = ["code", "sg_status_list", "frame_count", "entity"]
+        replica = shotgun_api3.ShotgunReplica(sg, {"Version": fields})
+        api3, sg._api3 = sg._api3, FilteringCRUD([{"type": "Version", "id": i, "code": "v%05d" % i, "sg_status_list": "rev",
+            "frame_count": 120, "entity": {"type": "Shot", "id": i / 10, "name": "shot_%04d" % (i / 10)},
+            "updated_at": datetime.datetime(2010, 5, 1, 12, 30)} for i in range(1, count + 1)])
+        replica.refresh()
+        sg._api3 = api3
+        filters = [["entity", "is", {"type": "Shot", "id": 42}], ["sg_status_list", "is", "rev"]]
+        report("find()", timeit(lambda: sg.find("Version", filters, fields), number),
+                         timeit(lambda: replica.find("Version", filters, fields), number))
+    finally:
+        server.stop()
+
+if __name__ == "__main__":
+    bench_small_calls()
+    bench_large_response()
+    bench_datetimes()
+    bench_unmarshal()
+    bench_marshal()
+    bench_small_requests()
+    bench_find_columns()
+    bench_replica_find()
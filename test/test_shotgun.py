@@ -1,8 +1,1238 @@
 import unittest
+import calendar
+import datetime
 import sys
+import os
+import threading
+import BaseHTTPServer
+import SocketServer
+import gzip
+import zlib
+import StringIO
+import shutil
+import tempfile
+import time
+import httplib
+import socket
+import errno
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import shotgun_api3
+from lib import xmlrpc_sg
+from lib import cache_sg
+import xmlrpclib
+
+class FakeCRUD(object):
+    """
+    Stands in for ShotgunCRUD, answering read() calls from a list of
+    in-memory records and remembering every request it was sent.
+    """
+    def __init__(self, records):
+        self.records = records
+        self.calls = []
+
+    def schema_field_read(self, args):
+        self.calls.append(args)
+        return {"results": {"code": {"data_type": {"value": "text"}}}}
+
+    def schema_field_update(self, args):
+        self.calls.append(args)
+        return {"results": True}
+
+    def update(self, args):
+        self.calls.append(args)
+        return {"results": args}
+
+    def batch(self, reqs):
+        self.calls.append(reqs)
+        for r in reqs:
+            if r.get("id") == 13:
+                raise xmlrpc_sg.Fault(1, "cannot update 13")
+        return {"results": [{"type": r["type"], "id": r.get("id", 0)} for r in reqs]}
+
+    def read(self, req):
+        self.calls.append(req)
+        per_page = req["paging"]["entities_per_page"]
+        start = (req["paging"]["current_page"] - 1) * per_page
+        return {"results": {
+            "entities": [dict(r) for r in self.records[start:start + per_page]],
+            "paging_info": {"entity_count": len(self.records)}
+        }}
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers requests from the routes of the StandInServer. A route is a
+    function taking the handler and returning (status, headers, body).
+    """
+    protocol_version = "HTTP/1.1"
+    # answer in a single write, like a real server would
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        self.body = self.rfile.read(int(self.headers.get("content-length", 0)))
+        route = self.server.routes.get(self.path.split("?")[0])
+        self.server.requests.append(self)
+        if route is None:
+            status, headers, body = 404, {}, "not found"
+        else:
+            status, headers, body = route(self)
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        if "Content-Length" not in headers:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    do_GET = do_POST = _handle
+
+    def log_message(self, *args):
+        pass
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local keep-alive HTTP server used in place of a Shotgun server. Errors
+    raised while answering requests are raised again by stop().
+    """
+    daemon_threads = True
+
+    def __init__(self, routes):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+        self.routes = routes
+        self.requests = []
+        self.errors = []
+        self.url = "http://127.0.0.1:%d" % self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        # connections still open are left to their threads, whose errors
+        # aren't wanted any more
+        errors, self.errors = self.errors, None
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def handle_error(self, request, client_address):
+        if self.errors is None:
+            return
+        error = sys.exc_info()
+        if isinstance(error[1], socket.error) and error[1].args[0] in (errno.EPIPE, errno.ECONNRESET):
+            return # clients going away
+        self.errors.append(error)
 
 class ShotgunAPITestCase(unittest.TestCase):
-    pass
+    def setUp(self):
+        self.sg = shotgun_api3.Shotgun("http://localhost:3000", "test_script", "0123456789abcdef")
+        self.sg.records_per_page = 10
+        self.crud = FakeCRUD([{"type": "Version", "id": i} for i in range(1, 96)])
+        self.sg._api3 = self.crud
+
+class FindTestCase(ShotgunAPITestCase):
+    def test_parallel_matches_serial(self):
+        serial = self.sg.find("Version", [])
+        parallel = self.sg.find("Version", [], parallel=True)
+        self.assertEqual(95, len(parallel))
+        self.assertEqual(serial, parallel)
+
+    def test_max_parallel_requests(self):
+        sg = shotgun_api3.Shotgun("http://localhost:3000", "test_script", "0123456789abcdef",
+                                  max_parallel_requests=16)
+        self.assertEqual(16, sg.max_parallel_requests)
+        self.assertEqual(16, sg._api3._ShotgunCRUD__sg("transport")._pool.max_connections)
+        self.assertEqual(16, sg._thumb_pool.max_connections)
+        self.assertEqual(4, self.sg.max_parallel_requests)
+
+    def test_parallel_limit(self):
+        records = self.sg.find("Version", [], limit=25, parallel=True)
+        self.assertEqual(range(1, 26), [r["id"] for r in records])
+        self.assertEqual(3, len(self.crud.calls))
+
+    def test_find_iter_matches_find(self):
+        self.assertEqual(self.sg.find("Version", []), list(self.sg.find_iter("Version", [])))
+
+    def test_find_iter_limit(self):
+        records = list(self.sg.find_iter("Version", [], limit=15))
+        self.assertEqual(range(1, 16), [r["id"] for r in records])
+        self.assertEqual(2, len(self.crud.calls))
+
+class CompactFindTestCase(ShotgunAPITestCase):
+    def setUp(self):
+        ShotgunAPITestCase.setUp(self)
+        self.crud.records = [{"type": "Version", "id": i, "code": "v%03d" % i, "frame_count": 100 + i,
+                              "sg_status_list": "rev", "description": None,
+                              "entity": {"type": "Shot", "id": i / 10, "name": "shot_%d" % (i / 10)},
+                              "tags": [{"type": "Tag", "id": 1, "name": "hero"}]} for i in range(1, 96)]
+
+    def test_same_as_dicts(self):
+        records = self.sg.find("Version", [], compact=True)
+        self.assertEqual(self.sg.find("Version", []), records)
+        self.assertEqual(records, self.sg.find("Version", [], compact=True, parallel=True))
+        self.assertEqual(records, list(self.sg.find_iter("Version", [], compact=True)))
+        record = records[0]
+        self.assertEqual("v001", record["code"])
+        self.assertEqual(None, record.get("sg_foo"))
+        self.assertTrue("code" in record)
+        self.assertEqual(sorted(self.crud.records[0].keys()), sorted(record.keys()))
+        self.assertEqual(self.crud.records[0], record.to_dict())
+        self.assertTrue(type(record.to_dict()["entity"]) is dict)
+        self.assertRaises(KeyError, record.__getitem__, "sg_foo")
+
+    def test_shared_links(self):
+        records = self.sg.find("Version", [], compact=True)
+        self.assertTrue(records[10]["entity"] is records[11]["entity"])
+        self.assertTrue(records[0]["tags"][0] is records[90]["tags"][0])
+        self.assertTrue(type(records[0]) is type(records[1]))
+
+    def test_update(self):
+        record = self.sg.find("Version", [], compact=True)[0]
+        record["code"] = "renamed"
+        self.assertEqual("renamed", record["code"])
+        self.assertRaises(KeyError, record.__setitem__, "sg_foo", 1)
+
+    def test_copy(self):
+        import cPickle
+        import copy
+        record = self.sg.find("Version", [], compact=True)[0]
+        self.assertEqual(record, cPickle.loads(cPickle.dumps(record, 2)))
+        self.assertEqual(record, copy.deepcopy(record))
+
+    def test_send_back(self):
+        record = self.sg.find("Version", [], compact=True)[10]
+        link = record["entity"]
+        for marshaller in (xmlrpc_sg.Marshaller, xmlrpc_sg.BufferedMarshaller):
+            xml = marshaller("utf-8").dumps(({"entity": link, "tags": record["tags"]},))
+            self.assertEqual(({"entity": link.to_dict(), "tags": [record["tags"][0].to_dict()]},), 
+                             xmlrpclib.loads("<methodResponse>%s</methodResponse>" % xml)[0])
+        self.sg.update("Version", 1, {"entity": link})
+        self.assertEqual(link.to_dict(), xmlrpc_sg.loads(xmlrpc_sg.dumps((self.crud.calls[-1],), "update"))[0][0]
+            ["fields"][0]["value"])
+
+        self.sg.query_cache = cache_sg.QueryCache(60)
+        reads = len(self.crud.calls)
+        records = self.sg.find("Version", [["entity", "is", link]], compact=True)
+        self.assertEqual(records, self.sg.find("Version", [["entity", "is", link]], compact=True))
+        self.assertEqual(reads + 10, len(self.crud.calls))
+        self.assertEqual(link.to_dict(), xmlrpc_sg.loads(xmlrpc_sg.dumps((self.crud.calls[-1],), "read"))[0][0]
+            ["filters"]["conditions"][0]["values"][0])
+
+    def test_memory(self):
+        record = self.sg.find("Version", [], compact=True)[0]
+        plain = self.crud.records[0]
+        self.assertTrue(sys.getsizeof(record) * 4 < sys.getsizeof(plain) + sys.getsizeof(plain["entity"]))
+
+class ThumbnailTestCase(unittest.TestCase):
+    def setUp(self):
+        def thumbnail_url(handler):
+            entity_id = handler.path.split("entity_id=")[1]
+            return 200, {}, "1\n/files/thumb_%s.jpg\n" % entity_id
+        self.server = StandInServer({"/upload/get_thumbnail_url": thumbnail_url})
+        self.sg = shotgun_api3.Shotgun(self.server.url, "test_script", "0123456789abcdef")
+        self.records = [{"type": "Asset", "id": i, "image": i % 2 and "thumb" or None} for i in range(1, 21)]
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_batch_resolution(self):
+        self.sg._add_thumb_urls("Asset", self.records)
+        self.assertEqual(self.server.url + "/files/thumb_3.jpg", self.records[2]["image"])
+        self.assertEqual(None, self.records[1]["image"])
+        self.assertEqual(10, len(self.server.requests))
+
+    def test_lazy_resolution(self):
+        self.sg.lazy_thumbnail_urls = True
+        self.sg._add_thumb_urls("Asset", self.records)
+        self.assertEqual(0, len(self.server.requests))
+        self.assertEqual(self.server.url + "/files/thumb_5.jpg", str(self.records[4]["image"]))
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_lazy_comparison(self):
+        self.sg.lazy_thumbnail_urls = True
+        self.sg._add_thumb_urls("Asset", self.records)
+        url = self.server.url + "/files/thumb_5.jpg"
+        lazy = self.records[4]["image"]
+        self.assertFalse(lazy != url)
+        self.assertTrue(lazy != self.records[6]["image"])
+        self.assertTrue(url in set([lazy]))
+        self.assertTrue(lazy in set([url]))
+        self.assertEqual(1, len(set([lazy, shotgun_api3.LazyThumbnailUrl(self.sg, "Asset", 5)])))
+
+class BatchTestCase(ShotgunAPITestCase):
+    def updates(self, ids):
+        return [{"request_type": "update", "entity_type": "Shot", "entity_id": i, "data": {"code": "x"}} for i in ids]
+
+    def test_chunked(self):
+        for parallel in (False, True):
+            self.crud.calls = []
+            results = self.sg.batch(self.updates(range(1, 12)), chunk_size=5, parallel=parallel)
+            self.assertEqual(range(1, 12), [r["id"] for r in results])
+            self.assertEqual([5, 5, 1], sorted([len(c) for c in self.crud.calls], reverse=True))
+
+    def test_failed_chunk(self):
+        for parallel, last in ((False, None), (True, {"type": "Shot", "id": 20})):
+            try:
+                self.sg.batch(self.updates(range(1, 21)), chunk_size=5, parallel=parallel)
+            except shotgun_api3.BatchError, e:
+                self.assertEqual([(2, 10)], [f[:2] for f in e.failed_chunks])
+                self.assertEqual(range(1, 11), [r["id"] for r in e.results[:10]])
+                self.assertEqual([None] * 5, e.results[10:15])
+                # a serial batch stops at the failed chunk
+                self.assertEqual(last, e.results[-1])
+            else:
+                self.fail("BatchError not raised")
+
+class BufferedWritesTestCase(ShotgunAPITestCase):
+    def test_max_ops(self):
+        w = self.sg.buffered_writes(max_ops=3, max_delay=None)
+        results = [w.update("Shot", i, {"code": "x"}) for i in range(1, 8)]
+        self.assertEqual([3, 3], [len(c) for c in self.crud.calls])
+        self.assertEqual(False, results[-1].done())
+        w.close()
+        self.assertEqual([1, 2, 3, 4, 5, 6, 7], [r.result()["id"] for r in results])
+        self.assertEqual(3, len(self.crud.calls))
+
+    def test_max_delay(self):
+        w = self.sg.buffered_writes(max_delay=0.05)
+        result = w.create("Shot", {"code": "x"})
+        time.sleep(0.5)
+        self.assertTrue(result.done())
+        self.assertEqual({"type": "Shot", "id": 0}, result.result())
+
+    def test_failed_background_flush(self):
+        w = self.sg.buffered_writes(max_delay=0.05)
+        result = w.update("Shot", 13, {"code": "x"})
+        time.sleep(0.5)
+        self.assertTrue(result.done())
+        other = w.update("Shot", 1, {"code": "x"})
+        self.assertEqual(1, other.result()["id"])
+        self.assertRaises(xmlrpc_sg.Fault, w.close)
+        w.close()
+
+        def write():
+            with self.sg.buffered_writes(max_delay=0.05) as w:
+                w.update("Shot", 13, {"code": "x"})
+                time.sleep(0.5)
+        self.assertRaises(xmlrpc_sg.Fault, write)
+        def fail():
+            with self.sg.buffered_writes(max_delay=0.05) as w:
+                w.update("Shot", 13, {"code": "x"})
+                time.sleep(0.5)
+                raise KeyError("sg_foo")
+        self.assertRaises(KeyError, fail)
+
+    def test_result_flushes(self):
+        w = self.sg.buffered_writes(max_delay=None)
+        result = w.update("Shot", 13, {"code": "x"})
+        self.assertRaises(xmlrpc_sg.Fault, result.result)
+
+    def test_context_manager(self):
+        with self.sg.buffered_writes(max_delay=None) as w:
+            result = w.delete("Shot", 1)
+        self.assertTrue(result.done())
+        self.assertEqual(1, len(self.crud.calls))
+
+class SchemaCacheTestCase(ShotgunAPITestCase):
+    def setUp(self):
+        ShotgunAPITestCase.setUp(self)
+        self.cache_dir = tempfile.mkdtemp()
+        self.sg.schema_cache = cache_sg.SchemaCache(self.sg.base_url, 60, self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_cached(self):
+        first = self.sg.schema_field_read("Shot", "code")
+        first["code"]["data_type"]["value"] = "changed by caller"
+        self.assertEqual("text", self.sg.schema_field_read("Shot", "code")["code"]["data_type"]["value"])
+        self.assertEqual(1, len(self.crud.calls))
+
+    def test_invalidated_by_update(self):
+        self.sg.schema_field_read("Shot", "code")
+        self.sg.schema_field_update("Shot", "code", {"name": "Code"})
+        self.sg.schema_field_read("Shot", "code")
+        self.assertEqual(3, len(self.crud.calls))
+
+    def test_persisted(self):
+        self.sg.schema_field_read("Shot", "code")
+        self.sg.schema_cache = cache_sg.SchemaCache(self.sg.base_url, 60, self.cache_dir)
+        self.sg.schema_field_read("Shot", "code")
+        self.assertEqual(1, len(self.crud.calls))
+
+    def test_shared_file(self):
+        other = cache_sg.SchemaCache(self.sg.base_url, 60, self.cache_dir)
+        self.sg.schema_field_read("Shot", "code")
+        other.set("other process", 1)
+        cache = cache_sg.SchemaCache(self.sg.base_url, 60, self.cache_dir)
+        self.assertEqual(1, cache.get("other process"))
+        self.assertEqual(2, len(cache))
+        other.clear()
+        self.assertEqual(0, len(cache_sg.SchemaCache(self.sg.base_url, 60, self.cache_dir)))
+
+    def test_unusable_file(self):
+        path = self.sg.schema_cache.path
+        for data in ["garbage", "cnosuchmodule\nThing\n.", "c__builtin__\nint\n(S'x'\ntR.", "I1\n."]:
+            f = open(path, "wb")
+            f.write(data)
+            f.close()
+            self.assertEqual(0, len(cache_sg.SchemaCache(self.sg.base_url, 60, self.cache_dir)))
+
+class QueryCacheTestCase(ShotgunAPITestCase):
+    def setUp(self):
+        ShotgunAPITestCase.setUp(self)
+        self.sg.query_cache = cache_sg.QueryCache(60)
+
+    def test_rough_sizes(self):
+        # the guesses used without sys.getsizeof() are in the same ballpark
+        records = self.sg.find("Version", [])
+        for value in ["", "x" * 100, u"y" * 100, {}, records[0], records, tuple(records), 5, None]:
+            self.assertTrue(0.5 < float(cache_sg._rough_sizeof(value)) / sys.getsizeof(value) < 2)
+
+    def reads(self):
+        return len([c for c in self.crud.calls if "paging" in c])
+
+    def test_cached(self):
+        records = self.sg.find("Version", [["id", "less_than", 20]], ["code"])
+        self.assertEqual(10, self.reads())
+        records[0]["code"] = "changed"
+        self.assertEqual(self.sg.find("Version", [["id", "less_than", 20]], ["code"])[1:], records[1:])
+        self.assertFalse("code" in self.sg.find("Version", [["id", "less_than", 20]], ["code"])[0])
+        self.assertEqual(10, self.reads())
+        self.sg.find("Version", [["id", "less_than", 20]], ["code"], limit=5)
+        self.assertEqual(11, self.reads())
+
+    def test_invalidation(self):
+        self.sg.find("Version", [["entity.Shot.code", "is", "sh01"]])
+        self.sg.find("Version", [])
+        self.sg.update("Asset", 1, {"code": "a"})
+        self.sg.find("Version", [["entity.Shot.code", "is", "sh01"]])
+        self.sg.find("Version", [])
+        self.assertEqual(20, self.reads())
+        self.sg.update("Shot", 1, {"code": "sh02"})
+        self.sg.find("Version", [["entity.Shot.code", "is", "sh01"]])
+        self.sg.find("Version", [])
+        self.assertEqual(30, self.reads())
+        self.sg.batch([{"request_type": "update", "entity_type": "Version", "entity_id": 1, "data": {}}])
+        self.sg.find("Version", [])
+        self.assertEqual(40, self.reads())
+
+    def test_write_during_read(self):
+        cache = self.sg.query_cache
+        generations = cache.generations(("Version",))
+        cache.invalidate("Version")
+        cache.put("key", [], ("Version",), generations)
+        self.assertEqual(None, cache.get("key"))
+
+    def test_size_limit(self):
+        cache = cache_sg.QueryCache(60, max_size=10000)
+        for i in range(10):
+            cache.put(i, ["x" * 1000], ("Version",), cache.generations(("Version",)))
+        self.assertTrue(cache.size <= 10000)
+        self.assertEqual(None, cache.get(0))
+        self.assertEqual(["x" * 1000], cache.get(9))
+        cache.invalidate("Version")
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.size)
+
+class FilteringCRUD(FakeCRUD):
+    """
+    FakeCRUD that also applies the "and" filters, sorts and return_only
+    of read() requests, for records with a "retired" flag.
+    """
+    relations = {
+        "is": lambda a, b: a == b,
+        "greater_than": lambda a, b: a > b,
+        "less_than": lambda a, b: a < b,
+        "not_in": lambda a, b: a not in b,
+    }
+
+    def read(self, req):
+        self.calls.append(req)
+        records = [r for r in self.records if r.get("retired", False) == (req["return_only"] == "retired")]
+        for c in req["filters"]["conditions"]:
+            records = [r for r in records if self.relations[c["relation"]](r[c["path"]], c["values"][0])]
+        for sort in reversed(req.get("sorts", [])):
+            records.sort(key=lambda r: r[sort["field_name"]], reverse=sort["direction"] == "desc")
+        per_page = req["paging"]["entities_per_page"]
+        start = (req["paging"]["current_page"] - 1) * per_page
+        fields = req["return_fields"] + ["type", "id"]
+        return {"results": {
+            "entities": [dict([(f, r.get(f)) for f in fields]) for r in records[start:start + per_page]],
+            "paging_info": {"entity_count": len(records)}
+        }}
+
+class IncrementalSyncTestCase(ShotgunAPITestCase):
+    def setUp(self):
+        ShotgunAPITestCase.setUp(self)
+        self.start = datetime.datetime(2011, 1, 1)
+        # 15 shots updated in the same second, spanning a page boundary
+        self.crud = FilteringCRUD([{"type": "Shot", "id": i, "code": "sh%02d" % i, "project": i % 2,
+            "updated_at": self.start + datetime.timedelta(seconds=max(i - 15, 0))} for i in range(1, 41)])
+        self.sg._api3 = self.crud
+        self.syncer = self.sg.incremental_sync()
+
+    def change(self, shot_id, **values):
+        record = self.crud.records[shot_id - 1]
+        record.update(values)
+        record["updated_at"] = self.start + datetime.timedelta(seconds=100)
+
+    def test_sync(self):
+        updated, retired = self.syncer.sync("Shot", [["project", "is", 1]], ["code"])
+        self.assertEqual(range(1, 41, 2), updated)
+        self.assertEqual([], retired)
+        self.assertEqual("sh39", self.syncer.store[("Shot", 39)]["code"])
+        self.assertEqual((self.start + datetime.timedelta(seconds=24), (39,)), 
+            self.syncer.marks[("Shot", (("project", "is", 1),))])
+
+        self.assertEqual(([], []), self.syncer.sync("Shot", [["project", "is", 1]], ["code"]))
+        self.change(3, code="new")
+        self.change(2, code="other project")
+        self.change(5, retired=True)
+        self.assertEqual(([3], [5]), self.syncer.sync("Shot", [["project", "is", 1]], ["code"]))
+        self.assertEqual("new", self.syncer.store[("Shot", 3)]["code"])
+        self.assertFalse(("Shot", 5) in self.syncer.store)
+        self.assertEqual(19, len(self.syncer.store))
+
+    def test_ties(self):
+        self.syncer.marks[("Shot", ())] = (self.start, tuple(range(1, 13)))
+        self.syncer.marks[("Shot", (), "retired")] = None
+        updated, retired = self.syncer.sync("Shot", [])
+        self.assertEqual(range(13, 41), updated)
+        self.crud.calls = []
+        self.change(7)
+        self.change(8)
+        self.assertEqual(([7, 8], []), self.syncer.sync("Shot", []))
+        self.assertEqual(3, len(self.crud.calls))
+
+    def test_same_second(self):
+        self.syncer.sync("Shot", [])
+        # updated in the second of the mark, after the last sync
+        self.crud.records[2]["updated_at"] = self.start + datetime.timedelta(seconds=25)
+        self.assertEqual(([3], []), self.syncer.sync("Shot", []))
+        self.assertEqual(([], []), self.syncer.sync("Shot", []))
+
+    def test_query_cache_bypassed(self):
+        self.sg.query_cache = cache_sg.QueryCache(60)
+        self.sg.find("Shot", [])
+        self.syncer.sync("Shot", [])
+        self.change(4)
+        self.assertEqual(([4], []), self.syncer.sync("Shot", []))
+
+class ReplicaTestCase(ShotgunAPITestCase):
+    def setUp(self):
+        ShotgunAPITestCase.setUp(self)
+        self.start = datetime.datetime(2011, 1, 1, tzinfo=xmlrpc_sg.sg_timezone.local)
+        statuses = ["ip", "fin", None]
+        self.crud = FilteringCRUD([{"type": "Shot", "id": i, "code": "sh_%02d" % i, "sg_status_list": statuses[i % 3],
+            "project": {"type": "Project", "id": i % 2, "name": "p%d" % (i % 2)}, "tags": [],
+            "updated_at": self.start + datetime.timedelta(seconds=i)} for i in range(1, 41)])
+        self.sg._api3 = self.crud
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "replica.db")
+        self.fields = ["code", "sg_status_list", "project", "tags"]
+        self.replica = shotgun_api3.ShotgunReplica(self.sg, {"Shot": self.fields}, self.path)
+
+    def tearDown(self):
+        self.replica.close()
+        shutil.rmtree(self.dir)
+
+    def local_find(self, filters, fields=None, order=None, filter_operator=None, limit=0):
+        calls = len(self.crud.calls)
+        records = self.replica.find("Shot", filters, fields, order, filter_operator, limit)
+        self.assertEqual(calls, len(self.crud.calls))
+        return [r["id"] for r in records]
+
+    def test_find(self):
+        self.assertEqual(None, self.replica.staleness("Shot"))
+        self.assertEqual(40, self.replica.refresh())
+        self.assertTrue(self.replica.staleness("Shot") < 5)
+
+        self.assertEqual(range(2, 41, 3), self.local_find([["sg_status_list", "is", None]]))
+        self.assertEqual([5], self.local_find([["sg_status_list", "is", None], 
+            ["project", "is", {"type": "Project", "id": 1}], ["id", "less_than", 10]]))
+        self.assertEqual([5, 10, 15, 20], self.local_find([["code", "ends_with", "5"], ["id", "in", [10, 15]],
+            ["code", "contains", "_2"]], order=[{"field_name": "code", "direction": "asc"}], filter_operator="any", 
+            limit=4))
+        self.assertEqual([39, 38, 36], self.local_find([["updated_at", "greater_than", self.start + datetime.timedelta(seconds=35)],
+            ["sg_status_list", "is_not", "fin"]], order=[{"field_name": "id", "direction": "desc"}]))
+        self.assertEqual([], self.local_find([["code", "contains", "%"]]))
+        self.assertEqual(range(1, 41), self.local_find([["project", "type_is", "Project"]]))
+        self.assertEqual([], self.local_find([["project", "type_is", "Proj"]]))
+
+        self.assertEqual([31], self.local_find([["updated_at", "is", datetime.datetime(2011, 1, 1, 0, 0, 31)]]))
+        self.assertTrue(self.replica.find_one("Shot", [], ["updated_at"])["updated_at"].tzinfo is self.start.tzinfo)
+        shot = self.replica.find_one("Shot", [["id", "is", 7]], ["code", "project"])
+        self.assertEqual({"type": "Shot", "id": 7, "code": "sh_07", "project": self.crud.records[6]["project"]}, shot)
+
+    def test_server_semantics(self):
+        self.replica.refresh()
+        fin, ip, empty = range(1, 41, 3), range(3, 41, 3), range(2, 41, 3)
+        self.assertEqual([5], self.local_find([["code", "is", "SH_05"]]))
+        self.assertEqual([1, 2], self.local_find([["code", "in", ["SH_01", "sh_02"]]]))
+        self.assertEqual([1, 2], self.local_find([["code", "less_than", "SH_03"]]))
+        self.assertEqual(fin + ip + empty, self.local_find([], order=[{"field_name": "sg_status_list"}]))
+        self.assertEqual(empty + ip + fin, self.local_find([], order=[{"field_name": "sg_status_list",
+                                                                       "direction": "desc"}]))
+        self.assertEqual(sorted(ip + empty), self.local_find([["sg_status_list", "in", [None, "ip"]]]))
+        self.assertEqual(fin, self.local_find([["sg_status_list", "not_in", [None, "ip"]]]))
+        self.assertEqual(fin, self.local_find([["sg_status_list", "not_in", None, "ip"]]))
+        project = self.sg.find("Shot", [["id", "is", 1]], ["project"], compact=True)[0]["project"]
+        self.assertTrue(isinstance(project, shotgun_api3.Record))
+        self.assertEqual(range(1, 41, 2), self.local_find([["project", "is", project]]))
+        self.assertEqual(range(2, 41, 2), self.local_find([["project", "not_in", [project]]]))
+
+        # links are ordered by name on the server
+        self.sg.records_per_page = 100
+        self.crud.calls = []
+        self.replica.find("Shot", [], order=[{"field_name": "project", "direction": "asc"}])
+        self.replica.find("Shot", [["project", "greater_than", {"type": "Project", "id": 0}]])
+        self.assertEqual(2, len(self.crud.calls))
+        # and values sqlite can't compare are left to the server too
+        self.replica.find("Shot", [["code", "is", object()]])
+        self.assertEqual(3, len(self.crud.calls))
+
+    def test_server_fallback(self):
+        self.replica.find("Shot", [])
+        self.replica.refresh()
+        self.crud.calls = []
+        self.sg.records_per_page = 100
+        self.replica.find("Shot", [], ["description"])
+        self.replica.find("Shot", [["tags", "is", []]])
+        self.replica.find("Asset", [])
+        self.assertEqual(["Shot", "Shot", "Asset"], [c["type"] for c in self.crud.calls])
+
+    def test_refresh(self):
+        self.replica.refresh()
+        self.crud.records[4]["code"] = "changed"
+        self.crud.records[4]["updated_at"] = self.start + datetime.timedelta(seconds=100)
+        self.crud.records[5]["retired"] = True
+        self.crud.records[5]["updated_at"] = self.start + datetime.timedelta(seconds=100)
+        self.crud.calls = []
+        self.assertEqual(2, self.replica.refresh())
+        self.assertEqual([5], self.local_find([["code", "is", "changed"]]))
+        self.assertEqual([], self.local_find([["id", "is", 6]]))
+
+        # another process opening the same file carries on from there
+        other = shotgun_api3.ShotgunReplica(self.sg, {"Shot": self.fields}, self.path)
+        self.assertEqual([5], [r["id"] for r in other.find("Shot", [["code", "is", "changed"]])])
+        self.crud.calls = []
+        self.assertEqual(0, other.refresh())
+        self.assertEqual(4, len(self.crud.calls))
+        other.close()
+        # but not with other fields
+        other = shotgun_api3.ShotgunReplica(self.sg, {"Shot": ["code"]}, self.path)
+        self.assertEqual(None, other.staleness("Shot"))
+        self.assertEqual(39, other.refresh())
+        other.close()
+
+    def test_shared_file(self):
+        import sqlite3
+        other = shotgun_api3.ShotgunReplica(self.sg, {"Shot": self.fields}, self.path)
+        read = self.crud.read
+        def locking_read(req):
+            # other processes can write to the file while a refresh runs
+            db = sqlite3.connect(self.path, timeout=0)
+            db.execute("BEGIN IMMEDIATE")
+            db.rollback()
+            db.close()
+            return read(req)
+        self.crud.read = locking_read
+        self.assertEqual(40, self.replica.refresh())
+
+        self.assertTrue(other.staleness("Shot") < 5)
+        self.crud.calls = []
+        self.assertEqual([5], [r["id"] for r in other.find("Shot", [["code", "is", "sh_05"]])])
+        self.assertEqual(0, other.refresh())
+        self.assertEqual(3, len(self.crud.calls))
+        other.close()
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_eviction(self):
+        cache = cache_sg.LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual([("c", 3), ("a", 1)], [i[:2] for i in cache.items()])
+
+    def test_ttl(self):
+        cache = cache_sg.LRUCache(2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2, expires=time.time() - 1)
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual(1, len(cache))
+
+def xmlrpc_echo(handler):
+    # answers any XML-RPC call with its last parameter
+    params, method = xmlrpclib.loads(handler.body)
+    return 200, {"Content-Type": "text/xml"}, xmlrpclib.dumps((params[-1],), methodresponse=1)
+
+def xmlrpc_compressed_echo(handler, encoding="gzip"):
+    # like xmlrpc_echo, but takes gzipped requests and compresses the
+    # response with the given encoding when the client accepts it
+    handler.raw_body = handler.body
+    if handler.headers.get("content-encoding") == "gzip":
+        handler.body = gzip.GzipFile(fileobj=StringIO.StringIO(handler.body)).read()
+    status, headers, body = xmlrpc_echo(handler)
+    if encoding in handler.headers.get("accept-encoding", ""):
+        if encoding == "gzip":
+            f = StringIO.StringIO()
+            gzf = gzip.GzipFile(mode="wb", fileobj=f)
+            gzf.write(body)
+            gzf.close()
+            body = f.getvalue()
+        else:
+            body = zlib.compress(body)
+        headers["Content-Encoding"] = encoding
+    return status, headers, body
+
+class FakeConnection(object):
+    closed = False
+    def close(self):
+        self.closed = True
+
+class UploadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer({"/upload/upload_file": lambda handler: (200, {}, "1:42\n")})
+        self.sg = shotgun_api3.Shotgun(self.server.url, "test_script", "0123456789abcdef")
+        fd, self.path = tempfile.mkstemp(suffix=".mov")
+        self.data = "".join([chr(i % 256) for i in range(300000)])
+        os.write(fd, self.data)
+        os.close(fd)
+
+    def tearDown(self):
+        self.server.stop()
+        os.remove(self.path)
+
+    def test_streamed_upload(self):
+        self.assertEqual(42, self.sg.upload("Version", 1, self.path, "sg_uploaded_movie"))
+        request = self.server.requests[-1]
+        self.assertEqual(len(request.body), int(request.headers["content-length"]))
+        import cgi
+        form = cgi.FieldStorage(fp=StringIO.StringIO(request.body), headers=request.headers,
+                                environ={"REQUEST_METHOD": "POST"})
+        self.assertEqual(self.data, form["file"].value)
+        self.assertEqual("sg_uploaded_movie", form["field_name"].value)
+
+    def test_unicode_upload(self):
+        # a unicode path, kept ascii so any filesystem encoding can open it
+        path = os.path.join(unicode(tempfile.mkdtemp()), u"cafe.mov")
+        shutil.copy(self.path, path)
+        try:
+            self.assertEqual(42, self.sg.upload("Version", 1, path, u"sg_uploaded_movie", u"caf\xe9 movie",
+                                                u"t\xe4g"))
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+        request = self.server.requests[-1]
+        self.assertEqual(len(request.body), int(request.headers["content-length"]))
+        import cgi
+        form = cgi.FieldStorage(fp=StringIO.StringIO(request.body), headers=request.headers,
+                                environ={"REQUEST_METHOD": "POST"})
+        self.assertEqual(self.data, form["file"].value)
+        self.assertEqual("cafe.mov", form["file"].filename)
+        self.assertEqual("caf\xc3\xa9 movie", form["display_name"].value)
+        self.assertEqual("t\xc3\xa4g", form["tag_list"].value)
+
+    def test_upload_many(self):
+        items = [{"entity_type": "Version", "entity_id": i, "path": self.path} for i in range(5)]
+        items.append({"entity_type": "Version", "entity_id": 5, "path": "/no/such/file"})
+        results = self.sg.upload_many(items)
+        self.assertEqual([42] * 5 + [None], [r["result"] for r in results])
+        self.assertTrue(isinstance(results[-1]["error"], shotgun_api3.ShotgunError))
+
+    def test_stream_matches_encode(self):
+        from lib.form_post_handler import FormPostHandler
+        handler = FormPostHandler()
+        fd = open(self.path, "rb")
+        params = [("entity_id", 1), ("display_name", "movie")]
+        boundary, body = handler.encode(params, [("file", fd)], "BOUNDARY")
+        boundary, stream = handler.encode_stream(params, [("file", fd)], "BOUNDARY")
+        self.assertEqual(len(body), stream.length)
+        chunks = []
+        chunk = stream.read(1000)
+        while chunk:
+            chunks.append(chunk)
+            chunk = stream.read(1000)
+        self.assertEqual(body, "".join(chunks))
+        fd.close()
+
+def session_token(handler):
+    return 200, {"Content-Type": "text/xml"}, xmlrpclib.dumps(({"session_id": "0123abcd"},), methodresponse=1)
+
+def ranged_file(data):
+    # serves data, honouring "Range: bytes=N-" requests
+    def route(handler):
+        byte_range = handler.headers.get("range")
+        if not byte_range:
+            return 200, {}, data
+        start = int(byte_range.split("=")[1].rstrip("-"))
+        if start >= len(data):
+            return 416, {"Content-Range": "bytes */%d" % len(data)}, ""
+        return 206, {"Content-Range": "bytes %d-%d/%d" % (start, len(data) - 1, len(data))}, data[start:]
+    return route
+
+class DownloadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data = "".join([chr(i % 256) for i in range(300000)])
+        self.server = StandInServer({"/api2/": session_token,
+            "/file_serve/attachment/7": ranged_file(self.data),
+            "/file_serve/attachment/8": lambda handler: (200, {}, "\n<!DOCTYPE html><html></html>")})
+        self.sg = shotgun_api3.Shotgun(self.server.url, "test_script", "0123456789abcdef")
+        self.sg.download_chunk_size = 1000
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        self.server.stop()
+        os.remove(self.path)
+
+    def test_download(self):
+        self.assertEqual(self.data, self.sg.download_attachment(7))
+        self.assertEqual("_session_id=0123abcd", self.server.requests[-1].headers["cookie"])
+
+    def test_download_to_file(self):
+        self.assertEqual(self.path, self.sg.download_attachment(7, self.path))
+        self.assertEqual(self.data, open(self.path, "rb").read())
+        f = StringIO.StringIO()
+        self.sg.download_attachment(7, f)
+        self.assertEqual(self.data, f.getvalue())
+
+    def test_resume(self):
+        open(self.path, "wb").write(self.data[:1234])
+        self.sg.download_attachment(7, self.path, resume=True)
+        self.assertEqual("bytes=1234-", self.server.requests[-1].headers["range"])
+        self.assertEqual(self.data, open(self.path, "rb").read())
+        self.sg.download_attachment(7, self.path, resume=True)
+        self.assertEqual(self.data, open(self.path, "rb").read())
+
+    def test_resume_other_file(self):
+        # a partial file bigger than the remote one isn't part of it
+        open(self.path, "wb").write(self.data + "more")
+        self.sg.download_attachment(7, self.path, resume=True)
+        self.assertEqual(self.data, open(self.path, "rb").read())
+        self.assertFalse("range" in self.server.requests[-1].headers)
+        # nor is one when the server doesn't say how big the file is
+        self.server.routes["/file_serve/attachment/9"] = lambda handler: \
+            handler.headers.get("range") and (416, {}, "") or (200, {}, self.data)
+        open(self.path, "wb").write(self.data)
+        self.sg.download_attachment(9, self.path, resume=True)
+        self.assertEqual(2, len([r for r in self.server.requests if r.path.endswith("/9")]))
+
+    def test_download_many(self):
+        paths = [self.path + "_%d" % i for i in range(6)]
+        items = [{"entity_id": 7, "file_path": p} for p in paths] + [{"entity_id": 8}]
+        results = self.sg.download_many(items, max_workers=3)
+        self.assertEqual(paths + [None], [r["result"] for r in results])
+        self.assertTrue(isinstance(results[-1]["error"], shotgun_api3.ShotgunError))
+        for p in paths:
+            self.assertEqual(self.data, open(p, "rb").read())
+            os.remove(p)
+        # one session token for all of them
+        self.assertEqual(1, len([r for r in self.server.requests if r.path == "/api2/"]))
+
+    def test_session_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            for i in range(2):
+                sg = shotgun_api3.Shotgun(self.server.url, "test_script", "0123456789abcdef",
+                    session_cache_dir=cache_dir)
+                self.assertEqual(self.data, sg.download_attachment(7))
+                self.assertEqual("_session_id=0123abcd", self.server.requests[-1].headers["cookie"])
+            self.assertEqual(1, len([r for r in self.server.requests if r.path == "/api2/"]))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_unusable_session_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = cache_sg.SessionCache(self.server.url, "test_script", cache_dir)
+            for data in ["garbage", "I1\n.", "(S'x'\ntp0\n.", "(S'x'\nS'y'\ntp0\n.", "(lp0\n."]:
+                f = open(cache.path, "wb")
+                f.write(data)
+                f.close()
+                self.assertEqual("new", cache.get(lambda: "new")[0])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_session_rejected(self):
+        def logged_in_only(handler):
+            if handler.headers.get("cookie") != "_session_id=0123abcd":
+                return 403, {}, ""
+            return 200, {}, self.data
+        self.server.routes["/file_serve/attachment/9"] = logged_in_only
+        cache_dir = tempfile.mkdtemp()
+        try:
+            sg = shotgun_api3.Shotgun(self.server.url, "test_script", "0123456789abcdef",
+                session_cache_dir=cache_dir)
+            sg.session_cache.get(lambda: "expired")
+            self.assertRaises(shotgun_api3.ShotgunError, sg.download_attachment, 9)
+            self.assertEqual(0, len([r for r in self.server.requests if r.path == "/api2/"]))
+            # once the token is old enough to have expired, a new one is fetched
+            sg.session_token_min_age = 0
+            self.assertEqual(self.data, sg.download_attachment(9))
+            self.assertEqual(1, len([r for r in self.server.requests if r.path == "/api2/"]))
+            self.assertEqual("0123abcd", sg.session_cache.get(lambda: "unused")[0])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_error_page_keeps_session(self):
+        page = '<!DOCTYPE html><html><body>%s</body></html>'
+        def login(handler):
+            return 200, {}, page % '<form action="/user/login"><input type="password"></form>'
+        self.server.routes["/file_serve/attachment/9"] = lambda handler: (200, {}, page % "not found")
+        self.server.routes["/file_serve/attachment/10"] = login
+        self.server.routes["/file_serve/attachment/11"] = lambda handler: (302, {"Location": "/user/login"}, "")
+        self.server.routes["/user/login"] = lambda handler: (200, {}, page % "log in")
+        cache_dir = tempfile.mkdtemp()
+        try:
+            sg = shotgun_api3.Shotgun(self.server.url, "test_script", "0123456789abcdef",
+                session_cache_dir=cache_dir)
+            sg.session_token_min_age = 0
+            sg.session_cache.get(lambda: "shared")
+            # a file that can't be served leaves the session alone
+            try:
+                sg.download_attachment(9)
+            except shotgun_api3.ShotgunError, e:
+                self.assertTrue("doesn't exist" in str(e))
+            else:
+                self.fail("no error for an error page")
+            self.assertEqual(0, len([r for r in self.server.requests if r.path == "/api2/"]))
+            self.assertEqual("shared", sg.session_cache.get(lambda: "unused")[0])
+            # the login page means the token was rejected
+            for entity_id in (10, 11):
+                self.assertRaises(shotgun_api3.ShotgunError, sg.download_attachment, entity_id)
+            self.assertEqual(2, len([r for r in self.server.requests if r.path == "/api2/"]))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            sg = shotgun_api3.Shotgun(self.server.url, "test_script", "0123456789abcdef",
+                attachment_cache_dir=cache_dir, attachment_cache_size=len(self.data))
+            self.assertEqual(self.data, sg.download_attachment(7))
+            count = len(self.server.requests)
+            self.assertEqual(self.data, sg.download_attachment(7))
+            self.assertEqual(self.data, sg.open_attachment(7)[:])
+            sg.download_attachment(7, self.path)
+            self.assertEqual(self.data, open(self.path, "rb").read())
+            self.assertEqual(count, len(self.server.requests))
+            # a second attachment pushes the first one out
+            self.server.routes["/file_serve/attachment/9"] = ranged_file("x" * 10)
+            path = sg.attachment_path(9)
+            self.assertEqual([os.path.basename(path)], os.listdir(os.path.dirname(path)))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_error_page(self):
+        self.assertRaises(shotgun_api3.ShotgunError, self.sg.download_attachment, 8, self.path)
+        self.assertRaises(shotgun_api3.ShotgunError, self.sg.download_attachment, 8)
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def test_reuse(self):
+        pool = xmlrpc_sg.ConnectionPool(2)
+        c = pool.checkout("host", lambda host: FakeConnection())
+        pool.checkin("host", c)
+        self.assertTrue(c is pool.checkout("host", lambda host: FakeConnection()))
+
+    def test_bounded(self):
+        pool = xmlrpc_sg.ConnectionPool(1)
+        c = pool.checkout("host", lambda host: FakeConnection())
+        got = []
+        t = threading.Thread(target=lambda: got.append(pool.checkout("host", lambda host: FakeConnection())))
+        t.start()
+        t.join(0.2)
+        self.assertEqual([], got)
+        pool.checkin("host", c)
+        t.join()
+        self.assertEqual([c], got)
+
+    def test_max_lifetime(self):
+        pool = xmlrpc_sg.ConnectionPool(2, max_lifetime=0)
+        c = pool.checkout("host", lambda host: FakeConnection())
+        c._pool_created -= 1
+        pool.checkin("host", c)
+        self.assertTrue(c.closed)
+        self.assertFalse(c is pool.checkout("host", lambda host: FakeConnection()))
+
+def make_find_response(count):
+    # a read() response shaped like the ones the server sends for find()
+    import datetime
+    entities = []
+    for i in range(count):
+        entities.append({"type": "Version", "id": i, "code": "shot_%04d_comp_v%03d" % (i / 10, i % 10),
+            "sg_status_list": "rev", "frame_count": 120, "created_at": datetime.datetime(2010, 5, 1, 12, 30),
+            "entity": {"type": "Shot", "id": i / 10, "name": "shot_%04d" % (i / 10)},
+            "description": "notes & <comments>"})
+    return xmlrpclib.dumps(({"results": {"entities": entities,
+        "paging_info": {"entity_count": count}}},), methodresponse=1)
+
+def paged_find(records):
+    # answers read() calls a page at a time from records
+    def route(handler):
+        params, method = xmlrpclib.loads(handler.body)
+        paging = params[1]["paging"]
+        start = (paging["current_page"] - 1) * paging["entities_per_page"]
+        page = records[start:start + paging["entities_per_page"]]
+        return 200, {"Content-Type": "text/xml"}, xmlrpclib.dumps(({"results": {"entities": page,
+            "paging_info": {"entity_count": len(records)}}},), methodresponse=1, allow_none=1)
+    return route
+
+class FindColumnsTestCase(unittest.TestCase):
+    def setUp(self):
+        import datetime
+        self.records = []
+        for i in range(1, 96):
+            self.records.append({"type": "Version", "id": i, "code": "v%03d" % i,
+                "frame_count": i % 7 and 100 + i or None, "cut_in": 1001, "sg_ready": i % 2 == 0,
+                "created_at": datetime.datetime(2010, 5, 1, 12, i % 60),
+                "entity": i % 5 and {"type": "Shot", "id": i / 10, "name": "shot_%d" % (i / 10)} or None})
+        self.server = StandInServer({"/api3_preview/": paged_find(self.records)})
+        self.sg = shotgun_api3.Shotgun(self.server.url, "test_script", "0123456789abcdef")
+        self.sg.records_per_page = 20
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_columns(self):
+        import array
+        columns = self.sg.find_columns("Version", [], ["code", "frame_count", "cut_in", "sg_ready", "created_at", "entity"])
+        self.assertEqual(5, len(self.server.requests))
+        self.assertEqual(array.array("l", range(1, 96)), columns["id"])
+        self.assertEqual(["Version"] * 95, columns["type"])
+        self.assertEqual([r["code"] for r in self.records], columns["code"])
+        self.assertEqual(array.array("l", [1001] * 95), columns["cut_in"])
+        self.assertEqual(array.array("b", [r["sg_ready"] for r in self.records]), columns["sg_ready"])
+        frames = columns["frame_count"]
+        self.assertEqual("d", frames.typecode)
+        self.assertEqual(101.0, frames[0])
+        self.assertTrue(frames[6] != frames[6]) # NaN for None
+        self.assertEqual([calendar.timegm(r["created_at"].timetuple()) for r in self.records], list(columns["created_at"]))
+        self.assertEqual([r["entity"] and "Shot" for r in self.records], columns["entity.type"])
+        self.assertEqual(array.array("l", [r["entity"] and r["entity"]["id"] or 0 for r in self.records]),
+                         columns["entity.id"])
+
+    def test_limit(self):
+        columns = self.sg.find_columns("Version", [], ["code"], limit=30)
+        self.assertEqual(range(1, 31), list(columns["id"]))
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            return
+        columns = self.sg.find_columns("Version", [], ["cut_in"], numpy=True)
+        self.assertEqual(1001 * 95, columns["cut_in"].sum())
+
+    def test_thumbnails(self):
+        for r in self.records:
+            r["image"] = r["id"] % 3 and "thumb" or None
+        self.server.routes["/upload/get_thumbnail_url"] = lambda handler: \
+            (200, {}, "1\n/files/thumb_%s.jpg\n" % handler.path.split("entity_id=")[1])
+        columns = self.sg.find_columns("Version", [], ["image"])
+        self.assertEqual([r["image"] and self.server.url + "/files/thumb_%d.jpg" % r["id"] for r in self.records],
+                         columns["image"])
+
+    def test_retried_page(self):
+        transport = self.sg._api3._ShotgunCRUD__sg("transport")
+        single_request = transport.single_request
+        def reset_once(*args):
+            result = single_request(*args)
+            if len(self.server.requests) == 2:
+                raise socket.error(errno.ECONNRESET, "Connection reset by peer")
+            return result
+        transport.single_request = reset_once
+        columns = self.sg.find_columns("Version", [], ["code"])
+        self.assertEqual(range(1, 96), list(columns["id"]))
+        self.assertEqual(6, len(self.server.requests))
+
+class CoalescingTestCase(unittest.TestCase):
+    def setUp(self):
+        def slow_echo(handler):
+            time.sleep(0.3)
+            return xmlrpc_echo(handler)
+        self.server = StandInServer({"/api3_preview/": slow_echo})
+        self.sg = shotgun_api3.Shotgun(self.server.url, "test_script", "0123456789abcdef")
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_identical_reads(self):
+        req = {"type": "Shot", "filters": {"conditions": []}}
+        results = shotgun_api3._parallel_map(lambda i: self.sg._api3.read(req), range(4), 4)
+        self.assertEqual([req] * 4, results)
+        self.assertEqual(1, len(self.server.requests))
+        results[0]["type"] = "Asset"
+        self.assertEqual("Shot", results[1]["type"])
+
+    def test_result_changed_by_caller(self):
+        req = {"type": "Shot", "entities": [{"id": i, "image": "thumb"} for i in range(5000)]}
+        def read(i):
+            result = self.sg._api3.read(req)
+            unchanged = [e for e in result["entities"] if e["image"] == "thumb"]
+            # like find() does with thumbnail urls, as soon as it gets them
+            for e in result["entities"]:
+                e["image"] = "url %d" % i
+            return len(unchanged)
+        self.assertEqual([5000] * 4, shotgun_api3._parallel_map(read, range(4), 4))
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_different_calls(self):
+        shotgun_api3._parallel_map(lambda i: self.sg._api3.read({"id": i % 2}), range(4), 4)
+        self.assertEqual(2, len(self.server.requests))
+        shotgun_api3._parallel_map(lambda i: self.sg._api3.update({"id": 1}), range(2), 2)
+        self.assertEqual(4, len(self.server.requests))
+
+class TransportTestCase(unittest.TestCase):
+    def setUp(self):
+        big_response = make_find_response(2000)
+        self.server = StandInServer({"/api3_preview/": xmlrpc_echo,
+            "/big/": lambda handler: (200, {"Content-Type": "text/xml"}, big_response)})
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_shared_between_threads(self):
+        proxy = xmlrpc_sg.ServerProxy(self.server.url + "/api3_preview/", max_connections=3)
+        results = shotgun_api3._parallel_map(lambda i: proxy.echo({"id": i}), range(40), 8)
+        self.assertEqual([{"id": i} for i in range(40)], results)
+        self.assertTrue(len(set([r.client_address for r in self.server.requests])) <= 3)
+
+    def test_compression(self):
+        self.server.routes["/api3_preview/"] = xmlrpc_compressed_echo
+        sg = shotgun_api3.Shotgun(self.server.url, "test_script", "0123456789abcdef", compress_request_threshold=1000)
+        data = {"code": "x" * 5000}
+        self.assertEqual(data, sg._api3.create(data))
+        request = self.server.requests[-1]
+        self.assertEqual("gzip", request.headers.get("content-encoding"))
+        self.assertTrue(len(request.raw_body) < 1000)
+        self.assertEqual({"id": 1}, sg._api3.update({"id": 1}))
+        self.assertEqual(None, self.server.requests[-1].headers.get("content-encoding"))
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_deflate_response(self):
+        self.server.routes["/deflate/"] = lambda handler: xmlrpc_compressed_echo(handler, "deflate")
+        proxy = xmlrpc_sg.ServerProxy(self.server.url + "/deflate/")
+        self.assertEqual(range(1000), proxy.read(range(1000)))
+
+    def test_large_response(self):
+        proxy = xmlrpc_sg.ServerProxy(self.server.url + "/big/")
+        chunked = proxy.read({})
+        proxy("transport").zero_copy = 1
+        zero_copy = proxy.read({})
+        self.assertEqual(2000, len(chunked["results"]["entities"]))
+        self.assertEqual("notes & <comments>", chunked["results"]["entities"][5]["description"])
+        self.assertEqual(chunked, zero_copy)
+
+    def test_server_errors(self):
+        def broken(handler):
+            raise ValueError("broken route")
+        self.server.routes["/broken/"] = broken
+        self.assertRaises(Exception, urllib2.urlopen, self.server.url + "/broken/")
+        self.assertRaises(ValueError, self.server.stop)
+
+    def test_truncated_response(self):
+        def truncated(handler):
+            handler.close_connection = 1
+            body = make_find_response(10)
+            return 200, {"Content-Type": "text/xml", "Content-Length": str(len(body) + 100)}, body
+        self.server.routes["/truncated/"] = truncated
+        proxy = xmlrpc_sg.ServerProxy(self.server.url + "/truncated/")
+        proxy("transport").zero_copy = 1
+        self.assertRaises(httplib.IncompleteRead, proxy.read, {})
+        self.assertEqual({}, proxy("transport")._pool._idle)
+
+class MarshallerTestCase(unittest.TestCase):
+    def test_same_as_marshaller(self):
+        import datetime
+        values = ({"type": "Version", "id": 1, "code": u"caf\xe9 & <bar>", "none": None, "big": 2L**20,
+                   "flags": (True, False), "frames": 2.5, "created_at": datetime.datetime(2010, 5, 1, 12, 30),
+                   "date": datetime.date(2010, 5, 1), "wrapped": xmlrpc_sg.DateTime("20100501T12:30:00"),
+                   "data": xmlrpc_sg.Binary("\0\1"), u"n\xe4me": [{"a": "<"}, [], {}]},)
+        self.assertEqual(xmlrpc_sg.Marshaller("utf-8").dumps(values),
+                         xmlrpc_sg.BufferedMarshaller("utf-8").dumps(values))
+        fault = xmlrpc_sg.Fault(1, "<error>")
+        self.assertEqual(xmlrpc_sg.Marshaller("utf-8").dumps(fault),
+                         xmlrpc_sg.BufferedMarshaller("utf-8").dumps(fault))
+
+    def test_marshalled(self):
+        auth = {"script_name": "test_script", "script_key": "0123456789abcdef"}
+        data = {"id": 1, "code": "a & b"}
+        expected = xmlrpclib.dumps((auth, data), "update")
+        self.assertEqual(expected, xmlrpc_sg.dumps((xmlrpc_sg.Marshalled(auth), data), "update"))
+        self.assertEqual(expected, xmlrpc_sg.dumps((auth, data), "update"))
+
+    def test_errors(self):
+        self.assertRaises(OverflowError, xmlrpc_sg.dumps, ({"id": 2**40},))
+        self.assertRaises(TypeError, xmlrpc_sg.dumps, ({"id": set()},))
+        self.assertRaises(TypeError, xmlrpc_sg.dumps, ({1: 1},))
+        value = []
+        value.append(value)
+        m = xmlrpc_sg.BufferedMarshaller(check_recursion=1)
+        self.assertRaises(TypeError, m.dumps, (value,))
+
+class UnmarshallerTestCase(unittest.TestCase):
+    def test_same_as_xmlrpclib(self):
+        values = [{"type": "Version", "id": 1, "code": u"caf\xe9 & <bar>", "empty": "", "none": None,
+                   "flags": [True, False], "frames": 2.5, "text": "line\n" * 5000, "bare": "bare &amp;",
+                   "entity": {"type": "Shot", "id": 2, u"n\xe4me": u"\u65e5\u672c"}}, [], {}]
+        response = xmlrpclib.dumps((values,), methodresponse=1, allow_none=1)
+        response = response.replace("<value><string>bare &amp;amp;</string>", "<value>bare &amp;amp;")
+        self.assertTrue("<value>bare" in response)
+        self.assertEqual(xmlrpclib.loads(response), xmlrpc_sg.loads(response))
+
+    def test_interned_keys(self):
+        response = xmlrpclib.dumps(([{"sg_status_list": 1}, {"sg_status_list": 2}],), methodresponse=1)
+        p, u = xmlrpc_sg.getparser()
+        self.assertTrue(isinstance(u, xmlrpc_sg.ExpatUnmarshaller))
+        p.feed(response)
+        p.close()
+        first, second = u.close()[0]
+        self.assertTrue(first.keys()[0] is second.keys()[0])
+
+class TimezoneTestCase(unittest.TestCase):
+    def test_fromutc(self):
+        import datetime
+        local = xmlrpc_sg.sg_timezone.local
+        value = datetime.datetime(2009, 1, 1)
+        while value.year < 2011:
+            expected = datetime.datetime.fromtimestamp(calendar.timegm(value.timetuple()))
+            self.assertEqual(expected, local.fromutc(value.replace(tzinfo=local)).replace(tzinfo=None))
+            value += datetime.timedelta(hours=7, minutes=13)
+
+    def test_unmarshal(self):
+        import datetime
+        utc = datetime.datetime(2010, 5, 1, 12, 30, 5)
+        expected = utc.replace(tzinfo=xmlrpc_sg.sg_timezone.utc).astimezone(xmlrpc_sg.sg_timezone.local)
+        response = xmlrpclib.dumps(([utc, utc, {"created_at": utc}],), methodresponse=1)
+        values = xmlrpc_sg.loads(response)[0][0]
+        self.assertEqual([expected, expected, {"created_at": expected}], values)
+        self.assertEqual([utc, utc], [v.replace(tzinfo=None) for v in
+            xmlrpc_sg.loads(response, convert_datetimes_to_utc=0)[0][0][:2]])
+
+    def test_utcoffset(self):
+        import datetime
+        from lib import timezone_sg
+        local = xmlrpc_sg.sg_timezone.local
+        value = datetime.datetime(2009, 1, 1)
+        while value.year < 2011:
+            # the offsets that give back the local time, leaving out the
+            # hours repeated or skipped at dst transitions
+            offsets = set([offset for offset in (timezone_sg.STDOFFSET, timezone_sg.DSTOFFSET)
+                if datetime.datetime.fromtimestamp(calendar.timegm((value - offset).timetuple())) == value])
+            if len(offsets) != 1:
+                value += datetime.timedelta(hours=7, minutes=13)
+                continue
+            expected = offsets.pop()
+            self.assertEqual(expected, local.utcoffset(value))
+            # again, from the per day cache
+            self.assertEqual(expected, local.utcoffset(value))
+            value += datetime.timedelta(hours=7, minutes=13)
 
 if __name__ == "__main__":
     unittest.main()